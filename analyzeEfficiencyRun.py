@@ -1,7 +1,13 @@
 
-import sys, os, glob, shutil, json, math, re, random
+import sys, os, glob, shutil, json, math, re, random, multiprocessing
 import ROOT
+import numpy as np
 import analyzer as an
+import render
+import histograms
+import scanlog
+import caen
+import rawdata
 import config 
 
 ROOT.gROOT.SetBatch()
@@ -45,28 +51,145 @@ def setGraphStyle(g, xlabel, ylabel):
     return g
 
 
-if __name__ == "__main__":
+# Output: output directory of a chamber (see cfg: the output directory itself for a single chamber)
+def chamberDir(outputdir, name):
 
-    ## tag: all the plots and results will be saved in a directory with its tagname
-    tag = "INFN_efficiency"
+    return outputdir + name + "/" if name != "" else outputdir
     
-    ## config: specify the configuration containing the mapping and strip dimensions (see config.py)
-    cfg = config.cfg_GRAPHITE_HIGH
     
-    ## dir: ROOT directory of all raw data files 
-    dir = "."
+# Analyze one single HV point of all the chambers (executed in a worker process when nJobs > 1)
+# Output: the analyzer results of each chamber, tables of each chamber written once per scan {kind: table} (see writeTables)
+def analyzeHVPoint(args):
+
+    dir, outputdir, scanid, HVPoint, chambers, computeOnly, nJobsPerHVPoint, muonPeak, formats, renderJobs, eventSummary = args
+    print "Analyze HV point %d " % HVPoint
     
-    ## xMin, xMax: typical voltage range for the analysis 
-    xMin, xMax = 6000, 8000
+    results, tables, data = {}, {}, None
+    for name in sorted(chambers):
     
+        saveDir = chamberDir(outputdir, name) + "HV%d/" % HVPoint
+        if not os.path.exists(saveDir): os.makedirs(saveDir)
 
+        analyzer = an.Analyzer(dir, saveDir, scanid, HVPoint, "efficiency", nJobs = nJobsPerHVPoint, data = data)
+        analyzer.loadConfig(chambers[name])
+        analyzer.setVerbose(1)
+        analyzer.setComputeOnly(computeOnly)
+        analyzer.setFormats(formats)
+        analyzer.setRenderJobs(renderJobs)
+        analyzer.request("timeProfile", *muonPeak[name]) # args: peakMean (ns), peakWidth (ns); NO FIT. -1: Gaussian fit per HV point
+        analyzer.request("timeStripProfile2D")
+        analyzer.request("stripProfile")
+        analyzer.request("clusterization", *chambers[name].get("clusterTimeWindows", (10, 4, 16))) # args: nominal/up/down clusterization time constraint (ns), per config if given (see sweep.py)
+        analyzer.request("efficiency")
+        if eventSummary: analyzer.request("eventSummary", 10) # per-event summary table (args: clusterization time constraint (ns)), see Analyzer.eventSummary
+        analyzer.run() # perform all the requested stages (in dependency order)
+        #analyzer.eventDisplay(10) # args: amount of events to be plotted (randomly). -1: all events
+        #analyzer.eventDisplay(-1, lambda s: s["CMP"] >= 3, "pdf") # events selected on their summary (see Analyzer.eventSummary), in one PDF file
+        
+        analyzer.finishRender() # wait for the plots of the render queue
+        
+        results[name] = analyzer.getResults() # all the results, written once per scan (see writeHVPoints)
+        tables[name] = dict((kind, table) for kind, table in [("eventSummary", analyzer.eventTable)] if table is not None) # written once per scan (see writeTables)
+        data = analyzer.data # the DAQ file is read once, the raw data are shared by all the chambers (not in streaming mode)
     
-    ##############################################################################################
-    outputdir = "%s/%s/" % (dir, tag)
-    #if os.path.exists(outputdir): shutil.rmtree(outputdir) # delete output dir, if exists
-    if not os.path.exists(outputdir):os.makedirs(outputdir) # make output dir
+    return results, tables
+
+
+# Time profiles of one single HV point of all the chambers, without fit (executed in a worker process when nJobs > 1)
+def timeProfileHVPoint(args):
+
+    dir, outputdir, scanid, HVPoint, chambers, nJobsPerHVPoint = args
+    
+    timeProfiles, data = {}, None
+    for name in sorted(chambers):
+    
+        saveDir = chamberDir(outputdir, name) + "HV%d/" % HVPoint
+        if not os.path.exists(saveDir): os.makedirs(saveDir)
+
+        analyzer = an.Analyzer(dir, saveDir, scanid, HVPoint, "efficiency", nJobs = nJobsPerHVPoint, data = data)
+        analyzer.loadConfig(chambers[name])
+        timeProfiles[name] = analyzer.timeProfileHist() # cached with the stage results, i.e. not filled again by analyzeHVPoint
+        data = analyzer.data
+        
+    return timeProfiles
     
     
+# Estimate the muon peak of each chamber once for a list of HV points, from the sum of their time profiles (see an.muonPeak)
+# Input: time profiles of each chamber summed over earlier HV points (None: no earlier HV points)
+# Output: peak mean and width (ns) of each chamber, summed time profiles including the given HV points
+def scanMuonPeak(dir, outputdir, scanid, HVPoints, chambers, nJobs, nJobsPerHVPoint, timeProfiles = None):
+
+    jobs = [(dir, outputdir, scanid, HVPoint, chambers, nJobsPerHVPoint) for HVPoint in HVPoints]
+    if nJobs > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(nJobs, len(jobs)))
+        results = pool.map(timeProfileHVPoint, jobs)
+        pool.close()
+        pool.join()
+    else:
+        results = [timeProfileHVPoint(job) for job in jobs]
+        
+    if timeProfiles is None: timeProfiles = {}
+    peaks = {}
+    for name in sorted(chambers):
+    
+        for h in results: timeProfiles[name] = histograms.merge(timeProfiles.get(name), h[name])
+        peaks[name] = an.muonPeak(timeProfiles[name])
+        if peaks[name][0] == -1: print "No significant muon peak found in the scan %s" % name
+        else: print "Muon peak of the scan %s: mean %.1f ns, width %.1f ns" % (name, peaks[name][0], peaks[name][1])
+        
+    return peaks, timeProfiles
+
+
+# Output: True if the DAQ files of the HV points are decoded once by the two passes of muonPeak = "scan" (time profiles,
+# then the analysis), i.e. their decoded hits are cached or can be cached (see rawdata.cacheAvailable)
+def scanCacheAvailable(dir, scanid, HVPoints):
+
+    return all(rawdata.cacheAvailable("%s/Scan%.6d_HV%d_DAQ.root" % (dir, scanid, HVPoint)) for HVPoint in HVPoints)
+
+
+# Analyze a list of HV points, in parallel if nJobs > 1
+# Input: chambers {name: config}, peak mean and width (ns) of the muon peak of each chamber, (-1, -1): Gaussian fit per HV point
+# Output: the analyzer results and tables of each HV point and chamber (see analyzeHVPoint)
+def analyzeHVPoints(dir, outputdir, scanid, HVPoints, chambers, computeOnly, nJobs, nJobsPerHVPoint, muonPeak, formats = "both", renderJobs = 0, eventSummary = False):
+
+    jobs = [(dir, outputdir, scanid, HVPoint, chambers, computeOnly, nJobsPerHVPoint, muonPeak, formats, renderJobs, eventSummary) for HVPoint in HVPoints]
+    if nJobs > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(nJobs, len(jobs)))
+        results = pool.map(analyzeHVPoint, jobs)
+        pool.close()
+        pool.join()
+    else:
+        results = [analyzeHVPoint(job) for job in jobs]
+        
+    return results
+
+
+# Input: monitoring table of the scan (see caen.loadScan), analyzer results of one HV point (see Analyzer.getResults)
+# Output: HV, gap currents (mean and spread) and analyzer results of the HV point
+def loadHVPoint(CAEN, HVPoint, cfg, analyzerResults):
+
+    point = caen.gapValues(CAEN, HVPoint, cfg)
+    point.update(analyzerResults)
+    return point
+
+
+# Write the HV, currents and analyzer results of all the HV points in one single file (HVPoints.json)
+def writeHVPoints(points, outputdir):
+
+    with open("%s/HVPoints.json" % outputdir, 'w') as fp: json.dump(dict(("HV%d" % HVPoint, points[HVPoint]) for HVPoint in points), fp, indent=4, sort_keys=True)
+
+
+# Write the tables of one kind (eventSummary) of all the HV points in one single file (<kind>.npz), one array per HV point
+# and column, e.g. np.load("eventSummary.npz")["HV3_CMP"] (see Analyzer.eventSummary)
+def writeTables(tables, outputdir, kind):
+
+    np.savez_compressed("%s/%s.npz" % (outputdir, kind), **dict(("HV%d_%s" % (HVPoint, column), tables[HVPoint][column]) for HVPoint in tables for column in tables[HVPoint]))
+
+
+# Plot the currents, efficiency, CLS and CMP versus HV of all the HV points analyzed so far, fit the efficiency curve
+# Input: dict of the loaded HV points (see loadHVPoint), typical voltage range
+def summarizeScan(points, outputdir, xMin, xMax, formats = "both"):
+
     HVeff = [] # storage of HV eff points
     out = {}
     
@@ -92,55 +215,15 @@ if __name__ == "__main__":
     
     iMonMax = -999
     
-    # get the scan ID from the ROOT file
-    files = glob.glob("%s/*CAEN.root" % dir)
-    if len(files) == 0: sys.exit("No ROOT files in directory") 
-    scanid = int(re.findall(r'\d+', files[0])[0])
-    
-    # get all ROOT files in the dir
-    files.sort(key=natural_keys) # sort on file name, i.e. according to HV points
-    for i,CAENFile in enumerate(files):
-        
-        HVPoint = int(os.path.basename(CAENFile).split("_")[1][2:])
-        print "Analyze HV point %d " % HVPoint
-        
-        
-        saveDir = outputdir + "HV%d/" % HVPoint
-        if not os.path.exists(saveDir): os.makedirs(saveDir)
-
-        
-        analyzer = an.Analyzer(dir, saveDir, scanid, HVPoint, "efficiency")
-        analyzer.loadConfig(cfg)
-        analyzer.setVerbose(1)
-        analyzer.timeProfile(267, 9) # args: peakMean (ns), peakWidth (ns); NO FIT
-        #analyzer.timeProfile() # w/o arguments the peakMean/peakWidth are determined by Gaussian fit
-        analyzer.timeStripProfile2D()
-        analyzer.stripProfile()
-        analyzer.clusterization(10, 4, 16) # args: nominal/up/down clusterization time constraint (ns)
-        analyzer.efficiency()
-        #analyzer.eventDisplay(10) # args: amount of events to be plotted (randomly). -1: all events
-        analyzer.write() # write all results to JSON file
-        
-        
+    for i,HVPoint in enumerate(sorted(points)):
         
-        # load CAEN for HV and currents
-        CAEN = ROOT.TFile(CAENFile)
-        current_TOP = CAEN.Get("Imon_%s" % cfg['topGapName']).GetMean()
-        current_BOT = CAEN.Get("Imon_%s" % cfg['botGapName']).GetMean()
-        HV = CAEN.Get("HVeff_%s" % cfg['topGapName']).GetMean()
-        if HV < 20: HV = CAEN.Get("HVeff_%s" % cfg['botGapName']).GetMean()
+        HV, current_TOP, current_BOT = points[HVPoint]["HV"], points[HVPoint]["current_TOP"], points[HVPoint]["current_BOT"]
+        analyzerResults = points[HVPoint]["output_parameters"]
         HVeff.append(HV)
         
         if HV > xMax: xMax = HV
         if HV < xMin: xMin = HV
         
-        CAEN.Close()
-
-        
-        # load analyzer results
-        with open("%s/output.json" % (saveDir)) as f_in: analyzerResults = json.load(f_in)
-        analyzerResults = analyzerResults['output_parameters']
-        
 
         if current_BOT > iMonMax: iMonMax = current_BOT
         if current_TOP > iMonMax: iMonMax = current_TOP
@@ -230,8 +313,7 @@ if __name__ == "__main__":
     out["effMax"] = fitted.GetParameter(0)
     
     drawAux(c)
-    c.SaveAs("%s/muonEfficiency.png" % outputdir)
-    c.SaveAs("%s/muonEfficiency.pdf" % outputdir)
+    render.save(c, "%s/muonEfficiency" % outputdir, formats)
     
     
 
@@ -272,8 +354,7 @@ if __name__ == "__main__":
     out["effMax_raw"] = fitted.GetParameter(0)
     
     drawAux(c)
-    c.SaveAs("%s/rawEfficiency.png" % outputdir)
-    c.SaveAs("%s/rawEfficiency.pdf" % outputdir)
+    render.save(c, "%s/rawEfficiency" % outputdir, formats)
        
     
     ############################
@@ -297,8 +378,7 @@ if __name__ == "__main__":
     out["iMonBot"] = g_iMon_BOT.Eval(WP)
     out["iMonTot"] = (g_iMon_BOT.Eval(WP)+g_iMon_TOP.Eval(WP))
     drawAux(c)
-    c.SaveAs("%s/gapCurrents.png" % outputdir)
-    c.SaveAs("%s/gapCurrents.pdf" % outputdir)
+    render.save(c, "%s/gapCurrents" % outputdir, formats)
     
 
     
@@ -313,8 +393,7 @@ if __name__ == "__main__":
     out["muonCLS"] = g_muon_cls.Eval(WP)
     out["muonCLS_err"] = g_muon_cls_err.Eval(WP)
     drawAux(c)
-    c.SaveAs("%s/muonCLS.png" % outputdir)
-    c.SaveAs("%s/muonCLS.pdf" % outputdir)
+    render.save(c, "%s/muonCLS" % outputdir, formats)
     
     
     
@@ -328,8 +407,7 @@ if __name__ == "__main__":
     out["muonCMP"] = g_muon_cmp.Eval(WP)
     out["muonCMP_err"] = g_muon_cmp_err.Eval(WP)
     drawAux(c)
-    c.SaveAs("%s/muonCMP.png" % outputdir)
-    c.SaveAs("%s/muonCMP.pdf" % outputdir)
+    render.save(c, "%s/muonCMP" % outputdir, formats)
 
       
       
@@ -337,5 +415,139 @@ if __name__ == "__main__":
       
     # write results to file
     with open("%s/results.json" % outputdir, 'w') as fp: json.dump(out, fp, indent=4)
+
+
+if __name__ == "__main__":
+
+    ## tag: all the plots and results will be saved in a directory with its tagname
+    tag = "INFN_efficiency"
+    
+    ## config: specify the configuration containing the mapping and strip dimensions (see config.py)
+    ## several chambers (or readout regions) read out by the same TDCs: {name: config}, e.g. {"HIGH": config.cfg_GRAPHITE_HIGH, ...};
+    ## the DAQ file of each HV point is then read once for all the chambers, each chamber has its own results in tag/name/
+    cfg = config.cfg_GRAPHITE_HIGH
+    
+    ## dir: ROOT directory of all raw data files 
+    dir = "."
+    
+    ## xMin, xMax: typical voltage range for the analysis 
+    xMin, xMax = 6000, 8000
+    
+    ## nJobs: number of HV points analyzed in parallel (1: sequential analysis), e.g. multiprocessing.cpu_count(); each
+    ## process holds the decoded DAQ file and hits of its HV point, i.e. the peak memory grows with nJobs
+    nJobs = 1
+    
+    ## nJobsPerHVPoint: number of processes sharing the events of one HV point, for HV points with many triggers (only with nJobs = 1)
+    nJobsPerHVPoint = 1
+    
+    ## computeOnly: only compute the results of the HV points (HVPoints.json), no plots per HV point
+    computeOnly = False
+    
+    ## formats: output formats of the plots, "png", "pdf", "both" or "none" (no plots at all, e.g. for batch reprocessing)
+    formats = "both"
+    
+    ## renderJobs: number of processes drawing the plots of an HV point while its analysis continues (only with nJobs = 1)
+    renderJobs = 0
+    
+    ## eventSummary: write the per-event summary tables of all the HV points to eventSummary.npz (see Analyzer.eventSummary),
+    ## e.g. for further selections without reading the DAQ files again; the tables of the scan are kept in memory
+    eventSummary = False
+    
+    ## muonPeak: muon time window of all the HV points. "scan": peak mean/width estimated once from the time profiles of all
+    ## the HV points added up (see an.muonPeak); "fit": Gaussian fit per HV point; (peakMean, peakWidth): fixed values (ns)
+    muonPeak = "scan"
+    
+    ## watch: analyze a running scan, each HV point as soon as it is finished (see scanlog.py); the scan plots, the
+    ## sigmoid fit and HVPoints.json are updated after each HV point (the fit from 3 HV points on). pollInterval, watchTimeout: in seconds
+    watch = False
+    pollInterval, watchTimeout = 30, 3600
+    
+
+    
+    ##############################################################################################
+    outputdir = "%s/%s/" % (dir, tag)
+    #if os.path.exists(outputdir): shutil.rmtree(outputdir) # delete output dir, if exists
+    if not os.path.exists(outputdir):os.makedirs(outputdir) # make output dir
+    
+    chambers = {"": cfg} if "TDC_channels" in cfg else cfg # {name: config}, name "": single chamber
+    for name in chambers:
+        if not os.path.exists(chamberDir(outputdir, name)): os.makedirs(chamberDir(outputdir, name))
+    
+    points = dict((name, {}) for name in chambers) # loaded HV points of each chamber (HV, currents and analyzer results)
+    tables = dict((name, {}) for name in chambers) # tables of the HV points of each chamber {kind: {HVPoint: table}} (see writeTables)
+    timeProfiles = None # time profiles summed over the HV points analyzed so far (muonPeak = "scan")
+    peak = dict((name, {"fit": (-1, -1)}.get(muonPeak, muonPeak)) for name in chambers)
+    
+    if watch:
+    
+        # analyze the new HV points only, the earlier HV points are kept (i.e. analyzed with the muon peak estimated so far)
+        # muonPeak = "scan": the HV points wait until the muon peak of the HV points so far is significant (see an.muonPeak);
+        # if it never is, they are analyzed with a Gaussian fit per HV point at the end of the scan
+        watched = scanlog.watchScan(dir, pollInterval, watchTimeout)
+        pending = [] # HV points waiting for a significant muon peak
+        while True:
+        
+            HVPoints = next(watched, None)
+            if HVPoints is None and len(pending) == 0: break
+            scanid = scanlog.parseLog("%s/log.txt" % dir)[0]
+            if muonPeak == "scan" and HVPoints is not None and not scanCacheAvailable(dir, scanid, HVPoints):
+            
+                print "Warning: the DAQ files cannot be cached (read-only directory?), the muon peak is fitted per HV point (muonPeak = \"fit\") instead of reading each DAQ file twice"
+                muonPeak, peak = "fit", dict((name, (-1, -1)) for name in chambers)
+                HVPoints, pending = pending + HVPoints, []
+                
+            if HVPoints is None: HVPoints, pending = pending, [] # end of the scan, peak = (-1, -1)
+            elif muonPeak == "scan":
+            
+                peak, timeProfiles = scanMuonPeak(dir, outputdir, scanid, HVPoints, chambers, nJobs, nJobsPerHVPoint, timeProfiles)
+                HVPoints, pending = pending + HVPoints, []
+                if any(peak[name][0] == -1 for name in chambers):
+                
+                    print "HV points %s analyzed as soon as the muon peak is significant" % ", ".join("HV%d" % HVPoint for HVPoint in HVPoints)
+                    HVPoints, pending = [], HVPoints
+                    continue
+                    
+            results = analyzeHVPoints(dir, outputdir, scanid, HVPoints, chambers, computeOnly, nJobs, nJobsPerHVPoint, peak, formats, renderJobs, eventSummary)
+            CAEN = caen.loadScan(dir, scanid, HVPoints, nJobs) # HV and currents of all the HV points, read at once
+            for name in chambers:
+            
+                for HVPoint, (analyzerResults, HVTables) in zip(HVPoints, results):
+                
+                    points[name][HVPoint] = loadHVPoint(CAEN, HVPoint, chambers[name], analyzerResults[name])
+                    for kind in HVTables[name]: tables[name].setdefault(kind, {})[HVPoint] = HVTables[name][kind]
+                    
+                writeHVPoints(points[name], chamberDir(outputdir, name))
+                for kind in tables[name]: writeTables(tables[name][kind], chamberDir(outputdir, name), kind)
+                if len(points[name]) >= 3: summarizeScan(points[name], chamberDir(outputdir, name), xMin, xMax, formats)
+            
+    else:
+    
+        # get the scan ID from the ROOT file
+        files = glob.glob("%s/*CAEN.root" % dir)
+        if len(files) == 0: sys.exit("No ROOT files in directory") 
+        scanid = int(re.findall(r'\d+', files[0])[0])
+        
+        # get all ROOT files in the dir
+        files.sort(key=natural_keys) # sort on file name, i.e. according to HV points
+        
+        # analyze all HV points, in parallel if nJobs > 1 (the results are collected in HV order)
+        HVPoints = [int(os.path.basename(CAENFile).split("_")[1][2:]) for CAENFile in files]
+        if muonPeak == "scan" and not scanCacheAvailable(dir, scanid, HVPoints):
+        
+            print "Warning: the DAQ files cannot be cached (read-only directory?), the muon peak is fitted per HV point (muonPeak = \"fit\") instead of reading each DAQ file twice"
+            muonPeak, peak = "fit", dict((name, (-1, -1)) for name in chambers)
+            
+        if muonPeak == "scan": peak, timeProfiles = scanMuonPeak(dir, outputdir, scanid, HVPoints, chambers, nJobs, nJobsPerHVPoint)
+        results = analyzeHVPoints(dir, outputdir, scanid, HVPoints, chambers, computeOnly, nJobs, nJobsPerHVPoint, peak, formats, renderJobs, eventSummary)
+        CAEN = caen.loadScan(dir, scanid, HVPoints, nJobs) # HV and currents of all the HV points, read at once
+        for name in chambers:
+        
+            for HVPoint, (analyzerResults, HVTables) in zip(HVPoints, results):
+            
+                points[name][HVPoint] = loadHVPoint(CAEN, HVPoint, chambers[name], analyzerResults[name])
+                for kind in HVTables[name]: tables[name].setdefault(kind, {})[HVPoint] = HVTables[name][kind]
+                
+            writeHVPoints(points[name], chamberDir(outputdir, name))
+            for kind in tables[name]: writeTables(tables[name][kind], chamberDir(outputdir, name), kind)
+            summarizeScan(points[name], chamberDir(outputdir, name), xMin, xMax, formats)
     
-    
\ No newline at end of file
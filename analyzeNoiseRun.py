@@ -1,7 +1,11 @@
 
-import sys, os, glob, shutil, json, math, re, random
+import sys, os, glob, shutil, json, math, re, random, multiprocessing
 import ROOT
+import numpy as np
 import analyzer as an
+import render
+import scanlog
+import caen
 import config 
 
 ROOT.gROOT.SetBatch()
@@ -45,28 +49,92 @@ def setGraphStyle(g, xlabel, ylabel):
     return g
 
 
-if __name__ == "__main__":
+# Output: output directory of a chamber (see cfg: the output directory itself for a single chamber)
+def chamberDir(outputdir, name):
 
-    ## tag: all the plots and results will be saved in a directory with its tagname
-    tag = "INFN_noise"
-    
-    ## config: specify the configuration containing the mapping and strip dimensions (see config.py)
-    cfg = config.cfg_GRAPHITE_HIGH
+    return outputdir + name + "/" if name != "" else outputdir
     
-    ## dir: ROOT directory of all raw data files 
-    dir = "."
-    
-    ## xMin, xMax: typical voltage range for the analysis 
-    xMin, xMax = 6000, 8000
     
+# Analyze one single HV point of all the chambers (executed in a worker process when nJobs > 1)
+# Output: the analyzer results of each chamber, tables of each chamber written once per scan {kind: table} (see writeTables)
+def analyzeHVPoint(args):
 
+    dir, outputdir, scanid, HVPoint, chambers, computeOnly, memoryBudget, nJobsPerHVPoint, formats, renderJobs, eventSummary, noiseMap = args
+    print "Analyze HV point %d " % HVPoint
     
-    ##############################################################################################
-    outputdir = "%s/%s/" % (dir, tag)
-    #if os.path.exists(outputdir): shutil.rmtree(outputdir) # delete output dir, if exists
-    if not os.path.exists(outputdir):os.makedirs(outputdir) # make output dir
+    results, tables, data = {}, {}, None
+    for name in sorted(chambers):
     
+        saveDir = chamberDir(outputdir, name) + "HV%d/" % HVPoint
+        if not os.path.exists(saveDir): os.makedirs(saveDir)
+
+        analyzer = an.Analyzer(dir, saveDir, scanid, HVPoint, "noise", memoryBudget = memoryBudget, nJobs = nJobsPerHVPoint, data = data)
+        analyzer.loadConfig(chambers[name])
+        analyzer.setVerbose(1)    
+        analyzer.setComputeOnly(computeOnly)
+        analyzer.setFormats(formats)
+        analyzer.setRenderJobs(renderJobs)
+        analyzer.request("timeStripProfile2D")
+        analyzer.request("timeProfile")
+        analyzer.request("stripProfile")
+        if eventSummary and memoryBudget <= 0: analyzer.request("eventSummary") # per-event summary table (args: clusterization time constraint (ns)), see Analyzer.eventSummary
+        if noiseMap: analyzer.request("noiseMap", 100, 1000) # noise rate per strip vs. time and event number (args: time bin (ns), events per block)
+        analyzer.run() # perform all the requested stages (in dependency order)
+        #analyzer.eventDisplay(-1)
+        
+        analyzer.finishRender() # wait for the plots of the render queue
+        
+        results[name] = analyzer.getResults() # all the results, written once per scan (see writeHVPoints)
+        tables[name] = dict((kind, table) for kind, table in [("eventSummary", analyzer.eventTable), ("noiseMap", analyzer.noiseMapTable)] if table is not None) # written once per scan (see writeTables)
+        data = analyzer.data # the DAQ file is read once, the raw data are shared by all the chambers (not in streaming mode)
     
+    return results, tables
+
+
+# Analyze a list of HV points, in parallel if nJobs > 1
+# Input: chambers {name: config}
+# Output: the analyzer results and tables of each HV point and chamber (see analyzeHVPoint)
+def analyzeHVPoints(dir, outputdir, scanid, HVPoints, chambers, computeOnly, memoryBudget, nJobs, nJobsPerHVPoint, formats = "both", renderJobs = 0, eventSummary = False, noiseMap = False):
+
+    jobs = [(dir, outputdir, scanid, HVPoint, chambers, computeOnly, memoryBudget, nJobsPerHVPoint, formats, renderJobs, eventSummary, noiseMap) for HVPoint in HVPoints]
+    if nJobs > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(nJobs, len(jobs)))
+        results = pool.map(analyzeHVPoint, jobs)
+        pool.close()
+        pool.join()
+    else:
+        results = [analyzeHVPoint(job) for job in jobs]
+        
+    return results
+
+
+# Input: monitoring table of the scan (see caen.loadScan), analyzer results of one HV point (see Analyzer.getResults)
+# Output: HV, gap currents (mean and spread) and analyzer results of the HV point
+def loadHVPoint(CAEN, HVPoint, cfg, analyzerResults):
+
+    point = caen.gapValues(CAEN, HVPoint, cfg)
+    point.update(analyzerResults)
+    return point
+
+
+# Write the HV, currents and analyzer results of all the HV points in one single file (HVPoints.json)
+def writeHVPoints(points, outputdir):
+
+    with open("%s/HVPoints.json" % outputdir, 'w') as fp: json.dump(dict(("HV%d" % HVPoint, points[HVPoint]) for HVPoint in points), fp, indent=4, sort_keys=True)
+
+
+# Write the tables of one kind (eventSummary, noiseMap) of all the HV points in one single file (<kind>.npz), one array per
+# HV point and column, e.g. np.load("eventSummary.npz")["HV3_nHits"] (see Analyzer.eventSummary) or
+# an.noiseMapRates(np.load("noiseMap.npz"), 10, 100, "HV3_") (see Analyzer.noiseMap)
+def writeTables(tables, outputdir, kind):
+
+    np.savez_compressed("%s/%s.npz" % (outputdir, kind), **dict(("HV%d_%s" % (HVPoint, column), tables[HVPoint][column]) for HVPoint in tables for column in tables[HVPoint]))
+
+
+# Plot the currents and noise rates versus HV of all the HV points analyzed so far
+# Input: dict of the loaded HV points (see loadHVPoint), typical voltage range
+def summarizeScan(points, outputdir, xMin, xMax, formats = "both"):
+
     HVeff = [] # storage of HV eff points
     out = {}
     
@@ -77,51 +145,16 @@ if __name__ == "__main__":
 
 
     iMonMax = -999
-
     
-    # get the scan ID from the ROOT file
-    files = glob.glob("%s/*CAEN.root" % dir)
-    if len(files) == 0: sys.exit("No ROOT files in directory") 
-    scanid = int(re.findall(r'\d+', files[0])[0])
-    
-    # get all ROOT files in the dir
-    files.sort(key=natural_keys) # sort on file name, i.e. according to HV points
-    for i,CAENFile in enumerate(files):
-        
-        HVPoint = int(os.path.basename(CAENFile).split("_")[1][2:])
-        print "Analyze HV point %d " % HVPoint
-        
-        
-        saveDir = outputdir + "HV%d/" % HVPoint
-        if not os.path.exists(saveDir): os.makedirs(saveDir)
-
-        
-        analyzer = an.Analyzer(dir, saveDir, scanid, HVPoint, "noise")
-        analyzer.loadConfig(cfg)
-        analyzer.setVerbose(1)    
-        analyzer.timeStripProfile2D()
-        analyzer.timeProfile()
-        analyzer.stripProfile()
-        #analyzer.eventDisplay(-1)
-        analyzer.write()
+    for i,HVPoint in enumerate(sorted(points)):
         
-        # load CAEN for HV and currents
-        CAEN = ROOT.TFile(CAENFile)
-        current_TOP = CAEN.Get("Imon_%s" % cfg['topGapName']).GetMean()
-        current_BOT = CAEN.Get("Imon_%s" % cfg['botGapName']).GetMean()
-        HV = CAEN.Get("HVeff_%s" % cfg['topGapName']).GetMean()
-        if HV < 20: HV = CAEN.Get("HVeff_%s" % cfg['botGapName']).GetMean()
+        HV, current_TOP, current_BOT = points[HVPoint]["HV"], points[HVPoint]["current_TOP"], points[HVPoint]["current_BOT"]
+        analyzerResults = points[HVPoint]["output_parameters"]
         HVeff.append(HV)
         
         if HV > xMax: xMax = HV
         if HV < xMin: xMin = HV
         
-        CAEN.Close()
-        
-        # load analyzer results
-        with open("%s/output.json" % (saveDir)) as f_in: analyzerResults = json.load(f_in)
-        analyzerResults = analyzerResults['output_parameters']
-        
 
         if current_BOT > iMonMax: iMonMax = current_BOT
         if current_TOP > iMonMax: iMonMax = current_TOP
@@ -163,8 +196,7 @@ if __name__ == "__main__":
     params.DrawLatex(0.16, 0.85, "#color[2]{Current bottom gap}")
 
     drawAux(c)
-    c.SaveAs("%s/gapCurrents.png" % outputdir)
-    c.SaveAs("%s/gapCurrents.pdf" % outputdir)
+    render.save(c, "%s/gapCurrents" % outputdir, formats)
 
     
 
@@ -176,9 +208,114 @@ if __name__ == "__main__":
     g_noise = setGraphStyle(g_noise, "HV_{eff} (V)", "Mean noise rate (Hz/cm^{2})")
     g_noise.Draw("ALP")
     drawAux(c)
-    c.SaveAs("%s/meanNoiseRate.png" % outputdir)
-    c.SaveAs("%s/meanNoiseRate.pdf" % outputdir) 
+    render.save(c, "%s/meanNoiseRate" % outputdir, formats)
+
+
+if __name__ == "__main__":
+
+    ## tag: all the plots and results will be saved in a directory with its tagname
+    tag = "INFN_noise"
+    
+    ## config: specify the configuration containing the mapping and strip dimensions (see config.py)
+    ## several chambers (or readout regions) read out by the same TDCs: {name: config}, e.g. {"HIGH": config.cfg_GRAPHITE_HIGH, ...};
+    ## the DAQ file of each HV point is then read once for all the chambers, each chamber has its own results in tag/name/
+    cfg = config.cfg_GRAPHITE_HIGH
+    
+    ## dir: ROOT directory of all raw data files 
+    dir = "."
+    
+    ## xMin, xMax: typical voltage range for the analysis 
+    xMin, xMax = 6000, 8000
+    
+    ## nJobs: number of HV points analyzed in parallel (1: sequential analysis), e.g. multiprocessing.cpu_count(); each
+    ## process holds the decoded DAQ file and hits of its HV point, i.e. the peak memory grows with nJobs
+    nJobs = 1
     
+    ## nJobsPerHVPoint: number of processes sharing the events of one HV point, for HV points with many triggers (only with nJobs = 1)
+    nJobsPerHVPoint = 1
     
+    ## computeOnly: only compute the results of the HV points (HVPoints.json), no plots per HV point
+    computeOnly = False
     
+    ## formats: output formats of the plots, "png", "pdf", "both" or "none" (no plots at all, e.g. for batch reprocessing)
+    formats = "both"
+    
+    ## renderJobs: number of processes drawing the plots of an HV point while its analysis continues (only with nJobs = 1)
+    renderJobs = 0
+    
+    ## memoryBudget: memory budget (MB) per HV point, the events are then processed in blocks (streaming mode); -1: all events at once
+    ## (the total memory is about nJobs x memoryBudget when several HV points are analyzed in parallel)
+    memoryBudget = -1
+    
+    ## eventSummary: write the per-event summary tables of all the HV points to eventSummary.npz (see Analyzer.eventSummary);
+    ## the tables of the scan are kept in memory, i.e. not in streaming mode (memoryBudget > 0)
+    eventSummary = False
+    
+    ## noiseMap: noise rate per strip vs. time and event number (see Analyzer.noiseMap), plots per HV point and the hit
+    ## counts of all the HV points in noiseMap.npz, to be rebinned with an.noiseMapRates; the hit counts (one entry per
+    ## event and fired strip) of the scan are kept in memory
+    noiseMap = False
+    
+    ## watch: analyze a running scan, each HV point as soon as it is finished (see scanlog.py); the scan plots
+    ## and HVPoints.json are updated after each HV point. pollInterval, watchTimeout: in seconds
+    watch = False
+    pollInterval, watchTimeout = 30, 3600
+    
+
+    
+    ##############################################################################################
+    outputdir = "%s/%s/" % (dir, tag)
+    #if os.path.exists(outputdir): shutil.rmtree(outputdir) # delete output dir, if exists
+    if not os.path.exists(outputdir):os.makedirs(outputdir) # make output dir
+    
+    chambers = {"": cfg} if "TDC_channels" in cfg else cfg # {name: config}, name "": single chamber
+    for name in chambers:
+        if not os.path.exists(chamberDir(outputdir, name)): os.makedirs(chamberDir(outputdir, name))
+    
+    points = dict((name, {}) for name in chambers) # loaded HV points of each chamber (HV, currents and analyzer results)
+    tables = dict((name, {}) for name in chambers) # tables of the HV points of each chamber {kind: {HVPoint: table}} (see writeTables)
+    
+    if watch:
+    
+        # analyze the new HV points only, the earlier HV points are kept
+        for HVPoints in scanlog.watchScan(dir, pollInterval, watchTimeout):
+        
+            scanid = scanlog.parseLog("%s/log.txt" % dir)[0]
+            results = analyzeHVPoints(dir, outputdir, scanid, HVPoints, chambers, computeOnly, memoryBudget, nJobs, nJobsPerHVPoint, formats, renderJobs, eventSummary, noiseMap)
+            CAEN = caen.loadScan(dir, scanid, HVPoints, nJobs) # HV and currents of all the HV points, read at once
+            for name in chambers:
+            
+                for HVPoint, (analyzerResults, HVTables) in zip(HVPoints, results):
+                
+                    points[name][HVPoint] = loadHVPoint(CAEN, HVPoint, chambers[name], analyzerResults[name])
+                    for kind in HVTables[name]: tables[name].setdefault(kind, {})[HVPoint] = HVTables[name][kind]
+                    
+                writeHVPoints(points[name], chamberDir(outputdir, name))
+                for kind in tables[name]: writeTables(tables[name][kind], chamberDir(outputdir, name), kind)
+                summarizeScan(points[name], chamberDir(outputdir, name), xMin, xMax, formats)
+            
+    else:
+    
+        # get the scan ID from the ROOT file
+        files = glob.glob("%s/*CAEN.root" % dir)
+        if len(files) == 0: sys.exit("No ROOT files in directory") 
+        scanid = int(re.findall(r'\d+', files[0])[0])
+        
+        # get all ROOT files in the dir
+        files.sort(key=natural_keys) # sort on file name, i.e. according to HV points
+        
+        # analyze all HV points, in parallel if nJobs > 1 (the results are collected in HV order)
+        HVPoints = [int(os.path.basename(CAENFile).split("_")[1][2:]) for CAENFile in files]
+        results = analyzeHVPoints(dir, outputdir, scanid, HVPoints, chambers, computeOnly, memoryBudget, nJobs, nJobsPerHVPoint, formats, renderJobs, eventSummary, noiseMap)
+        CAEN = caen.loadScan(dir, scanid, HVPoints, nJobs) # HV and currents of all the HV points, read at once
+        for name in chambers:
+        
+            for HVPoint, (analyzerResults, HVTables) in zip(HVPoints, results):
+            
+                points[name][HVPoint] = loadHVPoint(CAEN, HVPoint, chambers[name], analyzerResults[name])
+                for kind in HVTables[name]: tables[name].setdefault(kind, {})[HVPoint] = HVTables[name][kind]
+                
+            writeHVPoints(points[name], chamberDir(outputdir, name))
+            for kind in tables[name]: writeTables(tables[name][kind], chamberDir(outputdir, name), kind)
+            summarizeScan(points[name], chamberDir(outputdir, name), xMin, xMax, formats)
     
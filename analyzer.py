@@ -1,17 +1,133 @@
 
-import sys, os, glob, shutil, json, math, re, random
+import sys, os, glob, shutil, json, math, re, random, functools, multiprocessing, hashlib
 import ROOT
-import networkx as nx # graph tools needed for clusterization
+import numpy as np
+import rawdata
+import clustering
+import histograms
+import render
 
-ROOT.gROOT.SetBatch()
-ROOT.gStyle.SetOptStat(0)
-ROOT.gStyle.SetOptTitle(0)
 
+# Analyzer and fill functions of the current parallel pass (see Analyzer.__accumulate), inherited by the worker processes
+parallelPass = None
+
+def accumulateRange(eventRange):
+
+    analyzer, fills = parallelPass
+    return analyzer._accumulateRange(fills, *eventRange)
+
+
+# Estimate the mean and width of the muon peak in a time profile (e.g. the time profiles of all the HV points of a scan
+# added up, see Analyzer.timeProfileHist), without fit: the flat noise background (median bin content) is subtracted and the
+# mean/RMS are computed iteratively inside +/- nSigma around the peak (RMS corrected for the truncation of the Gaussian)
+# The peak is only accepted if its significance in the window, area/sqrt(area + background), reaches minSignificance and if
+# its width is larger than the minimum width (half a bin), e.g. not for a flat noise profile or a few hits at low HV
+# Output: peak mean and width (ns), -1 if no (significant) peak is found
+def muonPeak(timeProfile, nSigma = 3.0, maxIterations = 50, minSignificance = 5.0):
+
+    x = timeProfile.centers()
+    background = np.median(timeProfile.counts[1:-1])
+    signal = timeProfile.counts[1:-1] - background
+    if signal.max() <= 0: return -1, -1
+    
+    # start values: maximum and full width at half maximum of the peak
+    peak = int(np.argmax(signal))
+    below = np.nonzero(signal <= 0.5*signal[peak])[0]
+    left = below[below < peak].max()+1 if (below < peak).any() else 0
+    right = below[below > peak].min()-1 if (below > peak).any() else len(x)-1
+    binWidth = x[1]-x[0] if len(x) > 1 else 1.0
+    mean, sigma = x[peak], max((right-left+1)*binWidth/2.355, binWidth)
+    
+    truncation = math.sqrt(1.0 - 2.0*nSigma*math.exp(-0.5*nSigma**2)/math.sqrt(2.0*math.pi)/math.erf(nSigma/math.sqrt(2.0)))
+    for i in range(maxIterations):
+    
+        sel = np.abs(x - mean) <= nSigma*sigma
+        w = signal[sel]
+        if w.sum() <= 0: break
+        
+        newMean = (w*x[sel]).sum() / w.sum()
+        newSigma = math.sqrt(max((w*(x[sel]-newMean)**2).sum() / w.sum(), 0.0)) / truncation
+        converged = abs(newMean-mean) < 1e-3*binWidth and abs(newSigma-sigma) < 1e-3*binWidth
+        mean, sigma = newMean, max(newSigma, 0.5*binWidth)
+        if converged: break
+        
+    sel = np.abs(x - mean) <= nSigma*sigma
+    area = signal[sel].sum()
+    if sigma <= 0.5*binWidth or area < minSignificance*math.sqrt(max(area + background*sel.sum(), 1.0)): return -1, -1
+    return mean, sigma
+    
+    
+# Rebin the noise maps (see Analyzer.noiseMap), e.g. the table written to noiseMap.npz, without reading the DAQ file again
+# Input: noise map table, time bin width (ns, in steps of 1 ns), number of consecutive events per block, prefix of the
+# table entries (e.g. "HV3_" for the noise maps of a scan written by analyzeNoiseRun.py)
+# Output: noise rate (Hz/cm2) per strip and time bin (nStrips, nTimeBins), per event block and strip (nBlocks, nStrips)
+def noiseMapRates(noiseMap, timeBin, eventBlock, prefix = ""):
+
+    timeCounts, events, strips, hits = [noiseMap[prefix + name] for name in ["timeCounts", "events", "stripIndex", "hits"]]
+    nEvents, corrupted = int(noiseMap[prefix + "nEvents"]), noiseMap[prefix + "corrupted"]
+    stripArea, timeWindow = float(noiseMap[prefix + "stripArea"]), float(noiseMap[prefix + "timeWindow"])
+    timeBin, eventBlock = max(int(timeBin), 1), max(int(eventBlock), 1)
+    nStrips = timeCounts.shape[0]
+    
+    # sum the hits of adjacent 1 ns bins (the last time bin might be shorter)
+    starts = np.arange(0, timeCounts.shape[1], timeBin)
+    widths = np.diff(np.append(starts, timeCounts.shape[1]))
+    timeRates = np.add.reduceat(timeCounts, starts, axis=1) / (stripArea * widths * 1e-9 * max(nEvents - len(corrupted), 1))
+    
+    # sum the hits of consecutive events, normalized to the number of valid events of each block
+    nBlocks = (nEvents + eventBlock - 1) // eventBlock
+    blockCounts = np.bincount(events.astype(np.int64) // eventBlock * nStrips + strips, weights=hits, minlength=nBlocks*nStrips).reshape(nBlocks, nStrips)
+    nValid = np.minimum(nEvents - np.arange(nBlocks) * eventBlock, eventBlock) - np.bincount(corrupted // eventBlock, minlength=nBlocks)
+    blockRates = blockCounts / (stripArea * timeWindow * 1e-9 * np.maximum(nValid, 1))[:, None]
+    
+    return timeRates, blockRates
+    
+    
+
+# Lazily evaluated results of an analyzer, e.g. analyzer.results["efficiencyMuon"]
+# Asking for a result performs only the stage providing it (see Analyzer.resultStages) and its missing dependencies, with
+# the requested arguments if any (see Analyzer.request); each stage is performed once, later lookups return the stored value
+class Results():
+
+    analyzer = None
+
+
+    def __init__(self, analyzer):
+    
+        self.analyzer = analyzer
+        
+        
+    def __getitem__(self, name):
+    
+        if name not in self.analyzer.resultStages: raise KeyError(name)
+        self.analyzer.perform(self.analyzer.resultStages[name])
+        return getattr(self.analyzer, name)
+        
+        
+    def __contains__(self, name):
+    
+        return name in self.analyzer.resultStages
+        
+        
+    def keys(self):
+    
+        return sorted(self.analyzer.resultStages)
+        
+        
 
 class Analyzer():
 
-    fIn = None  # pointer to ROOT file
-    t = None    # raw data tree
+    data = None # columnar raw data (see rawdata.py), decoded once from the RAWData tree (current block of events in streaming mode)
+    hitTable = None # event number, strip index and time stamp of all the hits of the valid events (see __selectHits())
+    
+    fileName = ""
+    useCache = True
+    memoryBudget = -1 # memory budget (MB) of the streaming mode, -1: all the events are processed at once
+    nJobs = 1 # number of worker processes sharing the events of the file
+    
+    nEvents = -1            # number of events in the file
+    nValidEvents = -1       # number of events passing the quality flag validation
+    nCorruptedPerTDC = None # number of corrupted events per TDC
     
     tag = ""
     savePath = "" # path where the plots and results will be stored
@@ -40,6 +156,8 @@ class Analyzer():
     TDC_strips_mask = []
     TDC_channels = []
     TDC_channels_PMT = []
+    TDC_lookup = None       # lookup table TDC channel -> strip index (-1 if channel not connected or strip masked)
+    TDC_lookupOffset = -1   # TDC channel corresponding to the first entry of the lookup table
     
     ## list of parameters calculated by the analyzer
     muonWindowSigma = -1        # time profile width, obtained by Gaussian fit or given by user
@@ -53,6 +171,7 @@ class Analyzer():
     triggerWindow = -1          # either muonTimewindow or noiseTimeWindow (600 or 10000 ns, depending on scan type)
     
     ## results from clusterization
+    clusterTimeWindow = 10      # nominal clusterization time constraint (ns), set by clusterization
     muonCLS = -1
     muonCMP = -1
     muonCLS_err = -1
@@ -67,16 +186,73 @@ class Analyzer():
     ## results from noise calculation
     noiseRate = -1
     
+    ## per-event summary table (see eventSummary), None if not computed
+    eventTable = None
+    
+    ## hits per strip in 1 ns time bins and per event and fired strip (see noiseMap), None if not computed
+    noiseMapTable = None
+    
+    
     
+    ## results of the analysis stages (plain numbers, arrays and histograms), drawn by render()
+    products = None
+    stages = ["timeProfile", "timeStripProfile2D", "stripProfile", "noiseMap", "clusterization"] # drawing order
+    computeOnly = False # if True, the stages only compute their results (no canvas, no plots)
+    eventSheetTiles = (3, 4) # event display contact sheets: number of events per row and per column
+    formats = "both" # output formats of the plots: png, pdf, both or none (no plots, see render.outputFormats)
+    renderJobs = 0 # number of worker processes drawing the plots while the analysis continues (0: drawn immediately)
     
-    # drawing options (see function __drawAux())
-    c1 = None # default square canvas
-    c2 = None # default rectangular canvas
+    ## analysis plan (see request() and run())
+    plan = None # requested stages and their arguments, in order of request
+    performed = None # stages performed so far and their arguments (reset by loadConfig)
+    dependencies = {    # stages which must be performed before a given stage (the muon/noise windows are set by timeProfile)
+    
+        "timeProfile"           : [],
+        "timeStripProfile2D"    : [],
+        "stripProfile"          : ["timeProfile"],
+        "efficiency"            : ["timeProfile"],
+        "clusterization"        : ["timeProfile"],
+        "eventSummary"          : ["timeProfile"],
+        "noiseMap"              : ["timeProfile"],
+    }
+    
+    ## stage results cache (see __runStages())
+    # The merged partial results of each stage are cached next to the DAQ file, keyed on the file fingerprint, the stage
+    # arguments and the analyzer members used by its fill function (configuration, and the time windows set by timeProfile)
+    stageInputs = {
+    
+        "timeProfile"           : ["muonTriggerWindow", "noiseTriggerWindow"],
+        "timeStripProfile2D"    : ["muonTriggerWindow", "noiseTriggerWindow", "nStrips"],
+        "stripProfile"          : ["triggerWindow", "nStrips", "muonTimeWindowBegin", "muonTimeWindowEnd", "noiseTimeWindowBegin", "noiseTimeWindowEnd"],
+        "efficiency"            : ["muonTriggerWindow", "muonTimeWindowBegin", "muonTimeWindowEnd"],
+        "clusterization"        : ["muonTimeWindowBegin", "muonTimeWindowEnd"],
+        "eventSummary"          : ["triggerWindow", "muonTimeWindowBegin", "muonTimeWindowEnd", "noiseTimeWindowBegin", "noiseTimeWindowEnd"],
+        "noiseMap"              : ["nStrips", "noiseTimeWindowBegin", "noiseTimeWindowEnd"],
+    }
+    ## lazily evaluated results (see Results), stage providing each result
+    results = None
+    resultStages = dict([(name, "timeProfile") for name in ["muonWindowMean", "muonWindowSigma", "muonTimeWindowBegin", "muonTimeWindowEnd", "muonTimeWindow", "noiseTimeWindowBegin", "noiseTimeWindowEnd", "noiseTimeWindow"]] +
+        [(name, "clusterization") for name in ["muonCLS", "muonCMP", "muonCLS_err", "muonCMP_err"]] +
+        [(name, "efficiency") for name in ["efficiencyAbs", "efficiencyMuon", "efficiencyAbs_err", "efficiencyMuon_err"]] +
+        [("noiseRate", "stripProfile"), ("eventTable", "eventSummary"), ("noiseMapTable", "noiseMap")])
+    
+    stageKeyWithoutArgs = ["timeProfile", "noiseMap"] # stages of which the fill function does not depend on the arguments (peak mean/width, binning)
+    hitSelectionInputs = ["scanType", "timeWindowReject", "TDC_channels", "TDC_strips", "TDC_strips_mask"] # used by all the stages
+    stageCacheVersion = 3 # increase when a fill function changes, older stage results are then ignored
+    fingerprint = None # fingerprint of the DAQ file (see rawdata.fingerprint), determined at the first stage
+    
+    # drawing options (see render.drawAux())
     textCMS = "#bf{CMS} 904,#scale[0.75]{ #it{Preliminary}}" # CMS GIF++ TLatex (top left on canvas)
     textAux = None # auxiliary info (top right on canvas)
 
 
-    def __init__(self, dir, savePath, scanid, HVPoint, scanType):
+    # useCache: store/load the decoded raw data in a cache next to the DAQ file (see rawdata.loadFile)
+    # memoryBudget: if > 0, streaming mode: the events are processed in blocks such that the raw data and the intermediate
+    # arrays of the analysis fit in the given memory budget (MB), see rawdata.iterFile
+    # nJobs: number of worker processes, each analyzing a range of consecutive events of the file
+    # data: raw data of the DAQ file already read by another analyzer, e.g. of another chamber read out by the same TDCs; the
+    # hits of each chamber are selected by the channel lookup table of its configuration (see loadConfig)
+    def __init__(self, dir, savePath, scanid, HVPoint, scanType, useCache = True, memoryBudget = -1, nJobs = 1, data = None):
     
         self.scanid = scanid
         self.HVPoint = HVPoint
@@ -85,33 +261,99 @@ class Analyzer():
         
         if not os.path.exists(self.savePath): os.makedirs(self.savePath)
     
-        # get the raw data
-        self.fIn = ROOT.TFile("%s/Scan%.6d_HV%d_DAQ.root" % (dir, scanid, HVPoint))
-        self.t = self.fIn.Get("RAWData")
+        # get the raw data: decode all events once (or load them from the decoded-hit cache), all the stages run over these arrays
+        # in streaming mode, the events are read block by block by each analysis pass
+        self.fileName = "%s/Scan%.6d_HV%d_DAQ.root" % (dir, scanid, HVPoint)
+        self.useCache = useCache
+        self.memoryBudget = memoryBudget
+        self.nJobs = nJobs
+        if self.memoryBudget <= 0:
+        
+            self.data = data if data is not None else rawdata.loadFile(self.fileName, useCache)
+            self.nEvents, self.nValidEvents, self.nCorruptedPerTDC = self.data.nEvents, int(self.data.valid.sum()), self.data.nCorruptedPerTDC
         
         # trigger window
         self.scanType = scanType
         
-        
-        # default square canvas
-        self.c1 = ROOT.TCanvas("c1", "c1", 800, 800)
-        self.c1.SetLeftMargin(0.12)
-        self.c1.SetRightMargin(0.05)
-        self.c1.SetTopMargin(0.05)
-        self.c1.SetBottomMargin(0.1)
-        
-        # default rectangular canvas
-        self.c2 = ROOT.TCanvas("c2", "c2", 900, 1200)
-        self.c2.SetLeftMargin(0.12)
-        self.c2.SetRightMargin(0.13)
-        self.c2.SetTopMargin(0.05)
-        self.c2.SetBottomMargin(0.1)
+        self.products = {}
+        self.plan = []
+        self.performed = {}
+        self.results = Results(self)
         
     def setVerbose(self, verbose):
     
         self.verbose = verbose
         
         
+    # computeOnly: only calculate the results (output.json), the plots can be made afterwards with render()
+    def setComputeOnly(self, computeOnly):
+    
+        self.computeOnly = computeOnly
+        
+        
+    # formats: output formats of the plots (png, pdf, both or none), e.g. none for batch reprocessing
+    def setFormats(self, formats):
+    
+        if formats not in render.outputFormats: sys.exit("Unknown output format %s" % formats)
+        self.formats = formats
+        
+        
+    # nJobs: number of worker processes of the render queue (see render.startQueue), call finishRender() at the end
+    def setRenderJobs(self, nJobs):
+    
+        self.renderJobs = nJobs
+        
+        
+    # Wait for all the plots in the render queue
+    def finishRender(self):
+    
+        render.finishQueue()
+        
+        
+    # Declare a stage to be performed by run(), with the arguments of the stage function
+    # e.g. request("timeProfile", 267, 9), request("clusterization", 10, 4, 16)
+    def request(self, stage, *args):
+    
+        if stage not in self.dependencies: sys.exit("Unknown analysis stage %s" % stage)
+        self.plan = [(s, a) for s, a in self.plan if s != stage] + [(stage, args)]
+        
+        
+    # Perform all the requested stages in dependency order (missing dependencies are added with default arguments, the
+    # dependencies performed before are not repeated)
+    # All the stages share the same hit selection, the raw data are only mapped once. The stages which do not depend on
+    # each other are filled together, i.e. in streaming mode the events are read once per dependency level
+    def run(self):
+    
+        args = dict(self.plan)
+        order = []
+        def schedule(stage):
+            if stage in order: return
+            for dep in self.dependencies[stage]:
+                if dep not in self.performed or dep in args: schedule(dep)
+            order.append(stage)
+        for stage, a in self.plan: schedule(stage)
+        
+        level = {}
+        for stage in order: level[stage] = max([level[dep]+1 for dep in self.dependencies[stage] if dep in level] + [0])
+        for l in sorted(set(level.values())): self.__runStages([(stage, args.get(stage, ())) for stage in order if level[stage] == l])
+        self.plan = []
+        
+        
+    # Perform one stage if not yet performed, with the requested arguments if any (see request), e.g. for a lazy result
+    def perform(self, stage):
+    
+        if stage in self.performed: return
+        self.__runStages([(stage, self.__requestedArgs(stage))])
+        
+        
+    # Output: requested arguments of a stage (default arguments if not requested), the stage is removed from the plan
+    def __requestedArgs(self, stage):
+    
+        args = dict(self.plan).get(stage, ())
+        self.plan = [(s, a) for s, a in self.plan if s != stage]
+        return args
+        
+        
     def loadConfig(self, cfg):
     
         self.muonTriggerWindow = cfg["muonTriggerWindow"]
@@ -126,17 +368,31 @@ class Analyzer():
         self.TDC_strips_mask = cfg["TDC_strips_mask"]
         self.TDC_channels = cfg["TDC_channels"]
         
+        # build the dense channel lookup table, indexed by TDC channel number
+        self.TDC_lookupOffset = min(self.TDC_channels)
+        self.TDC_lookup = np.full(max(self.TDC_channels) - self.TDC_lookupOffset + 1, -1, dtype=np.int32)
+        for i,ch in enumerate(self.TDC_channels):
+            if self.TDC_strips[i] in self.TDC_strips_mask: continue
+            self.TDC_lookup[ch - self.TDC_lookupOffset] = i
+        
         if self.scanType == "efficiency": self.triggerWindow = self.muonTriggerWindow
         if self.scanType == "noise": self.triggerWindow = self.noiseTriggerWindow
+        
+        self.hitTable = None # the channel mapping (masks) might have changed
+        self.performed = {} # results of an earlier configuration
 
         
 
+    ## Analysis stages
+    # Each stage consists of a fill function, returning the partial results (histograms, counters) of the current block of
+    # events, and a finish function, calculating the final results out of the partial results merged over all the blocks
+
     def timeStripProfile2D(self):
     
-        #ROOT.gStyle.SetPalette(ROOT.kDarkRainBow)
-
-        self.c2.cd()
-        self.c2.Clear() 
+        return self.__runStages([("timeStripProfile2D", ())])[0]
+        
+        
+    def _fillTimeStripProfile2D(self):
 
         if self.scanType == "noise":
             
@@ -152,77 +408,75 @@ class Analyzer():
          
         width = timeEnd - timeStart
         
-        # make 2D histogram (x-axis time, y-axis strips)
-        timeStripProfile = ROOT.TH2D("timeStripProfile", "Time-strip profile", width, int(timeStart/scale), int(timeEnd/scale), self.nStrips, min(self.TDC_strips), max(self.TDC_strips)+1)
+        # make 2D histogram (x-axis time, y-axis strips), sparse for noise runs (1 ns bins over the 10 us trigger window)
+        timeStripProfile = histograms.Hist2D(width, int(timeStart/scale), int(timeEnd/scale), self.nStrips, min(self.TDC_strips), max(self.TDC_strips)+1, sparse = (self.scanType == "noise"))
         
-        for evNum in range(0, self.t.GetEntries()+1):
+        events, firedStrips, timeStamps = self.__selectHits(timeStart, timeEnd)
+        timeStripProfile.fill(timeStamps/scale, self.__stripNumbers(firedStrips))
         
-            self.t.GetEntry(evNum)
-            if not self.validateEvent(): continue
-                        
-            firedStrips, timeStamps = self.__groupAndOrder(self.t.TDC_channel, self.t.TDC_TimeStamp, timeStart, timeEnd)
-            for i,ch in enumerate(firedStrips): timeStripProfile.Fill(timeStamps[i]/scale, self.TDC_strips[ch])
+        return timeStripProfile
         
-        # loop over all strips: set the y-axis label and set all bin contents to zero          
-        for i in range(1, self.nStrips+1):
         
-            #print "Parse strip %d with TDC channel %d" % (i, cfg.TDC_strips[i-1])
-            timeStripProfile.GetYaxis().SetBinLabel(i, str(self.TDC_strips[i-1]))
-            #for j in range(0, self.triggerWindow): timeStripProfile.SetBinContent(j, i, 0.0)
-            
-
-
-        timeStripProfile.GetXaxis().SetRangeUser(int(timeStart/scale), int(timeEnd/scale))
-        if scale == 1000.: timeStripProfile.GetXaxis().SetTitle("Time (#mus)")
-        else: timeStripProfile.GetXaxis().SetTitle("Time (ns)")
-        timeStripProfile.GetXaxis().SetTitleOffset(1.0)
-        timeStripProfile.GetXaxis().SetLabelOffset(0.0)
-
-        timeStripProfile.GetYaxis().SetTitle("Strip number")   
-        timeStripProfile.GetYaxis().SetTitleOffset(1.3)
-        timeStripProfile.GetYaxis().SetLabelOffset(0.005)
-        
-        timeStripProfile.Draw("COLZ")
-        
-        self.__drawAux(self.c2)
-        self.c2.RedrawAxis()
-        self.c2.Modify()    
-        if self.verbose > 0:
-            self.c2.SaveAs("%stimeStripProfile2D.png" % self.savePath) 
-            self.c2.SaveAs("%stimeStripProfile2D.pdf" % self.savePath) 
+    def _finishTimeStripProfile2D(self, timeStripProfile):
+    
+        scale = 1000. if self.scanType == "noise" else 1.
+        self.__store("timeStripProfile2D", {"hist": timeStripProfile, "scale": scale, "strips": self.TDC_strips})
 
 
     def timeProfile(self, peakMean = -1, peakWidth = -1):
-
-
-        # in case of efficiency scan, determine the time windows after doing the Gaussian fit in the beam peak
+    
+        return self.__runStages([("timeProfile", (peakMean, peakWidth))])[0]
+        
+        
+    # Output: time profile (histogram of the hit times, as drawn by timeProfile), without fit nor time windows
+    # e.g. to estimate the muon peak once for a complete scan (see muonPeak())
+    def timeProfileHist(self):
+    
+        return self.__fillStages([("timeProfile", ())])[0]
+        
+        
+    def _fillTimeProfile(self, peakMean = -1, peakWidth = -1):
+    
         if self.scanType == "efficiency":
-
-            timeProfile = ROOT.TH1D("timeProfile", "Time profile", self.muonTriggerWindow-self.timeWindowReject, self.timeWindowReject, self.muonTriggerWindow)
-            for evNum in range(0, self.t.GetEntries()+1):
         
-                self.t.GetEntry(evNum)
-                if not self.validateEvent(): continue
-                
-  
-                firedStrips, timeStamps = self.__groupAndOrder(self.t.TDC_channel, self.t.TDC_TimeStamp, self.timeWindowReject, self.muonTriggerWindow)
-                for i,ch in enumerate(firedStrips): timeProfile.Fill(timeStamps[i])
+            timeProfile = histograms.Hist1D(self.muonTriggerWindow-self.timeWindowReject, self.timeWindowReject, self.muonTriggerWindow)
+            events, firedStrips, timeStamps = self.__selectHits(self.timeWindowReject, self.muonTriggerWindow)
+            timeProfile.fill(timeStamps)
+            
+        else:
+        
+            # noise window: start at rejection time
+            scale = 1000.
+            timeStart = self.timeWindowReject
+            timeEnd = self.noiseTriggerWindow
+        
+            timeProfile = histograms.Hist1D(timeEnd - timeStart, int(timeStart/scale), int(timeEnd/scale))
+            events, firedStrips, timeStamps = self.__selectHits(timeStart, timeEnd)
+            timeProfile.fill(timeStamps/scale)
+            
+        return timeProfile
+        
 
+    def _finishTimeProfile(self, timeProfile, peakMean = -1, peakWidth = -1):
 
+
+        # in case of efficiency scan, determine the time windows after doing the Gaussian fit in the beam peak
+        if self.scanType == "efficiency":
             
+            fitParams = None
             if peakWidth == -1 and peakMean == -1:
         
-                # fit the peak with a Gaussian
+                # fit the peak with a Gaussian (the function is not drawn, see render.drawTimeProfile)
+                h = timeProfile.toTH1D("timeProfileFit", "Time profile")
                 peakFit = ROOT.TF1("peakFit", "gaus", self.timeWindowReject, self.muonTriggerWindow)
-                peakFit.SetParameters(timeProfile.GetMaximum(), timeProfile.GetMean(), timeProfile.GetRMS())
-                timeProfile.Fit("peakFit", "R")
-                
-                      
+                peakFit.SetParameters(h.GetMaximum(), h.GetMean(), h.GetRMS())
+                h.Fit("peakFit", "R0")
                 
                 # get fit parameters
-                offset_ = peakFit.GetParameter(0)
-                self.muonWindowMean = peakFit.GetParameter(1)
-                self.muonWindowSigma = peakFit.GetParameter(2)
+                fitParams = [peakFit.GetParameter(0), peakFit.GetParameter(1), peakFit.GetParameter(2)]
+                self.muonWindowMean = fitParams[1]
+                self.muonWindowSigma = fitParams[2]
+                h.Delete()
                 
             else:
             
@@ -241,81 +495,13 @@ class Analyzer():
             if self.muonTimeWindowBegin < 0: self.muonTimeWindowBegin = 0
             if self.muonTimeWindowEnd > self.muonTriggerWindow: self.muonTimeWindowEnd = self.muonTriggerWindow
             
-
-            # draw raw profile and fit
-            self.c1.cd()
-            self.c1.Clear()     
-
-            leg = ROOT.TLegend(.65, 0.75, .95, .93)
-            leg.SetBorderSize(0)
-            leg.SetTextSize(0.03)
-            leg.SetFillStyle(0)
-            
-            timeProfile.Draw("HIST")
-            timeProfile.GetYaxis().SetRangeUser(0, 1.3*timeProfile.GetMaximum())
-            timeProfile.SetLineColor(ROOT.kBlack)
-
-            if peakWidth == -1 and peakMean == -1:
-            
-                peakFitDraw = peakFit.Clone("tmp1")
-                peakFitDraw.Draw("L SAME")
-                peakFitDraw.SetLineColor(ROOT.kRed)
-                peakFitDraw.GetXaxis().SetRangeUser(self.muonTimeWindowBegin, self.muonTimeWindowEnd)
-                peakFitDraw.SetLineWidth(2)  
-
-            muonTimeWindowArea = ROOT.TGraph(4)
-            muonTimeWindowArea.SetPoint(0, self.muonTimeWindowBegin, 0)
-            muonTimeWindowArea.SetPoint(1, self.muonTimeWindowEnd, 0)
-            muonTimeWindowArea.SetPoint(2, self.muonTimeWindowEnd, 0.3*timeProfile.GetMaximum())
-            muonTimeWindowArea.SetPoint(3, self.muonTimeWindowBegin, 0.3*timeProfile.GetMaximum())
-            muonTimeWindowArea.SetFillStyle(3354)
-            muonTimeWindowArea.SetFillColor(ROOT.kRed)
-            muonTimeWindowArea.SetLineColor(ROOT.kRed)
-            muonTimeWindowArea.SetFillColorAlpha(ROOT.kRed, 0.5)
-            muonTimeWindowArea.Draw("F SAME")        
-            
-            noiseTimeWindowArea = ROOT.TGraph(4)
-            noiseTimeWindowArea.SetPoint(0, self.noiseTimeWindowBegin, 0)
-            noiseTimeWindowArea.SetPoint(1, self.noiseTimeWindowEnd, 0)
-            noiseTimeWindowArea.SetPoint(2, self.noiseTimeWindowEnd, 0.3*timeProfile.GetMaximum())
-            noiseTimeWindowArea.SetPoint(3, self.noiseTimeWindowBegin, 0.3*timeProfile.GetMaximum())
-            noiseTimeWindowArea.SetFillStyle(3354)
-            noiseTimeWindowArea.SetFillColor(ROOT.kBlue)
-            noiseTimeWindowArea.SetLineColor(ROOT.kBlue)
-            noiseTimeWindowArea.SetFillColorAlpha(ROOT.kBlue, 0.5)
-            noiseTimeWindowArea.Draw("F SAME") 
-            
-            timeProfile.GetXaxis().SetTitle("Time (ns)")
-            timeProfile.GetXaxis().SetTitleOffset(1.2)
-            timeProfile.GetXaxis().SetLabelOffset(0.005)
-
-            timeProfile.GetYaxis().SetTitle("Hits / ns")   
-            timeProfile.GetYaxis().SetTitleOffset(1.8)
-            timeProfile.GetYaxis().SetLabelOffset(0.005)
-            
-            fitParams = ROOT.TLatex()
-            fitParams.SetTextFont(42)
-            fitParams.SetTextSize(0.03)
-            fitParams.SetNDC()
-            fitParams.DrawLatex(0.16, 0.9, "#color[2]{Peak mean: %.2f ns}" % self.muonWindowMean)
-            fitParams.DrawLatex(0.16, 0.85, "#color[2]{Peak width (#sigma): %.2f ns}" % self.muonWindowSigma)
-            fitParams.DrawLatex(0.16, 0.8, "#color[2]{Muon window (2#times%d#sigma): %.2f ns}" % (self.muonWindowWidth, 6.0*self.muonWindowSigma))
+            self.__store("timeProfile", {
             
-            
-
-            
-            leg.AddEntry(timeProfile, "Raw data", "L")
-            leg.AddEntry(muonTimeWindowArea, "Muon window", "F")
-            leg.AddEntry(noiseTimeWindowArea, "Noise window", "F")
-            leg.Draw()
-            
-            
-            self.__drawAux(self.c1)
-            self.c1.RedrawAxis()
-            self.c1.Modify()
-            if self.verbose > 0:
-                self.c1.SaveAs("%stimeProfile.png" % self.savePath) 
-                self.c1.SaveAs("%stimeProfile.pdf" % self.savePath) 
+                "hist": timeProfile, "scale": 1., "fitParams": fitParams, "muonWindowWidth": self.muonWindowWidth,
+                "muonWindowMean": self.muonWindowMean, "muonWindowSigma": self.muonWindowSigma,
+                "muonTimeWindowBegin": self.muonTimeWindowBegin, "muonTimeWindowEnd": self.muonTimeWindowEnd,
+                "noiseTimeWindowBegin": self.noiseTimeWindowBegin, "noiseTimeWindowEnd": self.noiseTimeWindowEnd,
+            })
         
         
         else:
@@ -323,226 +509,100 @@ class Analyzer():
             self.noiseTimeWindowBegin = self.timeWindowReject # start at rejection time
             self.noiseTimeWindowEnd = self.noiseTriggerWindow
             self.noiseTimeWindow = self.noiseTimeWindowEnd - self.noiseTimeWindowBegin   
-        
-            scale = 1000.
-            timeStart = self.noiseTimeWindowBegin
-            timeEnd = self.noiseTimeWindowEnd 
-            width = self.noiseTimeWindow
-        
-            timeProfile = ROOT.TH1D("timeProfile", "Time profile", width, int(timeStart/scale), int(timeEnd/scale))
-            for evNum in range(0, self.t.GetEntries()+1):
-        
-                self.t.GetEntry(evNum)
-                if not self.validateEvent(): continue
-  
-                firedStrips, timeStamps = self.__groupAndOrder(self.t.TDC_channel, self.t.TDC_TimeStamp, timeStart, timeEnd)
-                for i,ch in enumerate(firedStrips): timeProfile.Fill(timeStamps[i]/scale)
-        
-            
-            
-
-
-            # draw raw profile
-            self.c1.cd()
-            self.c1.Clear()     
-
             
-            timeProfile.Draw("HIST")
-            timeProfile.GetYaxis().SetRangeUser(0, 1.3*timeProfile.GetMaximum())
-            timeProfile.SetLineColor(ROOT.kBlack)
-
-            if scale == 1000.: timeProfile.GetXaxis().SetTitle("Time (#mus)")
-            else: timeProfile.GetXaxis().SetTitle("Time (ns)")
-            timeProfile.GetXaxis().SetTitleOffset(1.2)
-            timeProfile.GetXaxis().SetLabelOffset(0.005)
-
-            timeProfile.GetYaxis().SetTitle("Hits")   
-            timeProfile.GetYaxis().SetTitleOffset(1.8)
-            timeProfile.GetYaxis().SetLabelOffset(0.005)
-
-            self.__drawAux(self.c1)
-            self.c1.RedrawAxis()
-            self.c1.Modify()
-            if self.verbose > 0:
-                self.c1.SaveAs("%stimeProfile.png" % self.savePath) 
-                self.c1.SaveAs("%stimeProfile.pdf" % self.savePath)             
+            self.__store("timeProfile", {"hist": timeProfile, "scale": 1000.})
 
    
     def stripProfile(self):
     
-        nValidatedEvents = 0
-        stripProfileAll = ROOT.TH1D("stripProfileAll", "Strip profile (all)", self.nStrips, min(self.TDC_strips), max(self.TDC_strips)+1)
-        stripProfileNoise = ROOT.TH1D("stripProfileNoise", "Strip profile (noise)", self.nStrips, min(self.TDC_strips), max(self.TDC_strips)+1)
-        stripProfileMuon = ROOT.TH1D("stripProfileMuon", "Strip profile (muon)", self.nStrips, min(self.TDC_strips), max(self.TDC_strips)+1)
-
-        for i in range(1, self.nStrips+1):
-        
-            stripProfileAll.GetXaxis().SetBinLabel(i, str(self.TDC_strips[i-1]))
-            stripProfileNoise.GetXaxis().SetBinLabel(i, str(self.TDC_strips[i-1]))
-            stripProfileMuon.GetXaxis().SetBinLabel(i, str(self.TDC_strips[i-1]))
-        
-  
-        # loop over all events    
-        for evNum in range(0, self.t.GetEntries()+1):
-            
-            self.t.GetEntry(evNum)
-            if not self.validateEvent(): continue
-            nValidatedEvents += 1
-            
-            # all hits
-            firedStrips, timeStamps = self.__groupAndOrder(self.t.TDC_channel, self.t.TDC_TimeStamp, self.timeWindowReject, self.triggerWindow)
-            for ch in firedStrips: stripProfileAll.Fill(self.TDC_strips[ch])   
-                
-            # probe muon time window
-            if self.scanType == "efficiency":
-                firedStrips, timeStamps = self.__groupAndOrder(self.t.TDC_channel, self.t.TDC_TimeStamp, self.muonTimeWindowBegin, self.muonTimeWindowEnd)
-                for ch in firedStrips: stripProfileMuon.Fill(self.TDC_strips[ch])
-                
-
-            # probe noise time window
-            if self.scanType == "noise":
-                firedStrips, timeStamps = self.__groupAndOrder(self.t.TDC_channel, self.t.TDC_TimeStamp, self.noiseTimeWindowBegin, self.noiseTimeWindowEnd)
-                for ch in firedStrips: stripProfileNoise.Fill(self.TDC_strips[ch])              
-
-            
-        ## all hit profile
-        self.c1.cd()
-        self.c1.Clear()
-
-        stripProfileAll.GetYaxis().SetNoExponent()
-        stripProfileAll.SetFillStyle(3354)
-        stripProfileAll.SetFillColor(ROOT.kBlue)
-        stripProfileAll.SetFillColorAlpha(ROOT.kBlue, 0.35)
-        stripProfileAll.SetLineColor(ROOT.kBlue)
-        stripProfileAll.SetLineWidth(2)
-        stripProfileAll.Draw("HIST")
-        
-        stripProfileAll.GetYaxis().SetRangeUser(0, 1.3*stripProfileAll.GetMaximum())
-        stripProfileAll.GetXaxis().SetTitle("Strip number")
-        stripProfileAll.GetXaxis().SetTitleOffset(1.2)
-        stripProfileAll.GetXaxis().SetLabelOffset(0.005)
-        stripProfileAll.GetXaxis().SetLabelSize(0.04)
-
-        stripProfileAll.GetYaxis().SetTitle("Number of hits")   
-        stripProfileAll.GetYaxis().SetTitleOffset(1.8)
-        stripProfileAll.GetYaxis().SetLabelOffset(0.005)    
+        return self.__runStages([("stripProfile", ())])[0]
         
-        tLatex = ROOT.TLatex()
-        tLatex.SetTextFont(42)
-        tLatex.SetTextSize(0.03)
-        tLatex.SetNDC()
-        tLatex.DrawLatex(0.16, 0.9, "Hit profile (all hits)")
-        
-
-        self.__drawAux(self.c1)
-        self.c1.RedrawAxis()
-        self.c1.Modify()        
-        self.c1.SaveAs("%sallHitProfile.png" % self.savePath) 
-        self.c1.SaveAs("%sallHitProfile.pdf" % self.savePath)   
-
         
+    def _fillStripProfile(self):
+    
+        stripProfileAll = histograms.Hist1D(self.nStrips, min(self.TDC_strips), max(self.TDC_strips)+1)
+        stripProfileNoise, stripProfileMuon = None, None
         
-       
+        # all hits
+        events, firedStrips, timeStamps = self.__selectHits(self.timeWindowReject, self.triggerWindow)
+        stripProfileAll.fill(self.__stripNumbers(firedStrips))
         
-        # muon hit profile
+        # probe muon time window
         if self.scanType == "efficiency":
         
-            self.c1.cd()
-            self.c1.Clear()
-
-            stripProfileMuon.GetYaxis().SetNoExponent()
-            stripProfileMuon.SetFillStyle(3354)
-            stripProfileMuon.SetFillColor(ROOT.kBlue)
-            stripProfileMuon.SetFillColorAlpha(ROOT.kBlue, 0.35)
-            stripProfileMuon.SetLineColor(ROOT.kBlue)
-            stripProfileMuon.SetLineWidth(2)
-            stripProfileMuon.Draw("HIST")
-            
-            stripProfileMuon.GetYaxis().SetRangeUser(0, 1.3*stripProfileMuon.GetMaximum())
-            stripProfileMuon.GetXaxis().SetTitle("Strip number")
-            stripProfileMuon.GetXaxis().SetTitleOffset(1.2)
-            stripProfileMuon.GetXaxis().SetLabelOffset(0.005)
-            stripProfileMuon.GetXaxis().SetLabelSize(0.04)
-
-            stripProfileMuon.GetYaxis().SetTitle("Number of hits")   
-            stripProfileMuon.GetYaxis().SetTitleOffset(1.8)
-            stripProfileMuon.GetYaxis().SetLabelOffset(0.005)    
+            stripProfileMuon = histograms.Hist1D(self.nStrips, min(self.TDC_strips), max(self.TDC_strips)+1)
+            events, firedStrips, timeStamps = self.__selectHits(self.muonTimeWindowBegin, self.muonTimeWindowEnd)
+            stripProfileMuon.fill(self.__stripNumbers(firedStrips))
             
-            tLatex = ROOT.TLatex()
-            tLatex.SetTextFont(42)
-            tLatex.SetTextSize(0.03)
-            tLatex.SetNDC()
-            tLatex.DrawLatex(0.16, 0.9, "Muon hit profile (hits inside muon window)")
+        # probe noise time window
+        if self.scanType == "noise":
+        
+            stripProfileNoise = histograms.Hist1D(self.nStrips, min(self.TDC_strips), max(self.TDC_strips)+1)
+            events, firedStrips, timeStamps = self.__selectHits(self.noiseTimeWindowBegin, self.noiseTimeWindowEnd)
+            stripProfileNoise.fill(self.__stripNumbers(firedStrips))
             
-
-            self.__drawAux(self.c1)
-            self.c1.RedrawAxis()
-            self.c1.Modify()        
-            self.c1.SaveAs("%smuonHitProfile.png" % self.savePath) 
-            self.c1.SaveAs("%smuonHitProfile.pdf" % self.savePath)           
+        return stripProfileAll, stripProfileMuon, stripProfileNoise
         
-            return 0.0
         
+    def _finishStripProfile(self, profiles):
+    
+        stripProfileAll, stripProfileMuon, stripProfileNoise = profiles
+        meanNoise = -1
         
         # noise rate profile: calculate noise rate in noise window
         if self.scanType == "noise":
-        
-            meanNoise = stripProfileNoise.GetEntries() # total amount of hits
-            norm = self.stripArea * self.noiseTimeWindow * nValidatedEvents * 1e-9
-            stripProfileNoise.Scale(1./norm)
+            
+            meanNoise = stripProfileNoise.entries # total amount of hits
+            norm = self.stripArea * self.noiseTimeWindow * self.nValidEvents * 1e-9
+            stripProfileNoise.scale(1./norm)
             meanNoise /= (norm * (len(self.TDC_strips)-len(self.TDC_strips_mask))) # re-correct for masked strips
             self.noiseRate = meanNoise
-
-            self.c1.cd()
-            self.c1.Clear()
-
-            stripProfileNoise.SetFillStyle(3354)
-            stripProfileNoise.SetFillColor(ROOT.kBlue)
-            stripProfileNoise.SetFillColorAlpha(ROOT.kBlue, 0.35)
-            stripProfileNoise.SetLineColor(ROOT.kBlue)
-            stripProfileNoise.SetLineWidth(2)
-            stripProfileNoise.Draw("HIST")
             
-            stripProfileNoise.GetYaxis().SetRangeUser(0, 1.3*stripProfileNoise.GetMaximum())
-            stripProfileNoise.GetXaxis().SetTitle("Strip number")
-            stripProfileNoise.GetXaxis().SetTitleOffset(1.2)
-            stripProfileNoise.GetXaxis().SetLabelOffset(0.005)
-            stripProfileNoise.GetXaxis().SetLabelSize(0.04)
-
-            stripProfileNoise.GetYaxis().SetTitle("Noise rate (Hz/cm^{2})")   
-            stripProfileNoise.GetYaxis().SetTitleOffset(1.8)
-            stripProfileNoise.GetYaxis().SetLabelOffset(0.005)    
-            
-            tLatex = ROOT.TLatex()
-            tLatex.SetTextFont(42)
-            tLatex.SetTextSize(0.03)
-            tLatex.SetNDC()
-            tLatex.DrawLatex(0.16, 0.9, "Mean noise rate: %.2f Hz/cm^{2}" % meanNoise)
-
-            self.__drawAux(self.c1)
-            self.c1.RedrawAxis()
-            self.c1.Modify()        
-            self.c1.SaveAs("%snoiseProfile.png" % self.savePath) 
-            self.c1.SaveAs("%snoiseProfile.pdf" % self.savePath)        
+        self.__store("stripProfile", {"strips": self.TDC_strips, "all": stripProfileAll, "muon": stripProfileMuon, "noise": stripProfileNoise, "meanNoise": meanNoise})
+        
+        if self.scanType == "efficiency": return 0.0
 
     
         
     def clusterization(self, clusterTimeWindow = 10, clusterTimeWindowUp = -1, clusterTimeWindowDown = -1):
+    
+        return self.__runStages([("clusterization", (clusterTimeWindow, clusterTimeWindowUp, clusterTimeWindowDown))])[0]
+        
+        
+    # Output: list of clusterization time constraints (nominal and optional up/down variation)
+    def __clusterTimeWindows(self, clusterTimeWindow, clusterTimeWindowUp, clusterTimeWindowDown):
+    
+        clusterTimeWindows = [clusterTimeWindow]
+        if clusterTimeWindowUp != -1 and clusterTimeWindowDown != -1: clusterTimeWindows += [clusterTimeWindowUp, clusterTimeWindowDown]
+        return clusterTimeWindows
+        
+        
+    def _fillClusterization(self, clusterTimeWindow = 10, clusterTimeWindowUp = -1, clusterTimeWindowDown = -1):
+    
+        # consider only muon clusterization
+        if self.scanType != "efficiency": return None
+        
+        # perform clusterization for the nominal and up/down variations in one pass
+        return self._clusterization(self.__clusterTimeWindows(clusterTimeWindow, clusterTimeWindowUp, clusterTimeWindowDown))
+        
+
+    def _finishClusterization(self, results, clusterTimeWindow = 10, clusterTimeWindowUp = -1, clusterTimeWindowDown = -1):
 
         # consider only muon clusterization
         if self.scanType != "efficiency": return 
         
-        # perform clusterization
-        cls, cmp = self._clusterization(clusterTimeWindow)
+        self.clusterTimeWindow = clusterTimeWindow
+        
+        CMP, CLS, CLS_cmp1 = results[0]
+        cls, cmp = self.__mean(CLS), self.__mean(CMP)
         self.muonCLS, self.muonCMP = cls, cmp
         
         # calculate clusterization error
         clsErr, cmpErr = -1, -1
-        if clusterTimeWindowUp != -1 and clusterTimeWindowDown != -1:
+        if len(results) == 3:
                     
-            self.setVerbose(0) # turn of verbosity
-            clsUp, cmpUp = self._clusterization(clusterTimeWindowUp) # up variation
-            clsDown, cmpDown = self._clusterization(clusterTimeWindowDown) # down variation
+            clsUp, cmpUp = self.__mean(results[1][1]), self.__mean(results[1][0]) # up variation
+            clsDown, cmpDown = self.__mean(results[2][1]), self.__mean(results[2][0]) # down variation
             
             #clsErr = (abs(clsUp-cls) + abs(clsDown-cls)) / 2.0
             #cmpErr = (abs(cmpUp-cls) + abs(cmpDown-cmp)) / 2.0
@@ -552,245 +612,177 @@ class Analyzer():
             cmpErr = max([abs(cmpUp-cmp), abs(cmpDown-cmp)])
             
             self.muonCLS_err, self.muonCMP_err = clsErr, cmpErr
-            self.setVerbose(1)
+        
+        self.__store("clusterization", {"CMP": CMP, "CLS": CLS, "CLS_cmp1": CLS_cmp1})
         
         return cls, cmp
+        
+        
+    # Mean muon CLS/CMP for a list of clusterization time constraints, obtained in one pass (no plots, see clusterStudy.py)
+    def clusterizationScan(self, clusterTimeWindows):
+    
+        if self.scanType != "efficiency": return 
+        
+        results = self.__accumulate([lambda: self._clusterization(clusterTimeWindows)])[0]
+        return [self.__mean(CLS) for CMP, CLS, CLS_cmp1 in results], [self.__mean(CMP) for CMP, CLS, CLS_cmp1 in results]
+        
     
-    def _clusterization(self, clusterTimeWindow = 10):
+    # Input: list of clusterization time constraints
+    # Output: for each time constraint, the distributions (number of entries per value) of the CMP of all valid events,
+    # of the CLS of all clusters and of the CLS of the clusters in events with CMP == 1
+    def _clusterization(self, clusterTimeWindows):
 
-        self.clusterTimeWindow = clusterTimeWindow
+        # select all the hits in the muon window, the hit pairs (and their time differences) are computed once for all time constraints
+        events, firedStrips, timeStamps = self.__selectHits(self.muonTimeWindowBegin, self.muonTimeWindowEnd)
+        
+        results = []
+        for labels in clustering.multiClusterLabels(events, firedStrips, timeStamps, clusterTimeWindows):
+        
+            CMP, CLS, clusterEvent = clustering.clusterStats(events, labels, self.data.nEvents)
+            results.append((np.bincount(CMP[self.data.valid]), np.bincount(CLS), np.bincount(CLS[CMP[clusterEvent] == 1])))
+            
+        return results
+        
+        
+    # Per-event summary table, e.g. to select the events to be displayed (see eventDisplay) or for further selections and
+    # aggregations without reading the DAQ file again (written to eventSummary.npz by write())
+    # Output: dict of arrays (columns), one entry per event:
+    #   event: entry number, valid: quality flag (the hit counts and clusters of corrupted events are zero)
+    #   nHits, nHitsMuon, nHitsNoise: number of hits in the trigger window (without the rejected start), muon and noise window
+    #   CMP, maxCLS: cluster multiplicity and largest cluster size inside the muon window (noise window for noise scans)
+    #   firstHit: time (ns) of the first hit in the trigger window, -1 if none
+    def eventSummary(self, clusterTimeWindow = 10):
     
-        h_clustersize = ROOT.TH1D("clustersize", "Cluster size", 1000, 0, 1000)
-        h_clustersize_cmp = ROOT.TH1D("clustersize_cmp1", "Cluster size (CMP==1)", 1000, 0, 1000)
-        h_clustermultiplicity = ROOT.TH1D("clustermultiplicity", "Cluster multiplicity", 1000, 0, 1000)
+        return self.__runStages([("eventSummary", (clusterTimeWindow,))])[0]
+        
+        
+    # Output: summary of the current block of events, keyed on the entry number of its first event (merged blocks: dict)
+    def _fillEventSummary(self, clusterTimeWindow = 10):
     
-        # select the time window based on the mode
-        tMin, tMax = self.muonTimeWindowBegin, self.muonTimeWindowEnd
+        nEvents = self.data.nEvents
+        columns = {"event": self.data.first + np.arange(nEvents), "valid": np.array(self.data.valid, dtype=bool)}
         
-        maxCLS = -99
-        maxCMP = -99
+        # hits per window, the hits are ordered by event
+        events, firedStrips, timeStamps = self.__selectHits(self.timeWindowReject, self.triggerWindow)
+        columns["nHits"] = np.bincount(events, minlength=nEvents).astype(np.int32)
+        columns["firstHit"] = np.full(nEvents, -1.0)
+        if len(events) > 0:
+            hitEvents, first = np.unique(events, return_index=True)
+            columns["firstHit"][hitEvents] = np.minimum.reduceat(timeStamps, first)
         
-
-        for evNum in range(0, self.t.GetEntries()+1):
-            
-            self.t.GetEntry(evNum)
-            if not self.validateEvent(): continue
-            #if evNum > 1000: break
-           
-            firedStrips, timeStamps = self.__groupAndOrder(self.t.TDC_channel, self.t.TDC_TimeStamp, tMin, tMax)
-            #print "----------- %d" % evNum, firedStrips, timeStamps
+        columns["nHitsMuon"] = np.bincount(self.__selectHits(self.muonTimeWindowBegin, self.muonTimeWindowEnd)[0], minlength=nEvents).astype(np.int32)
+        columns["nHitsNoise"] = np.bincount(self.__selectHits(self.noiseTimeWindowBegin, self.noiseTimeWindowEnd)[0], minlength=nEvents).astype(np.int32)
+        
+        # clusters
+        events, firedStrips, timeStamps = self.__selectHits(*self.__displayWindow())
+        labels = clustering.clusterLabels(events, firedStrips, timeStamps, clusterTimeWindow)
+        CMP, CLS, clusterEvent = clustering.clusterStats(events, labels, nEvents)
+        columns["CMP"] = CMP.astype(np.int32)
+        columns["maxCLS"] = np.zeros(nEvents, dtype=np.int32)
+        np.maximum.at(columns["maxCLS"], clusterEvent, CLS.astype(np.int32))
+        
+        return {self.data.first: columns}
+        
+        
+    def _finishEventSummary(self, blocks, clusterTimeWindow = 10):
     
-            #if len(firedStrips) == 0: continue
+        firsts = sorted(blocks)
+        self.eventTable = dict((name, np.concatenate([blocks[first][name] for first in firsts])) for name in blocks[firsts[0]])
+        return self.eventTable
+        
+        
+    # Noise rate per strip as a function of the time inside the noise window and of the event number (run stability), e.g.
+    # to find noise bursts and slow drifts. The hits are counted per strip in 1 ns time bins and per event and fired strip
+    # (noiseMapTable, written to noiseMap.npz by write()) and rebinned to timeBin (ns) and blocks of eventBlock events; any
+    # other binning follows from the table (see noiseMapRates), e.g. noiseMapRates(analyzer.noiseMapTable, 10, 100)
+    def noiseMap(self, timeBin = 100, eventBlock = 1000):
     
-            # make graph from all hits
-            G = nx.Graph()
-            
-            # add node for each hit
-            for i,ch in enumerate(firedStrips): G.add_node(i)
-            
-            # add edges between nodes
-            # and edge connect the nodes based on space and time constraints
-            for i, ch1 in enumerate(firedStrips):
-                for j, ch2 in enumerate(firedStrips):
-                    
-                    if j <= i: continue # avoid double counting
-                    DT = (timeStamps[i]-timeStamps[j])
-                    DS = (firedStrips[i] - firedStrips[j])
-                    
-                    if abs(DS) == 1 and abs(DT) < self.clusterTimeWindow: # if pair conditions satisfied
-                        #print "pair", ch1, ch2
-                        G.add_edge(i,j)
-                        
-            #print "Graph nodes:", G.number_of_nodes(), "Edges:", G.number_of_edges()
-            #print "MP", len(list(nx.connected_components(G)))
-            MP = len(list(nx.connected_components(G)))
-            if MP > maxCMP: maxCMP = MP
-            h_clustermultiplicity.Fill(MP)
-            
-            
-            if len(firedStrips) == 0: continue # if empty event, do not count for calculation of CLS
-            for k in nx.connected_components(G): 
-                CLS = len(k)
-                if CLS > maxCLS: maxCLS = CLS
-                h_clustersize.Fill(CLS)
-            
-            # histogram for CMP == 1
-            if MP == 1:
-                for k in nx.connected_components(G): 
-                    CLS = len(k)
-                    h_clustersize_cmp.Fill(CLS)  
-
-        # store the mean CLS BEFORE change of axis range!
-        cls, cmp = h_clustersize.GetMean(), h_clustermultiplicity.GetMean()   
-        cls_cmp1 = h_clustersize_cmp.GetMean()
-
-        # draw the CLS and CMP distributions
-        self.c1.cd()
-        self.c1.Clear()
-
-        leg = ROOT.TLegend(.15, 0.75, .4, .93)
-        leg.SetBorderSize(0)
-        leg.SetTextSize(0.03)
-        leg.SetFillStyle(0)
-        
-        if h_clustermultiplicity.Integral() > 1: h_clustermultiplicity.Scale(1.0/h_clustermultiplicity.Integral())
-        
-        h_clustermultiplicity.Draw("HIST ")
-        h_clustermultiplicity.SetLineColor(ROOT.kBlue)
-        h_clustermultiplicity.GetYaxis().SetRangeUser(0, 1.3*h_clustermultiplicity.GetMaximum())
-        h_clustermultiplicity.GetXaxis().SetRangeUser(0, 1.1*maxCMP)
-        h_clustermultiplicity.SetLineWidth(2)  
-
-
-        h_clustermultiplicity.GetXaxis().SetTitle("Cluster multiplicity")
-        h_clustermultiplicity.GetXaxis().SetTitleOffset(1.2)
-        h_clustermultiplicity.GetXaxis().SetLabelOffset(0.005)
-
-        h_clustermultiplicity.GetYaxis().SetTitle("Events (normalized)")   
-        h_clustermultiplicity.GetYaxis().SetTitleOffset(1.8)
-        h_clustermultiplicity.GetYaxis().SetLabelOffset(0.005)
+        return self.__runStages([("noiseMap", (timeBin, eventBlock))])[0]
         
-        params = ROOT.TLatex()
-        params.SetTextFont(42)
-        params.SetTextSize(0.03)
-        params.SetNDC()
-        params.DrawLatex(0.16, 0.9, "Mean muon cluster multiplicity (CMP): %.2f" % cmp)
         
-
-        self.__drawAux(self.c1)
-        self.c1.RedrawAxis()
-        self.c1.Modify()
-        if self.verbose > 0:
-            self.c1.SaveAs("%sCMP_muon.png" % self.savePath) 
-            self.c1.SaveAs("%sCMP_muon.pdf" % self.savePath)   
-            
-            
+    # Output: hits per strip and 1 ns time bin, hits per event and strip of the current block of events (only the fired
+    # strips of each event: event, strip index, hits) with its corrupted events and number of events (keyed on the entry
+    # number of its first event, merged blocks: dict)
+    def _fillNoiseMap(self, timeBin = 100, eventBlock = 1000):
+    
+        nTimeBins = max(int(math.ceil(self.noiseTimeWindowEnd - self.noiseTimeWindowBegin)), 1)
         
-
-
-        # draw the CLS and CMP distributions
-        self.c1.cd()
-        self.c1.Clear()
-
-        leg = ROOT.TLegend(.15, 0.75, .4, .93)
-        leg.SetBorderSize(0)
-        leg.SetTextSize(0.03)
-        leg.SetFillStyle(0)
-        
-        if h_clustersize.Integral() > 1: h_clustersize.Scale(1.0/h_clustersize.Integral())
-        
-        h_clustersize.Draw("HIST ")
-        h_clustersize.SetLineColor(ROOT.kBlue)
-        h_clustersize.GetYaxis().SetRangeUser(0, 1.3*h_clustersize.GetMaximum())
-        h_clustersize.GetXaxis().SetRangeUser(0, 1.1*maxCLS)
-        h_clustersize.SetLineWidth(2)  
-        
-        h_clustersize.Draw("HIST SAME")
-        h_clustersize.SetLineWidth(2)  
-        h_clustersize.SetLineColor(ROOT.kBlue)
-
-        h_clustersize.GetXaxis().SetTitle("Cluster size")
-        h_clustersize.GetXaxis().SetTitleOffset(1.2)
-        h_clustersize.GetXaxis().SetLabelOffset(0.005)
-
-        h_clustersize.GetYaxis().SetTitle("Events (normalized)")   
-        h_clustersize.GetYaxis().SetTitleOffset(1.8)
-        h_clustersize.GetYaxis().SetLabelOffset(0.005)
+        events, firedStrips, timeStamps = self.__selectHits(self.noiseTimeWindowBegin, self.noiseTimeWindowEnd)
+        firedStrips = firedStrips.astype(np.int64)
+        timeBins = np.minimum((timeStamps - self.noiseTimeWindowBegin).astype(np.int64), nTimeBins-1) # end of the window included
+        timeCounts = np.bincount(firedStrips*nTimeBins + timeBins, minlength=self.nStrips*nTimeBins).reshape(self.nStrips, nTimeBins)
         
-        params = ROOT.TLatex()
-        params.SetTextFont(42)
-        params.SetTextSize(0.03)
-        params.SetNDC()
-        params.DrawLatex(0.16, 0.9, "Mean muon cluster size (CLS): %.2f" % cls)
+        # sparse per-event counts, the size follows the number of hits of the block (not events x strips)
+        pairs, hits = np.unique(events.astype(np.int64)*self.nStrips + firedStrips, return_counts=True)
+        corrupted = np.flatnonzero(~np.asarray(self.data.valid, dtype=bool))
         
-
-        self.__drawAux(self.c1)
-        self.c1.RedrawAxis()
-        self.c1.Modify()
-        if self.verbose > 0:
-            self.c1.SaveAs("%sCLS_muon.png" % self.savePath) 
-            self.c1.SaveAs("%sCLS_muon.pdf" % self.savePath)   
-            
-            
-                      
-        h_clustersize.Delete()
-        h_clustermultiplicity.Delete()  
+        return timeCounts, {self.data.first: ((pairs // self.nStrips).astype(np.int32), (pairs % self.nStrips).astype(np.int16), hits.astype(np.int32), corrupted, self.data.nEvents)}
         
         
+    def _finishNoiseMap(self, partials, timeBin = 100, eventBlock = 1000):
+    
+        timeCounts, blocks = partials
+        firsts = sorted(blocks) # event numbers counted from the first event of the analysis
+        self.noiseMapTable = {
+        
+            "timeCounts": timeCounts, "nEvents": sum(blocks[first][4] for first in firsts),
+            "events": np.concatenate([blocks[first][0] + (first - firsts[0]) for first in firsts]), "stripIndex": np.concatenate([blocks[first][1] for first in firsts]),
+            "hits": np.concatenate([blocks[first][2] for first in firsts]), "corrupted": np.concatenate([blocks[first][3] + (first - firsts[0]) for first in firsts]),
+            "timeBegin": self.noiseTimeWindowBegin, "timeWindow": self.noiseTimeWindow, "stripArea": self.stripArea, "strips": np.asarray(self.TDC_strips),
+        }
+        timeRates, blockRates = noiseMapRates(self.noiseMapTable, timeBin, eventBlock)
         
-        # draw CMP==1 distribution
-        self.c1.cd()
-        self.c1.Clear()
-
-        leg = ROOT.TLegend(.15, 0.75, .4, .93)
-        leg.SetBorderSize(0)
-        leg.SetTextSize(0.03)
-        leg.SetFillStyle(0)
-        
-        if h_clustersize_cmp.Integral() > 1: h_clustersize_cmp.Scale(1.0/h_clustersize_cmp.Integral())
-        
-        h_clustersize_cmp.Draw("HIST ")
-        h_clustersize_cmp.SetLineColor(ROOT.kBlue)
-        h_clustersize_cmp.GetYaxis().SetRangeUser(0, 1.3*h_clustersize_cmp.GetMaximum())
-        h_clustersize_cmp.GetXaxis().SetRangeUser(0, 1.1*maxCLS)
-        h_clustersize_cmp.SetLineWidth(2)  
-        
-        h_clustersize_cmp.Draw("HIST SAME")
-        h_clustersize_cmp.SetLineWidth(2)  
-        h_clustersize_cmp.SetLineColor(ROOT.kBlue)
-
-        h_clustersize_cmp.GetXaxis().SetTitle("Cluster size (CMP==1)")
-        h_clustersize_cmp.GetXaxis().SetTitleOffset(1.2)
-        h_clustersize_cmp.GetXaxis().SetLabelOffset(0.005)
-
-        h_clustersize_cmp.GetYaxis().SetTitle("Events (normalized)")   
-        h_clustersize_cmp.GetYaxis().SetTitleOffset(1.8)
-        h_clustersize_cmp.GetYaxis().SetLabelOffset(0.005)
+        # rates as histograms (x-axis time or event number, y-axis strips)
+        scale = 1000. if self.scanType == "noise" else 1.
+        timeMap = histograms.Hist2D(timeRates.shape[1], self.noiseTimeWindowBegin/scale, (self.noiseTimeWindowBegin + timeRates.shape[1]*max(int(timeBin), 1))/scale, self.nStrips, min(self.TDC_strips), max(self.TDC_strips)+1)
+        timeMap.counts[1:-1, 1:-1] = timeRates.T
+        timeMap.entries = int(timeCounts.sum())
+        eventMap = histograms.Hist2D(blockRates.shape[0], 0, blockRates.shape[0]*max(int(eventBlock), 1), self.nStrips, min(self.TDC_strips), max(self.TDC_strips)+1)
+        eventMap.counts[1:-1, 1:-1] = blockRates
+        eventMap.entries = int(timeCounts.sum())
         
-        params = ROOT.TLatex()
-        params.SetTextFont(42)
-        params.SetTextSize(0.03)
-        params.SetNDC()
-        params.DrawLatex(0.16, 0.9, "Mean muon cluster size (CLS): %.2f" % cls_cmp1)
-        params.DrawLatex(0.16, 0.85, "Cluster Multiplicity = 1")
+        self.__store("noiseMap", {"time": timeMap, "events": eventMap, "scale": scale, "strips": self.TDC_strips})
+        return self.noiseMapTable
         
-
-        self.__drawAux(self.c1)
-        self.c1.RedrawAxis()
-        self.c1.Modify()
-        if self.verbose > 0:
-            self.c1.SaveAs("%sCLS_muon_CMP1.png" % self.savePath) 
-            self.c1.SaveAs("%sCLS_muon_CMP1.pdf" % self.savePath)   
-            
-            
-                      
-        #h_clustersize_cmp.Delete()
-        #h_clustermultiplicity.Delete()  
+        
+    # Output: time window of the event displays and summaries, muon window (efficiency scans) or noise window
+    def __displayWindow(self):
+    
+        if self.scanType == "efficiency": return self.muonTimeWindowBegin, self.muonTimeWindowEnd
+        return self.noiseTimeWindowBegin, self.noiseTimeWindowEnd
+        
+        
+    # Mean value of a CLS/CMP distribution, given as number of entries per value (zero if empty)
+    def __mean(self, counts):
+    
+        if counts.sum() == 0: return 0.0
+        return 1.0*(counts*np.arange(len(counts))).sum() / counts.sum()
         
         
-        return cls, cmp
-         
-
     def efficiency(self):
+    
+        return self.__runStages([("efficiency", ())])[0]
         
-        # calculate efficiency
-        nHitsAbs = 0
-        nHitsMuonWindow = 0
-        nTrig = 0
-        for evNum in range(0, self.t.GetEntries()+1):
-            
-            self.t.GetEntry(evNum)
-            if not self.validateEvent(): continue
-            nTrig +=1
-            
-            # probe the entire time window
-            firedStrips, timeStamps = self.__groupAndOrder(self.t.TDC_channel, self.t.TDC_TimeStamp, self.timeWindowReject, self.muonTriggerWindow)
-            if len(firedStrips) > 0: nHitsAbs +=1
-
-            # probe the muon window
-            firedStrips, timeStamps = self.__groupAndOrder(self.t.TDC_channel, self.t.TDC_TimeStamp, self.muonTimeWindowBegin, self.muonTimeWindowEnd)
-            if len(firedStrips) > 0: nHitsMuonWindow +=1
+        
+    def _fillEfficiency(self):
+        
+        # count the valid events with at least one hit in the time window
+        
+        # probe the entire time window
+        events, firedStrips, timeStamps = self.__selectHits(self.timeWindowReject, self.muonTriggerWindow)
+        nHitsAbs = len(np.unique(events))
 
+        # probe the muon window
+        events, firedStrips, timeStamps = self.__selectHits(self.muonTimeWindowBegin, self.muonTimeWindowEnd)
+        nHitsMuonWindow = len(np.unique(events))
+        
+        return nHitsAbs, nHitsMuonWindow
+        
+        
+    def _finishEfficiency(self, counts):
+    
+        nHitsAbs, nHitsMuonWindow = counts
+        nTrig = self.nValidEvents
 
         # calculate the efficiency and store in class members
         self.efficiencyAbs = 1.0*nHitsAbs / nTrig
@@ -798,242 +790,308 @@ class Analyzer():
 
         self.efficiencyAbs_err = math.sqrt(self.efficiencyAbs*(1.0-self.efficiencyAbs)/nTrig)
         self.efficiencyMuon_err = math.sqrt(self.efficiencyMuon*(1.0-self.efficiencyMuon)/nTrig)
+        
+        
+    # Input: list of (stage, arguments), the stages must not depend on each other
+    # Output: return value of each stage
+    # The dependencies which are not yet performed are performed first (e.g. the time windows of the efficiency)
+    # With useCache, the merged partial results are loaded from the stage results cache if available, only the other stages
+    # are filled (i.e. a change of e.g. the clusterization time constraints only reprocesses the clusterization)
+    def __runStages(self, stages):
+    
+        missing = []
+        for stage, args in stages:
+            missing += [dep for dep in self.dependencies[stage] if dep not in self.performed and dep not in missing]
+        if len(missing) > 0: self.__runStages([(dep, self.__requestedArgs(dep)) for dep in missing])
+        
+        partials = self.__fillStages(stages)
+        results = [getattr(self, "_finish%s" % (stage[0].upper() + stage[1:]))(partials[i], *args) for i, (stage, args) in enumerate(stages)]
+        for stage, args in stages:
+        
+            if stage in self.performed and self.performed[stage] != args: self.__invalidateDependents(stage)
+            self.performed[stage] = args
+        
+        return results
+        
+        
+    # Input: stage performed again with other arguments (e.g. other muon/noise windows of timeProfile)
+    # The stages depending on it, directly or not, are no longer up to date: they are performed again when needed (by run()
+    # or a lazy result), instead of returning the results of the earlier arguments
+    def __invalidateDependents(self, stage):
+    
+        for other in self.dependencies:
+            if stage in self.dependencies[other] and other in self.performed:
+            
+                del self.performed[other]
+                self.__invalidateDependents(other)
+        
+        
+    # Input: list of (stage, arguments)
+    # Output: merged partial results of each stage (fill functions only), from the stage results cache if available
+    def __fillStages(self, stages):
+    
+        keys = [self.__stageKey(stage, args) if self.useCache else None for stage, args in stages]
+        partials = [rawdata.loadStage(self.fileName, key) if key is not None else None for key in keys]
+        
+        missing = [i for i in range(len(stages)) if partials[i] is None]
+        if len(missing) > 0:
+        
+            fills = [functools.partial(getattr(self, "_fill%s" % (stages[i][0][0].upper() + stages[i][0][1:])), *stages[i][1]) for i in missing]
+            for i, result in zip(missing, self.__accumulate(fills)):
+            
+                partials[i] = (result, (self.nEvents, self.nValidEvents, self.nCorruptedPerTDC))
+                if keys[i] is not None: rawdata.saveStage(self.fileName, keys[i], partials[i])
+        
+        # streaming mode without any pass over the events: event counts from the cache
+        if self.nEvents == -1: self.nEvents, self.nValidEvents, self.nCorruptedPerTDC = partials[0][1]
+        
+        return [partial[0] for partial in partials]
+        
+        
+    # Output: key of the stage results in the stage results cache
+    def __stageKey(self, stage, args):
+    
+        if self.fingerprint is None: self.fingerprint = rawdata.fingerprint(self.fileName)
+        
+        inputs = dict((name, getattr(self, name)) for name in self.hitSelectionInputs + self.stageInputs[stage])
+        if stage in self.stageKeyWithoutArgs: args = ()
+        key = {"version": self.stageCacheVersion, "file": self.fingerprint["sha1"], "stage": stage, "args": args, "inputs": inputs}
+        return hashlib.sha1(json.dumps(key, sort_keys=True, default=lambda x: x.tolist())).hexdigest()
+        
+        
+    # Input: list of functions returning the partial results (histograms, counters) of the current block of events
+    # Output: the results of each function over all the events
+    # In streaming mode (memoryBudget > 0), the events are read in blocks fitting the memory budget and the partial results
+    # are merged (see histograms.merge), which gives the same results as one pass over all the events at once
+    # With nJobs > 1, the events are split in nJobs consecutive ranges, each filled by a worker process; the partial results
+    # are merged in event order (the histograms hold integer counts, such that the results are identical to the serial pass)
+    def __accumulate(self, fills):
+    
+        nJobs = self.nJobs if not multiprocessing.current_process().daemon else 1 # no worker processes inside a worker process
+        if self.memoryBudget <= 0 and nJobs <= 1: return [fill() for fill in fills]
+        
+        if nJobs <= 1: partials = [self._accumulateRange(fills, 0, -1)]
+        else:
+        
+            nEvents = self.nEvents if self.nEvents != -1 else rawdata.countEvents(self.fileName, self.useCache)
+            nJobs = max(min(nJobs, nEvents), 1)
+            bounds = [nEvents*i // nJobs for i in range(nJobs+1)]
+            
+            # the worker processes inherit the analyzer and the fill functions (fork)
+            global parallelPass
+            parallelPass = (self, fills)
+            pool = multiprocessing.Pool(nJobs)
+            partials = pool.map(accumulateRange, zip(bounds[:-1], bounds[1:]))
+            pool.close()
+            pool.join()
+            parallelPass = None
+        
+        results, counts = functools.reduce(histograms.merge, partials)
+        if self.memoryBudget > 0: self.data, self.hitTable = None, None
+        self.nEvents, self.nValidEvents, self.nCorruptedPerTDC = counts
+        
+        return results
+        
+        
+    # Input: list of fill functions, event range [first, last) (-1: up to the last event)
+    # Output: merged partial results of the fill functions over the range, event counts (all, valid, corrupted per TDC)
+    def _accumulateRange(self, fills, first, last):
+    
+        if self.memoryBudget <= 0: blocks = [self.data.block(first, last)]
+        else: blocks = rawdata.iterFile(self.fileName, self.memoryBudget, self.useCache, first, last)
+        
+        results = [None]*len(fills)
+        counts = None
+        for block in blocks:
+        
+            self.data, self.hitTable = block, None
+            results = [histograms.merge(results[i], fill()) for i, fill in enumerate(fills)]
+            counts = histograms.merge(counts, (block.nEvents, int(block.valid.sum()), block.nCorruptedPerTDC))
+            
+        return results, counts
+        
+        
+    # Input: name of the analysis stage, its results (plain numbers and arrays/histograms, see histograms.py)
+    # The results are drawn immediately, unless in compute-only mode (see render())
+    def __store(self, name, product):
+    
+        self.products[name] = product
+        if not self.computeOnly: self.__render(name)
+        
+        
+    def __render(self, name):
+    
+        if self.formats == "none": return
+        render.startQueue(self.renderJobs)
+        render.submit(name, self.products[name], self.__renderInfo())
+        
+        
+    # Output: info of the HV point needed for the plots (see render.py)
+    def __renderInfo(self):
+    
+        return {"scanid": self.scanid, "HVPoint": self.HVPoint, "savePath": self.savePath, "verbose": self.verbose, "formats": self.formats, "textCMS": self.textCMS}
+        
+        
+    # Draw the results of all the analysis stages performed so far (e.g. after running in compute-only mode)
+    def render(self):
+    
+        for name in self.stages:
+            if name in self.products: self.__render(name)
  
  
-    def eventDisplay(self, maxEvents):
+    # Draw single events (hits inside the muon/noise window, time vs. strip)
+    # Input: amount of events to be plotted, chosen randomly among the selected events (-1: all the selected events)
+    # selection: function of the event summary (see eventSummary) returning the mask of the events to be plotted, e.g.
+    # lambda s: (s["CMP"] >= 3) | (s["maxCLS"] > 5); None: all events
+    # layout: files (two PNG files per event), pdf (all the events in one multi-page PDF file) or sheets (contact sheets)
+    def eventDisplay(self, maxEvents, selection = None, layout = "files"):
     
+        if self.computeOnly or self.formats == "none": return # event displays are plots only
+        if layout not in ["files", "pdf", "sheets"]: sys.exit("Unknown event display layout %s" % layout)
+        
         #ROOT.gStyle.SetPalette(ROOT.kDarkRainBow)
         
-        # select random numbers
+        # select the events, random events (without repetition) if more events are selected than requested
         #random.seed(0) # fix seed of random generator in order to display the same events
-        evToPlot = []
-        if maxEvents == -1:
+        if self.nEvents == -1: self.__accumulate([]) # streaming mode: count the events first
+        if selection is None: selected = range(self.nEvents)
+        else:
         
-            for j in range(self.t.GetEntries()+1): evToPlot.append(j)
+            summary = self.eventSummary(self.clusterTimeWindow)
+            selected = [int(evNum) for evNum in summary["event"][selection(summary)]]
             
-        else:
-
-            for j in range(maxEvents):
-                evToPlot.append(random.randint(0, self.t.GetEntries()+1)) 
+        if maxEvents == -1 or maxEvents >= len(selected): evToPlot = selected
+        else: evToPlot = sorted(random.sample(selected, maxEvents))
                 
         path = self.savePath + "eventDisplay/"
         if os.path.isdir(path): shutil.rmtree(path)
         os.mkdir(path)
 
 
-        
-        if self.scanType == "noise" or self.scanType == "rate":
-            
-            scale = 1000.
-            timeStart = self.timeWindowReject
-            timeEnd = self.noiseTriggerWindow
-            
-        elif self.scanType == "efficiency":
-            
-            scale = 1.
-            timeStart = self.timeWindowReject
-            timeEnd = self.muonTriggerWindow        
-         
-        width = timeEnd - timeStart
-        
-        
-        
-        # make 2D histogram (x-axis time, y-axis strips)
-        timeStripProfile = ROOT.TH2D("timeStripProfile", "Time-strip profile", width, int(timeStart/scale), int(timeEnd/scale), self.nStrips, min(self.TDC_strips), max(self.TDC_strips)+1)
-              
-
+        timeStart, timeEnd = self.__displayWindow()
         if self.scanType == "efficiency": 
         
             scale = 1.
-            timeStart = self.muonTimeWindowBegin
-            timeEnd = self.muonTimeWindowEnd
             width = 10*int(self.muonTimeWindow+1)
             
         else:
             
             scale = 1000.
-            timeStart = self.noiseTimeWindowBegin
-            timeEnd = self.noiseTimeWindowEnd
-            width = 10*int(self.noiseTimeWindow+1)
             width = self.noiseTimeWindow+1
     
     
+        # get the hits of the selected events (valid events only)
+        eventHits = self.__accumulate([lambda: self._eventHits(evToPlot)])[0]
+        info = self.__renderInfo()
+        render.startQueue(self.renderJobs)
+        events = [] # plain event data (see render.drawEvent), drawn at once for the pdf and sheets layouts
+        
         for evNum in evToPlot:
     
-            self.t.GetEntry(evNum)
-            if not self.validateEvent(): continue
-            
+            if evNum not in eventHits: continue
+            TDC_CH, TDC_TS = eventHits[evNum]
             
-            firedStrips, timeStamps = self.__groupAndOrder(self.t.TDC_channel, self.t.TDC_TimeStamp, timeStart, timeEnd)
+            firedStrips, timeStamps = self.__groupAndOrder(TDC_CH, TDC_TS, timeStart, timeEnd)
             if self.scanType == "noise" and len(firedStrips) == 0: continue
             if len(firedStrips) == 0: continue
             
-            # store hits in 2D histo (100 ps accuracy for timing)
-            eventHist = ROOT.TH2D("eventHist%d" % evNum, "Event %d" % evNum, width, int(timeStart/scale), int(timeEnd/scale), self.nStrips, min(self.TDC_strips), max(self.TDC_strips)+1)
-            eventHist_ext = ROOT.TH2D("eventHist%d_ext" % evNum, "Event %d" % evNum, width, int(timeStart/scale), 600, self.nStrips, min(self.TDC_strips), max(self.TDC_strips)+1)
-            
-            
-            for i,ch in enumerate(firedStrips): 
-                eventHist.Fill(timeStamps[i]/scale, self.TDC_strips[ch])     
-                eventHist_ext.Fill(timeStamps[i]/scale, self.TDC_strips[ch]) 
-                
-                
-                
             ## CALCULATE CLUSTERS
             outStr = "" 
-            G = nx.Graph() # make graph from all hits
-            for i,ch in enumerate(firedStrips): G.add_node(i) # add node for each hit
-            
-            # add edges between nodes
-            # and edge connect the nodes based on space and time constraints
-            for i, ch1 in enumerate(firedStrips):
-                for j, ch2 in enumerate(firedStrips):
-                    
-                    if j <= i: continue # avoid double counting
-                    DT = (timeStamps[i]-timeStamps[j])
-                    DS = (firedStrips[i] - firedStrips[j])
-                    
-                    if abs(DS) == 1 and abs(DT) < self.clusterTimeWindow: # if pair conditions satisfied
-                        #print "pair", ch1, ch2
-                        G.add_edge(i,j)
-                        
-            MP = len(list(nx.connected_components(G)))
+            labels = clustering.clusterLabels(np.zeros(len(firedStrips), dtype=np.int64), firedStrips, timeStamps, self.clusterTimeWindow)
+            MP, CLS, clusterEvent = clustering.clusterStats(np.zeros(len(firedStrips), dtype=np.int64), labels, 1)
+            MP = MP[0]
             outStr += "MP=%d, CLS=(" % MP
-            for k in nx.connected_components(G): 
-                CLS = len(k)
-                outStr += "%d," % CLS
+            for k in CLS: outStr += "%d," % k
             
             if MP != 0: outStr = outStr[:-1]
             outStr += "), #Deltat = %d ns" % self.clusterTimeWindow
             
-     
-            # draw it
-            self.c2.cd()
-            self.c2.SetRightMargin(0.05)
-            self.c2.Clear()  
-            
-            for i in range(1, self.nStrips+1): eventHist.GetYaxis().SetBinLabel(i, str(self.TDC_strips[i-1]))
-
-            eventHist.GetXaxis().SetTitle("Time (ns)")
-            eventHist.GetXaxis().SetTitleOffset(1.0)
-            eventHist.GetXaxis().SetLabelOffset(0.0)
-
-            eventHist.GetYaxis().SetTitle("Strip number")   
-            eventHist.GetYaxis().SetTitleOffset(1.3)
-            eventHist.GetYaxis().SetLabelOffset(0.005)
-            
-            eventHist.Draw("COL")
+            # draw it (hits in 2D histo, 100 ps accuracy for timing), see render.drawEvent
+            event = {"evNum": evNum, "path": path, "times": timeStamps/scale, "hitStrips": np.asarray(self.TDC_strips)[firedStrips], "strips": self.TDC_strips,
+                "xAxis": (width, int(timeStart/scale), int(timeEnd/scale)), "extMax": 600, "text": outStr}
+            if layout == "files": render.submit("event", event, info)
+            else: events.append(event)
             
-            txt = ROOT.TLatex()
-            txt.SetTextFont(42)
-            txt.SetTextSize(0.03)
-            txt.SetNDC()
-            txt.DrawLatex(self.c2.GetLeftMargin(), 0.035, outStr)
-            
-            self.__drawAux(self.c2, "EV%d" %evNum)
-            self.c2.RedrawAxis()
-            self.c2.Modify()    
-            self.c2.SaveAs("%sevent_%d.png" % (path, evNum))    
-            
-            
-            # draw it
-            self.c2.cd()
-            self.c2.Clear()  
-            
-            for i in range(1, self.nStrips+1): eventHist_ext.GetYaxis().SetBinLabel(i, str(self.TDC_strips[i-1]))
-
-            eventHist_ext.GetXaxis().SetTitle("Time (ns)")
-            eventHist_ext.GetXaxis().SetTitleOffset(1.0)
-            eventHist_ext.GetXaxis().SetLabelOffset(0.0)
-
-            eventHist_ext.GetYaxis().SetTitle("Strip number")   
-            eventHist_ext.GetYaxis().SetTitleOffset(1.3)
-            eventHist_ext.GetYaxis().SetLabelOffset(0.005)
-            
-            eventHist_ext.Draw("COL")
-            
-            txt = ROOT.TLatex()
-            txt.SetTextFont(42)
-            txt.SetTextSize(0.03)
-            txt.SetNDC()
-            txt.DrawLatex(self.c2.GetLeftMargin(), 0.035, outStr)
-            
-            self.__drawAux(self.c2, "EV%d" %evNum)
-            self.c2.RedrawAxis()
-            self.c2.Modify()    
-            self.c2.SaveAs("%sevent_ext_%d.png" % (path, evNum))  
-
+        if layout == "pdf": render.submit("eventPages", {"events": events, "fileName": path + "events.pdf"}, info)
+        if layout == "sheets":
         
-    def __drawAux(self, c, aux = ""):
-    
-        textLeft = ROOT.TLatex()
-        textLeft.SetTextFont(42)
-        textLeft.SetTextSize(0.04)
-        textLeft.SetNDC()
-        textLeft.DrawLatex(c.GetLeftMargin(), 0.96, self.textCMS)
-        
-        textRight = ROOT.TLatex()
-        textRight.SetNDC()
-        textRight.SetTextFont(42)
-        textRight.SetTextSize(0.04)
-        textRight.SetTextAlign(31)
-        if aux == "": textRight.DrawLatex(1.0-c.GetRightMargin(), 0.96, "S%d/HV%d" % (self.scanid, self.HVPoint))
-        else: textRight.DrawLatex(1.0-c.GetRightMargin(), 0.96, "S%d/HV%d/%s" % (self.scanid, self.HVPoint, aux))
+            perSheet = self.eventSheetTiles[0]*self.eventSheetTiles[1]
+            for i in range(0, len(events), perSheet):
+                render.submit("eventSheet", {"events": events[i:i+perSheet], "fileName": path + "events_%d" % (i // perSheet), "tiles": self.eventSheetTiles}, info)
 
         
-    def validateEvent(self):
-
-        ## Quality flag validation 
-        # see implementation Alexis: https://github.com/afagot/GIF_OfflineAnalysis/blob/master/src/utils.cc
-        qFlag = self.t.Quality_flag
-        tmpflag = qFlag
+    # Input: event numbers
+    # Output: TDC channels and time stamps of the valid events among them in the current block of events
+    def _eventHits(self, evNums):
+    
+        eventHits = {}
+        for evNum in evNums:
         
-        IsCorrupted = False
-        nDigits = 0
-        while tmpflag / int(math.pow(10, nDigits)) != 0: nDigits += 1;
+            i = evNum - self.data.first
+            if 0 <= i < self.data.nEvents and self.data.valid[i]: eventHits[evNum] = tuple(np.array(x) for x in self.data.hits(i))
+            
+        return eventHits
         
-        while not IsCorrupted and nDigits != 0:
         
-            tdcflag = tmpflag / int(math.pow(10, nDigits-1))
-
-            if tdcflag == 2: 
-                IsCorrupted = True
+    # Quality flag validation, the valid event mask is decoded once per file (see rawdata.decodeQualityFlag)
+    def validateEvent(self, evNum):
 
-            tmpflag = tmpflag % int(math.pow(10,nDigits-1))
-            nDigits -= 1
-        
-        return not IsCorrupted
+        return self.data.valid[evNum]
         
 
         
-    # Input: raw TDC channel/time vectors,
+    # Input: raw TDC channel/time vectors (single event or entire file),
     # Output: converted TDC channels to strip numbers, within the optinally given time window
     def __groupAndOrder(self, TDC_CH, TDC_TS, windowStart = -1e9, windowEnd = 1e9):
     
-        STRIP = []
-        TS = []
-        for i,ch in enumerate(TDC_CH):
-            if not ch in self.TDC_channels: continue # only consider channels from chamber
-            if TDC_TS[i] < windowStart: continue # min time window
-            if TDC_TS[i] > windowEnd: continue # max time window
-            if self.TDC_strips[self.TDC_channels.index(ch)] in self.TDC_strips_mask: continue
-            
-            
-            
-            #if TDC_TS[i] < self.timeWindowReject: continue # reject TDC first events
-            #stripNo = cfg.TDC_strips[cfg.TDC_channels.index(ch)]
-            stripNo = self.TDC_channels.index(ch)
-            STRIP.append(stripNo)
-            TS.append(TDC_TS[i])
+        STRIP = self.__mapChannels(TDC_CH)
+        sel = (STRIP != -1) & (TDC_TS >= windowStart) & (TDC_TS <= windowEnd)
         
-        return STRIP, TS
+        return STRIP[sel], TDC_TS[sel]
         
- 
-    def write(self):
+        
+    # Input: time window
+    # Output: event number, strip index and time stamp of all the hits of the valid events inside the time window (entire file)
+    def __selectHits(self, windowStart = -1e9, windowEnd = 1e9):
     
-        print "Write output JSON file"
+        # the hits of the valid events on connected strips are selected once, and shared by all the stages
+        if self.hitTable is None:
+        
+            EVENT = self.data.hitEvent()
+            STRIP = self.__mapChannels(self.data.channel)
+            sel = self.data.valid[EVENT] & (STRIP != -1)
+            self.hitTable = (EVENT[sel], STRIP[sel], np.asarray(self.data.time[sel]))
+        
+        EVENT, STRIP, TIME = self.hitTable
+        sel = (TIME >= windowStart) & (TIME <= windowEnd)
         
-        out = {}
+        return EVENT[sel], STRIP[sel], TIME[sel]
+        
+        
+    # Input: strip indices
+    # Output: strip numbers (as given in TDC_strips)
+    def __stripNumbers(self, STRIP):
+    
+        return np.asarray(self.TDC_strips)[STRIP]
+        
+        
+    # Input: raw TDC channels
+    # Output: strip index for each channel, -1 for channels not connected to the chamber or masked strips
+    def __mapChannels(self, TDC_CH):
+    
+        idx = TDC_CH - self.TDC_lookupOffset
+        inRange = (idx >= 0) & (idx < len(self.TDC_lookup))
+        
+        STRIP = np.full(len(idx), -1, dtype=np.int32)
+        STRIP[inRange] = self.TDC_lookup[idx[inRange]]
+        return STRIP
+        
+ 
+    # Output: all the input and output parameters of the analysis (plain numbers, as written in output.json)
+    # The scan drivers collect these results directly from the analyzer of each HV point, and write them once per scan
+    def getResults(self):
+    
+        if self.nEvents == -1: self.__accumulate([]) # streaming mode without any analysis pass: count the events
         
         param_input = {
         
@@ -1073,15 +1131,36 @@ class Analyzer():
             "efficiencyMuon_err"        : self.efficiencyMuon_err, 
             
             "noiseRate"                 : self.noiseRate,  
+            
+            "nEvents"                   : self.nEvents,
+            "nCorruptedEvents"          : self.nEvents - self.nValidEvents,
+            "nCorruptedEventsPerTDC"    : dict((str(tdc), int(n)) for tdc,n in enumerate(self.nCorruptedPerTDC) if n > 0),
         }        
    
-        data = {
+        return {
         
             "input_parameters"          :  param_input, 
             "output_parameters"         :  param_output, 
         }
+        
+        
+    def write(self):
     
-        with open("%soutput.json" % self.savePath, 'w') as fp: json.dump(data, fp, indent=4)
+        print "Write output JSON file"
+        with open("%soutput.json" % self.savePath, 'w') as fp: json.dump(self.getResults(), fp, indent=4)
+        if self.eventTable is not None: self.writeEventSummary()
+        if self.noiseMapTable is not None: self.writeNoiseMap()
+        
+        
+    # Write the per-event summary table (see eventSummary) in eventSummary.npz, one compressed array per column
+    # e.g. table = np.load("eventSummary.npz"); efficiency = (table["nHitsMuon"][table["valid"]] > 0).mean()
+    def writeEventSummary(self):
+    
+        np.savez_compressed("%seventSummary.npz" % self.savePath, **self.eventTable)
+        
+        
+    # Write the noise maps (see noiseMap) in noiseMap.npz, e.g. noiseMapRates(np.load("noiseMap.npz"), 10, 100)
+    def writeNoiseMap(self):
+    
+        np.savez_compressed("%snoiseMap.npz" % self.savePath, **self.noiseMapTable)
     
-
-
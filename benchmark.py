@@ -0,0 +1,205 @@
+
+import sys, os, glob, shutil, json, time, resource, subprocess, multiprocessing
+import analyzer as an
+import config
+import syntheticScan
+
+
+## Benchmark of the analyzer on synthetic scans (see syntheticScan.py)
+# Measures the throughput (events/s, hits/s) and the peak memory (RSS) of each analysis stage of one HV point, and the
+# run time and peak memory of the complete driver scripts (analyzeEfficiencyRun.py, analyzeNoiseRun.py). All the stages and
+# drivers start without any cache (decoded hits, stage results, CAEN table), i.e. the cold analysis is benchmarked.
+# The results are compared with a reference benchmark: the benchmark fails (exit code 1) if a result regresses by more
+# than the given tolerance, or if an absolute threshold is not met.
+
+
+# stages of one HV point, with their arguments (as called in the drivers)
+stages = {
+
+    "efficiency"    : [("timeProfile", (267, 9)), ("timeStripProfile2D", ()), ("stripProfile", ()), ("clusterization", (10, 4, 16)), ("efficiency", ()), ("eventSummary", (10,))],
+    "noise"         : [("timeProfile", ()), ("timeStripProfile2D", ()), ("stripProfile", ()), ("eventSummary", ()), ("noiseMap", (100, 1000))],
+}
+
+drivers = {"efficiency": "analyzeEfficiencyRun.py", "noise": "analyzeNoiseRun.py"}
+
+
+# Output: peak resident memory (MB) of the current process or of its terminated children
+def peakRSS(who = resource.RUSAGE_SELF):
+
+    return resource.getrusage(who).ru_maxrss / 1024. # kB on Linux
+
+
+# Generate the synthetic scan, unless it already exists with the same settings
+def prepareScan(dir, settings, cfg):
+
+    try:
+        with open("%s/settings.json" % dir) as f:
+            if json.load(f) == settings: return
+    except (IOError, OSError, ValueError): pass
+
+    if os.path.exists(dir): shutil.rmtree(dir)
+    syntheticScan.generateScan(dir, settings, cfg)
+    with open("%s/settings.json" % dir, 'w') as f: json.dump(settings, f, indent=4)
+
+
+# Remove all the caches of a scan directory (decoded hits and stage results of each DAQ file, CAEN table)
+def clearCaches(dir):
+
+    for cacheDir in glob.glob("%s/*.cache" % dir): shutil.rmtree(cacheDir)
+    for cacheFile in glob.glob("%s/Scan*_CAEN.json" % dir): os.remove(cacheFile)
+
+
+# peakRSSSoFar: high-water mark of the process up to the end of the step (all the steps run in the same process, i.e. it
+# only grows; a step needing more memory than the ones before shows up as an increase)
+def measure(t0, nEvents, nHits):
+
+    dt = max(time.time() - t0, 1e-9)
+    return {"time": dt, "eventsPerSecond": nEvents/dt, "hitsPerSecond": nHits/dt, "peakRSSSoFar": peakRSS()}
+
+
+# Benchmark all the stages of one HV point (executed in a separate process, such that the peak RSS only covers this HV point)
+def benchmarkStages(args):
+
+    dir, scanid, HVPoint, scanType, cfg, computeOnly = args
+    fileName = "%s/Scan%.6d_HV%d_DAQ.root" % (dir, scanid, HVPoint)
+    saveDir = "%s/benchmark/HV%d/" % (dir, HVPoint)
+    clearCaches(dir)
+
+    results = {}
+
+    # decoding of the DAQ file (without cache), writing and reading of the decoded-hit cache
+    t0 = time.time()
+    analyzer = an.Analyzer(dir, saveDir, scanid, HVPoint, scanType, useCache = False)
+    nEvents, nHits = analyzer.data.nEvents, analyzer.data.nHits()
+    results["decode"] = measure(t0, nEvents, nHits)
+
+    t0 = time.time()
+    analyzer = an.Analyzer(dir, saveDir, scanid, HVPoint, scanType) # decoding + writing of the cache
+    results["cacheWrite"] = measure(t0, nEvents, nHits)
+
+    t0 = time.time()
+    analyzer = an.Analyzer(dir, saveDir, scanid, HVPoint, scanType)
+    results["cacheRead"] = measure(t0, nEvents, nHits)
+
+    analyzer.loadConfig(cfg)
+    analyzer.setComputeOnly(computeOnly)
+    for stage, stageArgs in stages[scanType]:
+
+        t0 = time.time()
+        getattr(analyzer, stage)(*stageArgs)
+        results[stage] = measure(t0, nEvents, nHits)
+
+    return results
+
+
+# Run a driver script on the synthetic scan (in its directory), output: run time and peak RSS (incl. worker processes)
+def benchmarkDriver(dir, script):
+
+    clearCaches(dir) # cold run, as the reference
+    t0 = time.time()
+    with open("%s/%s.log" % (dir, script), 'w') as log:
+        p = subprocess.Popen([sys.executable, os.path.abspath(script)], cwd = dir, stdout = log, stderr = subprocess.STDOUT)
+        pid, status, rusage = os.wait4(p.pid, 0)
+
+    if status != 0: sys.exit("Driver %s failed, see %s/%s.log" % (script, dir, script))
+    return {"time": time.time() - t0, "peakRSS": rusage.ru_maxrss / 1024.}
+
+
+# Input: current and reference results, tolerance (relative), absolute thresholds
+# Output: list of regressions
+def compare(results, reference, tolerance, thresholds):
+
+    regressions = []
+    for name in sorted(results):
+
+        for key, value in sorted(results[name].items()):
+
+            # throughputs must not decrease, time and memory must not increase (the stage time is covered by the throughputs)
+            if key == "time" and "eventsPerSecond" in results[name]: continue
+            higherIsBetter = key.endswith("PerSecond")
+
+            limit = thresholds.get(name, {}).get(key)
+            if limit is not None and ((higherIsBetter and value < limit) or (not higherIsBetter and value > limit)):
+                regressions.append("%s %s: %.4g (threshold %.4g)" % (name, key, value, limit))
+
+            ref = reference.get(name, {}).get(key)
+            if ref is None: continue
+            if (higherIsBetter and value < (1.0-tolerance)*ref) or (not higherIsBetter and value > (1.0+tolerance)*ref):
+                regressions.append("%s %s: %.4g (reference %.4g)" % (name, key, value, ref))
+
+    return regressions
+
+
+if __name__ == "__main__":
+
+    ## dir: directory where the synthetic scans are generated (re-used as long as the settings do not change)
+    dir = "benchmarkScans"
+
+    ## settings: synthetic scan settings (see syntheticScan.py), one scan per scan type
+    settings = {
+
+        "efficiency"    : dict(syntheticScan.settings, scanType = "efficiency", nEvents = 20000),
+        "noise"         : dict(syntheticScan.settings, scanType = "noise", nEvents = 5000, noiseRate = 50.),
+    }
+
+    ## HVPoint: HV point used for the stage benchmarks
+    HVPoint = 4
+
+    ## computeOnly: benchmark the stages without rendering (see Analyzer.setComputeOnly())
+    computeOnly = True
+
+    ## runDrivers: benchmark the complete driver scripts as well
+    runDrivers = True
+
+    ## reference: results of a previous benchmark, the benchmark fails if a result regresses by more than tolerance
+    reference = "%s/benchmark_reference.json" % dir
+    tolerance = 0.25
+    updateReference = False # store the current results as new reference
+
+    ## thresholds: absolute limits per benchmark, e.g. {"efficiency/clusterization": {"eventsPerSecond": 1e5}}
+    thresholds = {}
+
+    cfg = config.cfg_GRAPHITE_HIGH
+
+
+    ##############################################################################################
+    results = {}
+    for scanType in ["efficiency", "noise"]:
+
+        scanDir = "%s/%s" % (dir, scanType)
+        prepareScan(scanDir, settings[scanType], cfg)
+        scanid = settings[scanType]["scanid"]
+
+        # stage benchmark in a fresh process
+        pool = multiprocessing.Pool(1)
+        stageResults = pool.apply(benchmarkStages, ((scanDir, scanid, HVPoint, scanType, cfg, computeOnly),))
+        pool.close()
+        pool.join()
+        for stage in stageResults: results["%s/%s" % (scanType, stage)] = stageResults[stage]
+
+        if runDrivers: results["driver/%s" % scanType] = benchmarkDriver(scanDir, drivers[scanType])
+
+
+    # report
+    print "%-35s %10s %14s %14s %12s %14s" % ("Benchmark", "Time (s)", "Events/s", "Hits/s", "Peak RSS (MB)", "RSS so far (MB)")
+    for name in sorted(results):
+        r = results[name]
+        print "%-35s %10.3f %14s %14s %12s %14s" % (name, r["time"], "%.4g" % r["eventsPerSecond"] if "eventsPerSecond" in r else "-", "%.4g" % r["hitsPerSecond"] if "hitsPerSecond" in r else "-",
+            "%.1f" % r["peakRSS"] if "peakRSS" in r else "-", "%.1f" % r["peakRSSSoFar"] if "peakRSSSoFar" in r else "-")
+
+    with open("%s/benchmark.json" % dir, 'w') as f: json.dump(results, f, indent=4, sort_keys=True)
+
+    # compare with the reference and the thresholds
+    ref = {}
+    if os.path.exists(reference) and not updateReference:
+        with open(reference) as f: ref = json.load(f)
+    else:
+        with open(reference, 'w') as f: json.dump(results, f, indent=4, sort_keys=True)
+        print "Reference benchmark written to %s" % reference
+
+    regressions = compare(results, ref, tolerance, thresholds)
+    if len(regressions) > 0:
+        print "Performance regressions:"
+        for r in regressions: print " - %s" % r
+        sys.exit(1)
+    print "No performance regressions"
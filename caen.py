@@ -0,0 +1,91 @@
+
+import sys, os, json, multiprocessing
+
+
+## Scan-level reader of the CAEN monitoring files
+# The mean, RMS and number of entries of all the monitoring histograms (HVeff, HVapp, HVmon, Imon of each gap) of all the
+# HV points are read in one (parallel) pass and stored in a table, cached in Scan%06d_CAEN.json next to the CAEN files.
+# The cache entry of each file is keyed on its size and modification time, i.e. only new or changed files are read again.
+cacheVersion = 1
+
+
+# Output: mean, RMS and number of entries of all the histograms in a CAEN file, None if the file cannot be read
+def readCAENFile(fileName):
+
+    import ROOT
+    fIn = ROOT.TFile(fileName)
+    if not fIn or fIn.IsZombie(): return None
+
+    hists = {}
+    for key in fIn.GetListOfKeys():
+
+        if key.GetName() in hists: continue # older cycle of the same histogram
+        h = key.ReadObj()
+        if h.InheritsFrom("TH1"): hists[key.GetName()] = [h.GetMean(), h.GetRMS(), h.GetEntries()]
+
+    fIn.Close()
+    return hists
+
+
+# Input: scan directory, scan ID, list of HV points, number of files read in parallel
+# Output: table of the monitoring histograms, {HVPoint: {histogram name: [mean, RMS, entries]}}
+def loadScan(dir, scanid, HVPoints, nJobs = 1, useCache = True):
+
+    cacheFile = "%s/Scan%.6d_CAEN.json" % (dir, scanid)
+    cached = {}
+    if useCache:
+        try:
+            with open(cacheFile) as f: cached = json.load(f)
+        except (IOError, OSError, ValueError): pass
+        if cached.get("version") != cacheVersion: cached = {}
+    files = cached.get("files", {})
+
+    # read the new or changed files
+    fileNames = dict((HVPoint, "%s/Scan%.6d_HV%d_CAEN.root" % (dir, scanid, HVPoint)) for HVPoint in HVPoints)
+    fingerprints = dict((HVPoint, [os.stat(fileNames[HVPoint]).st_size, os.stat(fileNames[HVPoint]).st_mtime]) for HVPoint in HVPoints)
+    toRead = [HVPoint for HVPoint in HVPoints if files.get(os.path.basename(fileNames[HVPoint]), {}).get("fingerprint") != fingerprints[HVPoint]]
+
+    if nJobs > 1 and len(toRead) > 1:
+        pool = multiprocessing.Pool(min(nJobs, len(toRead)))
+        hists = pool.map(readCAENFile, [fileNames[HVPoint] for HVPoint in toRead])
+        pool.close()
+        pool.join()
+    else:
+        hists = [readCAENFile(fileNames[HVPoint]) for HVPoint in toRead]
+
+    for HVPoint, h in zip(toRead, hists):
+
+        if h is None: sys.exit("Cannot read CAEN file %s" % fileNames[HVPoint])
+        files[os.path.basename(fileNames[HVPoint])] = {"fingerprint": fingerprints[HVPoint], "hists": h}
+
+    # store the updated table (silently skipped if the directory is not writable)
+    if useCache and len(toRead) > 0:
+        tmpFile = "%s.tmp%d" % (cacheFile, os.getpid())
+        try:
+            with open(tmpFile, 'w') as f: json.dump({"version": cacheVersion, "files": files}, f, indent=4, sort_keys=True)
+            os.rename(tmpFile, cacheFile)
+        except (IOError, OSError):
+            if os.path.exists(tmpFile): os.remove(tmpFile)
+
+    return dict((HVPoint, files[os.path.basename(fileNames[HVPoint])]["hists"]) for HVPoint in HVPoints)
+
+
+# Input: table of the monitoring histograms (see loadScan), HV point, chamber configuration (gap names)
+# Output: effective HV and gap currents (mean and RMS) of the HV point
+def gapValues(table, HVPoint, cfg):
+
+    hists = table[HVPoint]
+    top, bot = cfg['topGapName'], cfg['botGapName']
+
+    HV, HV_err = hists["HVeff_%s" % top][0:2]
+    if HV < 20: HV, HV_err = hists["HVeff_%s" % bot][0:2] # top gap off
+
+    return {
+
+        "HV"                : HV,
+        "HV_err"            : HV_err,
+        "current_TOP"       : hists["Imon_%s" % top][0],
+        "current_TOP_err"   : hists["Imon_%s" % top][1],
+        "current_BOT"       : hists["Imon_%s" % bot][0],
+        "current_BOT_err"   : hists["Imon_%s" % bot][1],
+    }
@@ -80,10 +80,10 @@ if __name__ == "__main__":
     analyzer.stripProfile()
 
     maxY = -999
-    analyzer.setVerbose(0) # turn off plotting
+    clsList, cmpList = analyzer.clusterizationScan(times) # clusterization for all time constraints in one pass (no plots)
     for i,t in enumerate(times):
     
-        cls, cmp = analyzer.clusterization(t)
+        cls, cmp = clsList[i], cmpList[i]
         g_cls.SetPoint(i, t, cls)
         g_cmp.SetPoint(i, t, cmp)
         if cls > maxY: maxY = cls
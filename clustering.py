@@ -0,0 +1,95 @@
+
+import numpy as np
+
+
+## Clusterization of hits: two hits belong to the same cluster if they are on adjacent strips (|DS| == 1) and
+## close in time (|DT| < clusterTimeWindow), clusters are the connected components of this relation
+# All functions work on flat hit arrays (event index, strip index, time stamp) covering one or many events
+
+
+# Input: per-hit event index, strip index and time stamp, maximal time difference
+# Output: all pairs of hits (i, j) on adjacent strips of the same event with |DT| < maxTimeWindow, and their DT
+def adjacentPairs(event, strip, time, maxTimeWindow):
+
+    event = np.asarray(event, dtype=np.int64)
+    strip = np.asarray(strip, dtype=np.int64)
+    time = np.asarray(time, dtype=np.float64)
+    if len(time) == 0: return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+
+    # sort the hits by event, strip and time; group = (event, strip) such that group+1 is the next strip in the same event
+    order = np.lexsort((time, strip, event))
+    group = event[order]*(strip.max()+2) + strip[order]
+    ts = time[order]
+
+    # search the hits of the neighbouring strip inside the time window using a sorted (group, time) key
+    # the candidate ranges are taken slightly wider than the window, the exact conditions are applied afterwards
+    span = (ts.max() - ts.min()) + 2.0*maxTimeWindow + 1.0
+    key = group*span + (ts - ts.min())
+    slack = 4.0*np.spacing(np.abs(key).max() + span) + 1e-9
+    lo = np.searchsorted(key, key + span - maxTimeWindow - slack, side='left')
+    hi = np.searchsorted(key, key + span + maxTimeWindow + slack, side='right')
+
+    # expand the ranges into candidate pairs
+    counts = hi - lo
+    src = np.repeat(np.arange(len(ts)), counts)
+    dst = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+
+    dt = ts[src] - ts[dst]
+    sel = (group[dst] == group[src]+1) & (np.abs(dt) < maxTimeWindow)
+
+    return order[src[sel]], order[dst[sel]], dt[sel]
+
+
+# Input: number of hits, pairs of connected hits
+# Output: cluster label for each hit (index of the root hit of its cluster)
+def connectedComponents(nHits, i, j):
+
+    parent = np.arange(nHits)
+    i, j = np.asarray(i, dtype=np.int64), np.asarray(j, dtype=np.int64)
+
+    while True:
+
+        pi, pj = parent[i], parent[j]
+        sel = (pi != pj)
+        if not sel.any(): break
+        i, j, pi, pj = i[sel], j[sel], pi[sel], pj[sel] # pairs already in the same cluster stay there
+
+        # union: attach the larger root to the smaller one
+        np.minimum.at(parent, np.maximum(pi, pj), np.minimum(pi, pj))
+
+        # find: compress the trees until every hit points to its root
+        while True:
+            grandParent = parent[parent]
+            if np.array_equal(grandParent, parent): break
+            parent = grandParent
+
+    return parent
+
+
+# Input: per-hit event index, strip index and time stamp, cluster time constraint
+# Output: cluster label for each hit
+def clusterLabels(event, strip, time, clusterTimeWindow):
+
+    i, j, dt = adjacentPairs(event, strip, time, clusterTimeWindow)
+    return connectedComponents(len(time), i, j)
+
+
+# Input: per-hit event index, strip index and time stamp, list of cluster time constraints
+# Output: cluster labels for each time constraint, the hit pairs and their time differences are computed only once
+def multiClusterLabels(event, strip, time, clusterTimeWindows):
+
+    i, j, dt = adjacentPairs(event, strip, time, max(clusterTimeWindows))
+    absDT = np.abs(dt)
+    
+    return [connectedComponents(len(time), i[absDT < w], j[absDT < w]) for w in clusterTimeWindows]
+
+
+# Input: per-hit event index and cluster label, total number of events
+# Output: cluster multiplicity of each event, size and event index of each cluster
+def clusterStats(event, labels, nEvents):
+
+    roots, CLS = np.unique(labels, return_counts=True)
+    clusterEvent = np.asarray(event, dtype=np.int64)[roots]
+    CMP = np.bincount(clusterEvent, minlength=nEvents)
+
+    return CMP, CLS, clusterEvent
@@ -0,0 +1,205 @@
+
+import numpy as np
+
+
+# Input: values, axis definition (number of bins, lower and upper edge)
+# Output: bin number of each value following the ROOT convention (0: underflow, nBins+1: overflow)
+def findBins(values, nBins, xMin, xMax):
+
+    values = np.asarray(values, dtype=np.float64)
+    bins = np.empty(len(values), dtype=np.int64)
+
+    under, over = (values < xMin), (values >= xMax)
+    inside = ~(under | over)
+    bins[under] = 0
+    bins[over] = nBins+1
+    bins[inside] = 1 + (nBins*(values[inside]-xMin)/(xMax-xMin)).astype(np.int64)
+
+    return bins
+
+
+
+# Plain 1D histogram (bin contents in a NumPy array, same binning conventions as ROOT.TH1D)
+class Hist1D():
+
+    nBins = -1
+    xMin = -1
+    xMax = -1
+    counts = None   # bin contents, including underflow (bin 0) and overflow (bin nBins+1)
+    entries = 0     # number of filled values
+
+
+    def __init__(self, nBins, xMin, xMax):
+
+        self.nBins, self.xMin, self.xMax = int(nBins), float(xMin), float(xMax)
+        self.counts = np.zeros(self.nBins+2, dtype=np.float64)
+        self.entries = 0
+
+
+    def fill(self, values, weights = None):
+
+        if len(values) == 0: return
+        self.counts += np.bincount(findBins(values, self.nBins, self.xMin, self.xMax), weights, minlength=self.nBins+2)
+        self.entries += len(values)
+
+
+    def add(self, other):
+
+        self.counts += other.counts
+        self.entries += other.entries
+
+
+    def scale(self, factor):
+
+        self.counts *= factor
+
+
+    def centers(self):
+
+        return self.xMin + (np.arange(self.nBins) + 0.5)*(self.xMax-self.xMin)/self.nBins
+
+
+    def integral(self):
+
+        return self.counts[1:-1].sum()
+
+
+    def maximum(self):
+
+        return self.counts[1:-1].max()
+
+
+    # mean and RMS computed from the bin contents (excluding under/overflow)
+    def mean(self):
+
+        if self.integral() == 0: return 0.0
+        return (self.counts[1:-1]*self.centers()).sum() / self.integral()
+
+
+    def rms(self):
+
+        if self.integral() == 0: return 0.0
+        return np.sqrt(max((self.counts[1:-1]*self.centers()**2).sum() / self.integral() - self.mean()**2, 0.0))
+
+
+    def toTH1D(self, name, title):
+
+        import ROOT
+        h = ROOT.TH1D(name, title, self.nBins, self.xMin, self.xMax)
+        for b in np.nonzero(self.counts)[0]: h.SetBinContent(int(b), self.counts[b])
+        h.SetEntries(self.entries)
+        return h
+
+
+
+# Plain 2D histogram (bin contents in a NumPy array, same binning conventions as ROOT.TH2D)
+# Large, sparsely filled histograms (e.g. the time-strip profile of noise runs) can be stored sparse: only the filled bins
+# and their contents are kept, until the filled fraction exceeds maxSparseFraction (the histogram then turns dense)
+class Hist2D():
+
+    nBinsX, xMin, xMax = -1, -1, -1
+    nBinsY, yMin, yMax = -1, -1, -1
+    counts = None   # bin contents (nBinsX+2, nBinsY+2), including underflow/overflow (None if sparse)
+    bins = None     # sparse storage: flat index (binX*(nBinsY+2) + binY) of the filled bins, sorted
+    contents = None # sparse storage: contents of the filled bins
+    entries = 0
+    maxSparseFraction = 0.5 # sparse: 16 bytes per filled bin (index and content), dense: 8 bytes per bin
+
+
+    def __init__(self, nBinsX, xMin, xMax, nBinsY, yMin, yMax, sparse = False):
+
+        self.nBinsX, self.xMin, self.xMax = int(nBinsX), float(xMin), float(xMax)
+        self.nBinsY, self.yMin, self.yMax = int(nBinsY), float(yMin), float(yMax)
+        if sparse: self.bins, self.contents = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+        else: self.counts = np.zeros((self.nBinsX+2, self.nBinsY+2), dtype=np.float64)
+        self.entries = 0
+
+
+    def size(self):
+
+        return (self.nBinsX+2)*(self.nBinsY+2)
+
+
+    def fill(self, x, y, weights = None):
+
+        if len(x) == 0: return
+        binsX = findBins(x, self.nBinsX, self.xMin, self.xMax)
+        binsY = findBins(y, self.nBinsY, self.yMin, self.yMax)
+        flat = binsX*(self.nBinsY+2) + binsY
+
+        if self.counts is not None: self.counts += np.bincount(flat, weights, minlength=self.size()).reshape(self.counts.shape)
+        else:
+            bins, inverse = np.unique(flat, return_inverse=True) # turns dense if too many distinct bins are filled
+            self.__addSparse(bins, np.bincount(inverse, weights, minlength=len(bins)).astype(np.float64))
+
+        self.entries += len(x)
+
+
+    # merge filled bins into the sparse storage
+    def __addSparse(self, bins, contents):
+
+        bins, inverse = np.unique(np.concatenate([self.bins, bins]), return_inverse=True)
+        self.bins, self.contents = bins, np.bincount(inverse, np.concatenate([self.contents, contents]), minlength=len(bins))
+        if len(self.bins) > self.maxSparseFraction*self.size(): self.densify()
+
+
+    def densify(self):
+
+        if self.counts is not None: return
+        self.counts = self.dense()
+        self.bins, self.contents = None, None
+
+
+    # Output: bin contents (nBinsX+2, nBinsY+2), for both storages
+    def dense(self):
+
+        if self.counts is not None: return self.counts
+        counts = np.zeros(self.size(), dtype=np.float64)
+        counts[self.bins] = self.contents
+        return counts.reshape((self.nBinsX+2, self.nBinsY+2))
+
+
+    def add(self, other):
+
+        if self.counts is None and other.counts is None: self.__addSparse(other.bins, other.contents)
+        else:
+            self.densify()
+            if other.counts is not None: self.counts += other.counts
+            else: self.counts.flat[other.bins] += other.contents
+        self.entries += other.entries
+
+
+    def toTH2D(self, name, title):
+
+        import ROOT
+        h = ROOT.TH2D(name, title, self.nBinsX, self.xMin, self.xMax, self.nBinsY, self.yMin, self.yMax)
+        h.SetContent(np.ascontiguousarray(self.dense().T).ravel()) # ROOT global bin = binX + (nBinsX+2)*binY
+        h.SetEntries(self.entries)
+        return h
+
+
+
+# Merge two partial results of the same kind: histograms, numbers, distributions given as arrays of counts (padded to
+# the longest array along the first axis), dicts, or tuples/lists of those; None stands for an empty partial result
+def merge(a, b):
+
+    if a is None: return b
+    if b is None: return a
+
+    if isinstance(a, (Hist1D, Hist2D)):
+        a.add(b)
+        return a
+
+    if isinstance(a, np.ndarray):
+        out = np.zeros((max(len(a), len(b)),) + a.shape[1:], dtype=np.result_type(a, b))
+        out[:len(a)] += a
+        out[:len(b)] += b
+        return out
+
+    if isinstance(a, dict):
+        a.update(b)
+        return a
+
+    if isinstance(a, (tuple, list)): return type(a)(merge(x, y) for x, y in zip(a, b))
+
+    return a + b
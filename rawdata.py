@@ -0,0 +1,354 @@
+
+import os, json, shutil, hashlib, array, pickle
+import numpy as np
+
+
+cacheVersion = 1 # increase when the cache layout changes, older caches are then rebuilt
+
+
+# Columnar representation of the RAWData tree of one DAQ file
+# All hits are stored in flat arrays, the hits of event i are found in the range offsets[i]:offsets[i+1]
+class RawData():
+
+    nEvents = 0
+    first = 0       # entry number of the first event (block of events, see iterFile)
+    offsets = None  # per-event hit offsets (length nEvents+1)
+    channel = None  # TDC channel of each hit
+    time = None     # TDC time stamp of each hit (ns)
+    qFlag = None    # quality flag of each event
+    valid = None            # valid event mask, decoded once from the quality flags
+    nCorruptedPerTDC = None # number of corrupted events per TDC
+
+
+    def __init__(self, offsets, channel, time, qFlag, valid = None, nCorruptedPerTDC = None):
+
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.channel = np.asarray(channel, dtype=np.int32)
+        self.time = np.asarray(time, dtype=np.float64)
+        self.qFlag = np.asarray(qFlag, dtype=np.int64)
+        self.nEvents = len(self.qFlag)
+        
+        if valid is None: self.valid, self.nCorruptedPerTDC = decodeQualityFlag(self.qFlag)
+        else: self.valid, self.nCorruptedPerTDC = np.asarray(valid, dtype=bool), np.asarray(nCorruptedPerTDC, dtype=np.int64)
+
+
+    # Input: event number
+    # Output: TDC channels and time stamps of all the hits in the event
+    def hits(self, evNum):
+
+        begin, end = self.offsets[evNum], self.offsets[evNum+1]
+        return self.channel[begin:end], self.time[begin:end]
+
+
+    # Output: event number of each hit
+    def hitEvent(self):
+
+        return np.repeat(np.arange(self.nEvents), np.diff(self.offsets))
+
+
+    def nHits(self):
+
+        return len(self.channel)
+
+
+    # Input: event range [first, last)
+    # Output: RawData of the events in the range (views on the arrays, no copy)
+    # The valid event mask is sliced, only the flags of the corrupted events are decoded again (corrupted events per TDC)
+    def block(self, first, last):
+
+        begin, end = self.offsets[first], self.offsets[last]
+        valid = self.valid[first:last]
+        nCorruptedPerTDC = decodeQualityFlag(self.qFlag[first:last][~valid])[1]
+        data = RawData(self.offsets[first:last+1] - begin, self.channel[begin:end], self.time[begin:end], self.qFlag[first:last], valid, nCorruptedPerTDC)
+        data.first = self.first + first
+        return data
+
+
+
+## Quality flag validation for all the events at once
+# see implementation Alexis: https://github.com/afagot/GIF_OfflineAnalysis/blob/master/src/utils.cc
+# Each decimal digit of the flag holds the status of one TDC (digit k <-> TDC k), the event is corrupted if any digit equals 2
+# Negative flags are not valid DAQ flags: these events are rejected (not counted per TDC)
+# Output: boolean mask of valid events, number of corrupted events per TDC
+def decodeQualityFlag(qFlag):
+
+    flags = np.array(qFlag, dtype=np.int64)
+    valid = flags >= 0
+    flags[~valid] = 0
+    nCorruptedPerTDC = []
+
+    while flags.any():
+
+        corrupted = (flags % 10 == 2)
+        valid &= ~corrupted
+        nCorruptedPerTDC.append(np.count_nonzero(corrupted))
+        flags //= 10
+
+    return valid, np.array(nCorruptedPerTDC, dtype=np.int64)
+
+
+
+# Read the TDC_channel, TDC_TimeStamp and Quality_flag branches in one single pass over the tree
+# Only the needed branches are decoded, the event range [first, last) can be restricted
+def loadTree(t, first = 0, last = -1):
+
+    if last == -1 or last > t.GetEntries(): last = t.GetEntries()
+
+    t.SetBranchStatus("*", 0)
+    for br in ["TDC_channel", "TDC_TimeStamp", "Quality_flag"]: t.SetBranchStatus(br, 1)
+
+    channel = array.array('i')
+    time = array.array('d')
+    qFlag = array.array('l')
+    offsets = array.array('l', [0])
+
+    for evNum in range(first, last):
+
+        t.GetEntry(evNum)
+        channel.extend(t.TDC_channel)
+        time.extend(t.TDC_TimeStamp)
+        qFlag.append(t.Quality_flag)
+        offsets.append(len(channel))
+
+    t.SetBranchStatus("*", 1)
+
+    data = RawData(np.frombuffer(offsets, dtype=np.dtype('l')), np.frombuffer(channel, dtype=np.dtype('i')), np.frombuffer(time, dtype=np.float64), np.frombuffer(qFlag, dtype=np.dtype('l')))
+    data.first = first
+    return data
+
+
+
+## Streaming mode: the events of a DAQ file are read in blocks which fit in a given memory budget
+# The memory needed per hit covers the raw arrays and the intermediate arrays of the analysis (hit selection, clustering)
+bytesPerHit = 200
+firstBlockSize = 1000 # number of events of the first block read from the ROOT file, used to estimate the number of hits per event
+
+
+# Input: DAQ file name, memory budget (MB, -1: one single block), event range [first, last) (-1: up to the last event)
+# Output: generator of RawData blocks, covering all the events of the range in order
+def iterFile(fileName, memoryBudget, useCache = True, first = 0, last = -1):
+
+    maxHits = max(int(memoryBudget*1024*1024 / bytesPerHit), 1) if memoryBudget > 0 else -1
+
+    # up-to-date cache: memory-mapped arrays, cut in blocks of at most maxHits hits
+    data = loadCache(fileName, fileName + ".cache") if useCache else None
+    if data is not None:
+
+        if last == -1 or last > data.nEvents: last = data.nEvents
+        while first < last:
+
+            end = last
+            if maxHits != -1: end = min(max(int(np.searchsorted(data.offsets, data.offsets[first] + maxHits, side='right')) - 1, first+1), last)
+            yield data.block(first, end)
+            first = end
+
+        return
+
+    # no cache: decode the ROOT file block by block, the block size follows from the mean number of hits per event so far
+    import ROOT
+    fIn = ROOT.TFile(fileName)
+    t = fIn.Get("RAWData")
+    if last == -1 or last > t.GetEntries(): last = t.GetEntries()
+
+    begin, nHits = first, 0
+    while first < last:
+
+        end = last
+        if maxHits != -1 and first == begin: end = min(first + firstBlockSize, last)
+        elif maxHits != -1: end = min(first + max(int(maxHits * (first-begin) / max(nHits, 1)), 1), last)
+        block = loadTree(t, first, end)
+        nHits += block.nHits()
+        yield block
+        first = end
+
+    fIn.Close()
+
+
+# Output: number of events in a DAQ file (read from the cache if up to date)
+def countEvents(fileName, useCache = True):
+
+    data = loadCache(fileName, fileName + ".cache") if useCache else None
+    if data is not None: return data.nEvents
+
+    import ROOT
+    fIn = ROOT.TFile(fileName)
+    nEvents = fIn.Get("RAWData").GetEntries()
+    fIn.Close()
+    return nEvents
+
+
+
+## Decoded-hit cache
+# The decoded arrays of a DAQ file are stored next to it in the directory <file>.cache/ as .npy files, which are
+# memory-mapped when loaded. The cache is keyed on the size, modification time and SHA-1 hash of the source file
+# and is rebuilt automatically when the source file changes.
+cacheArrays = ["offsets", "channel", "time", "qFlag", "valid", "nCorruptedPerTDC"]
+
+
+# Load the raw data of a DAQ file, from its cache if up to date (the ROOT file is not opened in that case)
+def loadFile(fileName, useCache = True):
+
+    cacheDir = fileName + ".cache"
+    if useCache:
+        data = loadCache(fileName, cacheDir)
+        if data is not None: return data
+
+    import ROOT # only needed to decode the DAQ file, not to read the cache
+    fIn = ROOT.TFile(fileName)
+    data = loadTree(fIn.Get("RAWData"))
+    fIn.Close()
+
+    if useCache: saveCache(fileName, cacheDir, data)
+    return data
+
+
+# Output: size, modification time and (optionally) SHA-1 hash of a file
+def fileFingerprint(fileName, withHash = True):
+
+    st = os.stat(fileName)
+    fingerprint = {"version": cacheVersion, "size": st.st_size, "mtime": st.st_mtime}
+    if withHash:
+
+        sha1 = hashlib.sha1()
+        with open(fileName, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b""): sha1.update(block)
+        fingerprint["sha1"] = sha1.hexdigest()
+
+    return fingerprint
+
+
+# Output: fingerprint of a file, the hash is taken from the cache if the size and modification time are unchanged
+# The fingerprint is stored in <file>.cache/source.json as well, such that it is hashed once even without decoded-hit cache
+# (streaming mode); fingerprint.json is only written together with the decoded arrays (see saveCache)
+def fingerprint(fileName):
+
+    current = fileFingerprint(fileName, withHash = False)
+    for name in ["fingerprint.json", "source.json"]:
+
+        try:
+            with open("%s.cache/%s" % (fileName, name)) as f: cached = json.load(f)
+        except (IOError, OSError, ValueError): continue
+        if "sha1" in cached and all(cached.get(k) == current[k] for k in current): return cached
+
+    current = fileFingerprint(fileName)
+    tmpFile = "%s.cache/source.json.tmp%d" % (fileName, os.getpid())
+    try:
+        if not os.path.exists(fileName + ".cache"): os.makedirs(fileName + ".cache")
+        with open(tmpFile, 'w') as f: json.dump(current, f, indent=4)
+        os.rename(tmpFile, "%s.cache/source.json" % fileName)
+    except (IOError, OSError):
+        if os.path.exists(tmpFile): os.remove(tmpFile)
+
+    return current
+
+
+# Output: RawData with memory-mapped arrays, None if no valid cache exists
+def loadCache(fileName, cacheDir):
+
+    try:
+        with open("%s/fingerprint.json" % cacheDir) as f: cached = json.load(f)
+    except (IOError, OSError, ValueError): return None
+
+    # size and modification time unchanged: cache valid; otherwise compare the content hash
+    current = fileFingerprint(fileName, withHash = False)
+    if cached.get("version") != current["version"] or cached.get("size") != current["size"]: return None
+    if cached.get("mtime") != current["mtime"]:
+
+        current = fileFingerprint(fileName)
+        if cached.get("sha1") != current["sha1"]: return None
+        try:
+            with open("%s/fingerprint.json" % cacheDir, 'w') as f: json.dump(current, f, indent=4)
+        except (IOError, OSError): pass
+
+    try:
+        arrays = dict((name, np.load("%s/%s.npy" % (cacheDir, name), mmap_mode='r')) for name in cacheArrays)
+    except (IOError, OSError, ValueError): return None
+
+    return RawData(arrays["offsets"], arrays["channel"], arrays["time"], arrays["qFlag"], arrays["valid"], arrays["nCorruptedPerTDC"])
+
+
+# Output: True if the decoded hits of a DAQ file are read from its cache, or can be cached at the first read (i.e. a later
+# pass over the file does not decode the ROOT file again); False e.g. for a read-only data directory without cache
+def cacheAvailable(fileName):
+
+    if loadCache(fileName, fileName + ".cache") is not None: return True
+    return os.access(os.path.dirname(os.path.abspath(fileName)), os.W_OK)
+
+
+# Write the cache of a DAQ file (silently skipped if the directory is not writable)
+def saveCache(fileName, cacheDir, data):
+
+    tmpDir = "%s.tmp%d" % (cacheDir, os.getpid())
+    try:
+
+        if os.path.exists(tmpDir): shutil.rmtree(tmpDir)
+        os.makedirs(tmpDir)
+        for name in cacheArrays: np.save("%s/%s.npy" % (tmpDir, name), getattr(data, name))
+        with open("%s/fingerprint.json" % tmpDir, 'w') as f: json.dump(fileFingerprint(fileName), f, indent=4)
+
+        # replace the old cache at once, such that readers never see a partially written cache (the stage results are kept,
+        # they are keyed on the file hash)
+        if os.path.exists("%s/stages" % cacheDir): os.rename("%s/stages" % cacheDir, "%s/stages" % tmpDir)
+        if os.path.exists(cacheDir): shutil.rmtree(cacheDir)
+        os.rename(tmpDir, cacheDir)
+
+    except (IOError, OSError):
+
+        if os.path.exists(tmpDir): shutil.rmtree(tmpDir, ignore_errors = True)
+
+
+
+## Stage results cache
+# The results of the analysis stages (see Analyzer.__runStages) are stored as pickle files in <file>.cache/stages/,
+# one file per key. The key covers the file fingerprint, such that outdated results are never used.
+# The least recently used results are removed when the stored results of a file exceed stageCacheBudget
+stageCacheBudget = 500 # MB per DAQ file
+
+# Output: the stored results, None if not available
+def loadStage(fileName, key):
+
+    stageFile = "%s.cache/stages/%s.pkl" % (fileName, key)
+    try:
+        with open(stageFile, 'rb') as f: results = pickle.load(f)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError): return None
+
+    try: os.utime(stageFile, None) # recently used
+    except OSError: pass
+    return results
+
+
+# Store the results of a stage (silently skipped if the directory is not writable)
+def saveStage(fileName, key, results):
+
+    stageDir = "%s.cache/stages" % fileName
+    tmpFile = "%s/%s.tmp%d" % (stageDir, key, os.getpid())
+    try:
+
+        if not os.path.exists(stageDir): os.makedirs(stageDir)
+        with open(tmpFile, 'wb') as f: pickle.dump(results, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpFile, "%s/%s.pkl" % (stageDir, key)) # readers never see a partially written file
+        evictStages(stageDir, key)
+
+    except (IOError, OSError):
+
+        if os.path.exists(tmpFile): os.remove(tmpFile)
+
+
+# Remove the least recently used stage results until the stage results fit in stageCacheBudget (the given key is kept)
+def evictStages(stageDir, key):
+
+    files = []
+    for name in os.listdir(stageDir):
+
+        if not name.endswith(".pkl") or name == "%s.pkl" % key: continue
+        try: st = os.stat("%s/%s" % (stageDir, name))
+        except OSError: continue # removed by another process
+        files.append((st.st_mtime, st.st_size, name))
+
+    total = sum(size for mtime, size, name in files) + os.path.getsize("%s/%s.pkl" % (stageDir, key))
+    for mtime, size, name in sorted(files):
+
+        if total <= stageCacheBudget*1024*1024: break
+        try: os.remove("%s/%s" % (stageDir, name))
+        except OSError: pass
+        total -= size
@@ -0,0 +1,525 @@
+
+import sys, multiprocessing
+import ROOT
+import numpy as np
+
+ROOT.gROOT.SetBatch()
+ROOT.gStyle.SetOptStat(0)
+ROOT.gStyle.SetOptTitle(0)
+
+
+## Rendering of the analyzer results (see Analyzer.render())
+# All draw functions take the plain results (product) of one analysis stage and a dict with the info of the HV point:
+# scanid, HVPoint, savePath, verbose (plots only saved if > 0, except the hit profiles and noise maps), formats and textCMS
+
+
+canvases = {} # canvases are only created when something is drawn
+outputFormats = {"png": ["png"], "pdf": ["pdf"], "both": ["png", "pdf"], "none": []} # file types of each output format setting
+
+## Render queue (see Analyzer.setRenderJobs())
+# The plots are drawn by a pool of worker processes while the analysis continues; the draw functions only get plain
+# results (see histograms.py), which are sent to the workers. Without queue, the plots are drawn immediately.
+queue = None    # pool of worker processes
+pending = []    # submitted plots (to wait for them, errors of the workers are raised by finishQueue)
+
+
+# Input: number of worker processes (<= 0: no queue)
+def startQueue(nJobs):
+
+    global queue
+    if queue is not None or nJobs <= 0: return
+    if multiprocessing.current_process().daemon: return # no worker processes inside a worker process
+    queue = multiprocessing.Pool(nJobs)
+
+
+# Draw the results of an analysis stage (name: drawing function without prefix, e.g. timeProfile), in the queue if started
+def submit(name, product, info):
+
+    if queue is None: draw(name, product, info)
+    else: pending.append(queue.apply_async(draw, (name, product, info)))
+
+
+def draw(name, product, info):
+
+    getattr(sys.modules[__name__], "draw%s" % (name[0].upper() + name[1:]))(product, info)
+
+
+# Wait for all the submitted plots and stop the queue
+def finishQueue():
+
+    global queue, pending
+    if queue is None: return
+    for p in pending: p.get()
+    queue.close()
+    queue.join()
+    queue, pending = None, []
+
+
+# Save a canvas in the given output formats (see outputFormats), fileName without extension
+def save(c, fileName, formats):
+
+    for ext in outputFormats[formats]: c.SaveAs("%s.%s" % (fileName, ext))
+
+
+# Input: canvas name, c1: default square canvas, c2: default rectangular canvas
+def getCanvas(name):
+
+    if name in canvases: return canvases[name]
+
+    if name == "c1":
+
+        c = ROOT.TCanvas("c1", "c1", 800, 800)
+        c.SetLeftMargin(0.12)
+        c.SetRightMargin(0.05)
+        c.SetTopMargin(0.05)
+        c.SetBottomMargin(0.1)
+
+    else:
+
+        c = ROOT.TCanvas("c2", "c2", 900, 1200)
+        c.SetLeftMargin(0.12)
+        c.SetRightMargin(0.13)
+        c.SetTopMargin(0.05)
+        c.SetBottomMargin(0.1)
+
+    canvases[name] = c
+    return c
+
+
+def drawAux(c, info, aux = ""):
+
+    textLeft = ROOT.TLatex()
+    textLeft.SetTextFont(42)
+    textLeft.SetTextSize(0.04)
+    textLeft.SetNDC()
+    textLeft.DrawLatex(c.GetLeftMargin(), 0.96, info["textCMS"])
+
+    textRight = ROOT.TLatex()
+    textRight.SetNDC()
+    textRight.SetTextFont(42)
+    textRight.SetTextSize(0.04)
+    textRight.SetTextAlign(31)
+    if aux == "": textRight.DrawLatex(1.0-c.GetRightMargin(), 0.96, "S%d/HV%d" % (info["scanid"], info["HVPoint"]))
+    else: textRight.DrawLatex(1.0-c.GetRightMargin(), 0.96, "S%d/HV%d/%s" % (info["scanid"], info["HVPoint"], aux))
+
+
+# Fill a ROOT histogram with all the values of an array at once
+def fillN(h, values, weights = None):
+
+    if len(values) == 0: return
+    values = np.asarray(values, dtype=np.float64)
+    weights = np.ones(len(values)) if weights is None else np.asarray(weights, dtype=np.float64)
+    h.FillN(len(values), values, weights)
+
+
+# Fill a 2D ROOT histogram with all the (x, y) values at once
+def fillN2(h, x, y):
+
+    if len(x) == 0: return
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    h.FillN(len(x), x, y, np.ones(len(x)))
+
+
+
+def drawTimeStripProfile2D(product, info):
+
+    #ROOT.gStyle.SetPalette(ROOT.kDarkRainBow)
+
+    c2 = getCanvas("c2")
+    c2.cd()
+    c2.Clear()
+
+    hist, scale, strips = product["hist"], product["scale"], product["strips"]
+    timeStripProfile = hist.toTH2D("timeStripProfile", "Time-strip profile")
+
+    # loop over all strips: set the y-axis label
+    for i in range(1, len(strips)+1): timeStripProfile.GetYaxis().SetBinLabel(i, str(strips[i-1]))
+
+    timeStripProfile.GetXaxis().SetRangeUser(hist.xMin, hist.xMax)
+    if scale == 1000.: timeStripProfile.GetXaxis().SetTitle("Time (#mus)")
+    else: timeStripProfile.GetXaxis().SetTitle("Time (ns)")
+    timeStripProfile.GetXaxis().SetTitleOffset(1.0)
+    timeStripProfile.GetXaxis().SetLabelOffset(0.0)
+
+    timeStripProfile.GetYaxis().SetTitle("Strip number")
+    timeStripProfile.GetYaxis().SetTitleOffset(1.3)
+    timeStripProfile.GetYaxis().SetLabelOffset(0.005)
+
+    timeStripProfile.Draw("COLZ")
+
+    drawAux(c2, info)
+    c2.RedrawAxis()
+    c2.Modify()
+    if info["verbose"] > 0:
+        save(c2, "%stimeStripProfile2D" % info["savePath"], info["formats"])
+
+
+# Draw the noise rate per strip versus time inside the noise window and versus event number (see Analyzer.noiseMap)
+def drawNoiseMap(product, info):
+
+    c2 = getCanvas("c2")
+    strips = product["strips"]
+    xTitle = "Time (#mus)" if product["scale"] == 1000. else "Time (ns)"
+
+    for name, fileName, title in [("time", "noiseMapTime", xTitle), ("events", "noiseMapEvents", "Event number")]:
+
+        c2.cd()
+        c2.Clear()
+
+        noiseMap = product[name].toTH2D(fileName, "Noise map")
+        for i in range(1, len(strips)+1): noiseMap.GetYaxis().SetBinLabel(i, str(strips[i-1]))
+
+        noiseMap.GetXaxis().SetTitle(title)
+        noiseMap.GetXaxis().SetTitleOffset(1.0)
+        noiseMap.GetYaxis().SetTitle("Strip number")
+        noiseMap.GetYaxis().SetTitleOffset(1.3)
+        noiseMap.GetYaxis().SetLabelOffset(0.005)
+        noiseMap.GetZaxis().SetTitle("Noise rate (Hz/cm^{2})")
+        noiseMap.GetZaxis().SetTitleOffset(1.4)
+        noiseMap.Draw("COLZ")
+
+        drawAux(c2, info)
+        c2.RedrawAxis()
+        c2.Modify()
+        save(c2, "%s%s" % (info["savePath"], fileName), info["formats"])
+
+
+def drawTimeProfile(product, info):
+
+    c1 = getCanvas("c1")
+    hist = product["hist"]
+    timeProfile = hist.toTH1D("timeProfile", "Time profile")
+
+    # efficiency scan: raw profile, fit and muon/noise windows
+    if "muonWindowMean" in product:
+
+        c1.cd()
+        c1.Clear()
+
+        leg = ROOT.TLegend(.65, 0.75, .95, .93)
+        leg.SetBorderSize(0)
+        leg.SetTextSize(0.03)
+        leg.SetFillStyle(0)
+
+        timeProfile.Draw("HIST")
+        timeProfile.GetYaxis().SetRangeUser(0, 1.3*timeProfile.GetMaximum())
+        timeProfile.SetLineColor(ROOT.kBlack)
+
+        if product["fitParams"] is not None:
+
+            peakFitDraw = ROOT.TF1("tmp1", "gaus", hist.xMin, hist.xMax)
+            peakFitDraw.SetParameters(*product["fitParams"])
+            peakFitDraw.Draw("L SAME")
+            peakFitDraw.SetLineColor(ROOT.kRed)
+            peakFitDraw.GetXaxis().SetRangeUser(product["muonTimeWindowBegin"], product["muonTimeWindowEnd"])
+            peakFitDraw.SetLineWidth(2)
+
+        muonTimeWindowArea = ROOT.TGraph(4)
+        muonTimeWindowArea.SetPoint(0, product["muonTimeWindowBegin"], 0)
+        muonTimeWindowArea.SetPoint(1, product["muonTimeWindowEnd"], 0)
+        muonTimeWindowArea.SetPoint(2, product["muonTimeWindowEnd"], 0.3*timeProfile.GetMaximum())
+        muonTimeWindowArea.SetPoint(3, product["muonTimeWindowBegin"], 0.3*timeProfile.GetMaximum())
+        muonTimeWindowArea.SetFillStyle(3354)
+        muonTimeWindowArea.SetFillColor(ROOT.kRed)
+        muonTimeWindowArea.SetLineColor(ROOT.kRed)
+        muonTimeWindowArea.SetFillColorAlpha(ROOT.kRed, 0.5)
+        muonTimeWindowArea.Draw("F SAME")
+
+        noiseTimeWindowArea = ROOT.TGraph(4)
+        noiseTimeWindowArea.SetPoint(0, product["noiseTimeWindowBegin"], 0)
+        noiseTimeWindowArea.SetPoint(1, product["noiseTimeWindowEnd"], 0)
+        noiseTimeWindowArea.SetPoint(2, product["noiseTimeWindowEnd"], 0.3*timeProfile.GetMaximum())
+        noiseTimeWindowArea.SetPoint(3, product["noiseTimeWindowBegin"], 0.3*timeProfile.GetMaximum())
+        noiseTimeWindowArea.SetFillStyle(3354)
+        noiseTimeWindowArea.SetFillColor(ROOT.kBlue)
+        noiseTimeWindowArea.SetLineColor(ROOT.kBlue)
+        noiseTimeWindowArea.SetFillColorAlpha(ROOT.kBlue, 0.5)
+        noiseTimeWindowArea.Draw("F SAME")
+
+        timeProfile.GetXaxis().SetTitle("Time (ns)")
+        timeProfile.GetXaxis().SetTitleOffset(1.2)
+        timeProfile.GetXaxis().SetLabelOffset(0.005)
+
+        timeProfile.GetYaxis().SetTitle("Hits / ns")
+        timeProfile.GetYaxis().SetTitleOffset(1.8)
+        timeProfile.GetYaxis().SetLabelOffset(0.005)
+
+        fitParams = ROOT.TLatex()
+        fitParams.SetTextFont(42)
+        fitParams.SetTextSize(0.03)
+        fitParams.SetNDC()
+        fitParams.DrawLatex(0.16, 0.9, "#color[2]{Peak mean: %.2f ns}" % product["muonWindowMean"])
+        fitParams.DrawLatex(0.16, 0.85, "#color[2]{Peak width (#sigma): %.2f ns}" % product["muonWindowSigma"])
+        fitParams.DrawLatex(0.16, 0.8, "#color[2]{Muon window (2#times%d#sigma): %.2f ns}" % (product["muonWindowWidth"], 6.0*product["muonWindowSigma"]))
+
+        leg.AddEntry(timeProfile, "Raw data", "L")
+        leg.AddEntry(muonTimeWindowArea, "Muon window", "F")
+        leg.AddEntry(noiseTimeWindowArea, "Noise window", "F")
+        leg.Draw()
+
+
+        drawAux(c1, info)
+        c1.RedrawAxis()
+        c1.Modify()
+        if info["verbose"] > 0:
+            save(c1, "%stimeProfile" % info["savePath"], info["formats"])
+
+    # noise scan: raw profile
+    else:
+
+        c1.cd()
+        c1.Clear()
+
+        timeProfile.Draw("HIST")
+        timeProfile.GetYaxis().SetRangeUser(0, 1.3*timeProfile.GetMaximum())
+        timeProfile.SetLineColor(ROOT.kBlack)
+
+        if product["scale"] == 1000.: timeProfile.GetXaxis().SetTitle("Time (#mus)")
+        else: timeProfile.GetXaxis().SetTitle("Time (ns)")
+        timeProfile.GetXaxis().SetTitleOffset(1.2)
+        timeProfile.GetXaxis().SetLabelOffset(0.005)
+
+        timeProfile.GetYaxis().SetTitle("Hits")
+        timeProfile.GetYaxis().SetTitleOffset(1.8)
+        timeProfile.GetYaxis().SetLabelOffset(0.005)
+
+        drawAux(c1, info)
+        c1.RedrawAxis()
+        c1.Modify()
+        if info["verbose"] > 0:
+            save(c1, "%stimeProfile" % info["savePath"], info["formats"])
+
+
+# Draw one strip profile (hit profiles are always saved)
+def drawHitProfile(hist, strips, info, fileName, yTitle, text, noExponent = True):
+
+    c1 = getCanvas("c1")
+    c1.cd()
+    c1.Clear()
+
+    stripProfile = hist.toTH1D(fileName, text)
+    for i in range(1, len(strips)+1): stripProfile.GetXaxis().SetBinLabel(i, str(strips[i-1]))
+
+    if noExponent: stripProfile.GetYaxis().SetNoExponent()
+    stripProfile.SetFillStyle(3354)
+    stripProfile.SetFillColor(ROOT.kBlue)
+    stripProfile.SetFillColorAlpha(ROOT.kBlue, 0.35)
+    stripProfile.SetLineColor(ROOT.kBlue)
+    stripProfile.SetLineWidth(2)
+    stripProfile.Draw("HIST")
+
+    stripProfile.GetYaxis().SetRangeUser(0, 1.3*stripProfile.GetMaximum())
+    stripProfile.GetXaxis().SetTitle("Strip number")
+    stripProfile.GetXaxis().SetTitleOffset(1.2)
+    stripProfile.GetXaxis().SetLabelOffset(0.005)
+    stripProfile.GetXaxis().SetLabelSize(0.04)
+
+    stripProfile.GetYaxis().SetTitle(yTitle)
+    stripProfile.GetYaxis().SetTitleOffset(1.8)
+    stripProfile.GetYaxis().SetLabelOffset(0.005)
+
+    tLatex = ROOT.TLatex()
+    tLatex.SetTextFont(42)
+    tLatex.SetTextSize(0.03)
+    tLatex.SetNDC()
+    tLatex.DrawLatex(0.16, 0.9, text)
+
+    drawAux(c1, info)
+    c1.RedrawAxis()
+    c1.Modify()
+    save(c1, "%s%s" % (info["savePath"], fileName), info["formats"])
+
+
+def drawStripProfile(product, info):
+
+    strips = product["strips"]
+    drawHitProfile(product["all"], strips, info, "allHitProfile", "Number of hits", "Hit profile (all hits)")
+
+    if product["muon"] is not None:
+        drawHitProfile(product["muon"], strips, info, "muonHitProfile", "Number of hits", "Muon hit profile (hits inside muon window)")
+
+    if product["noise"] is not None:
+        drawHitProfile(product["noise"], strips, info, "noiseProfile", "Noise rate (Hz/cm^{2})", "Mean noise rate: %.2f Hz/cm^{2}" % product["meanNoise"], False)
+
+
+# Draw one normalized CLS/CMP distribution
+def drawClusterDistribution(h, info, fileName, xTitle, xMax, texts):
+
+    c1 = getCanvas("c1")
+    c1.cd()
+    c1.Clear()
+
+    if h.Integral() > 1: h.Scale(1.0/h.Integral())
+
+    h.Draw("HIST ")
+    h.SetLineColor(ROOT.kBlue)
+    h.GetYaxis().SetRangeUser(0, 1.3*h.GetMaximum())
+    h.GetXaxis().SetRangeUser(0, 1.1*xMax)
+    h.SetLineWidth(2)
+
+    h.GetXaxis().SetTitle(xTitle)
+    h.GetXaxis().SetTitleOffset(1.2)
+    h.GetXaxis().SetLabelOffset(0.005)
+
+    h.GetYaxis().SetTitle("Events (normalized)")
+    h.GetYaxis().SetTitleOffset(1.8)
+    h.GetYaxis().SetLabelOffset(0.005)
+
+    params = ROOT.TLatex()
+    params.SetTextFont(42)
+    params.SetTextSize(0.03)
+    params.SetNDC()
+    for i,text in enumerate(texts): params.DrawLatex(0.16, 0.9-0.05*i, text)
+
+    drawAux(c1, info)
+    c1.RedrawAxis()
+    c1.Modify()
+    if info["verbose"] > 0:
+        save(c1, "%s%s" % (info["savePath"], fileName), info["formats"])
+
+
+def drawClusterization(product, info):
+
+    CMP, CLS, CLS_cmp1 = product["CMP"], product["CLS"], product["CLS_cmp1"]
+
+    h_clustersize = ROOT.TH1D("clustersize", "Cluster size", 1000, 0, 1000)
+    h_clustersize_cmp = ROOT.TH1D("clustersize_cmp1", "Cluster size (CMP==1)", 1000, 0, 1000)
+    h_clustermultiplicity = ROOT.TH1D("clustermultiplicity", "Cluster multiplicity", 1000, 0, 1000)
+
+    # the products are count distributions (number of events/clusters per CMP/CLS value)
+    fillN(h_clustermultiplicity, np.arange(len(CMP)), CMP)
+    fillN(h_clustersize, np.arange(len(CLS)), CLS)
+    fillN(h_clustersize_cmp, np.arange(len(CLS_cmp1)), CLS_cmp1)
+
+    maxCMP = len(CMP)-1 if CMP.sum() > 0 else -99
+    maxCLS = len(CLS)-1 if CLS.sum() > 0 else -99
+
+    # store the mean CLS BEFORE change of axis range!
+    cls, cmp = h_clustersize.GetMean(), h_clustermultiplicity.GetMean()
+    cls_cmp1 = h_clustersize_cmp.GetMean()
+
+    drawClusterDistribution(h_clustermultiplicity, info, "CMP_muon", "Cluster multiplicity", maxCMP, ["Mean muon cluster multiplicity (CMP): %.2f" % cmp])
+    drawClusterDistribution(h_clustersize, info, "CLS_muon", "Cluster size", maxCLS, ["Mean muon cluster size (CLS): %.2f" % cls])
+    drawClusterDistribution(h_clustersize_cmp, info, "CLS_muon_CMP1", "Cluster size (CMP==1)", maxCLS, ["Mean muon cluster size (CLS): %.2f" % cls_cmp1, "Cluster Multiplicity = 1"])
+
+
+# Draw the hits of one event (time vs. strip) in the current pad, time axis up to xMax
+# Output: the histogram (to be kept until the pad is saved)
+def drawEventHist(product, name, xMax):
+
+    strips = product["strips"]
+    nBins, xMin = product["xAxis"][0:2]
+    eventHist = ROOT.TH2D(name, "Event %d" % product["evNum"], nBins, xMin, xMax, len(strips), min(strips), max(strips)+1)
+    fillN2(eventHist, product["times"], product["hitStrips"])
+
+    for i in range(1, len(strips)+1): eventHist.GetYaxis().SetBinLabel(i, str(strips[i-1]))
+
+    eventHist.GetXaxis().SetTitle("Time (ns)")
+    eventHist.GetXaxis().SetTitleOffset(1.0)
+    eventHist.GetXaxis().SetLabelOffset(0.0)
+
+    eventHist.GetYaxis().SetTitle("Strip number")
+    eventHist.GetYaxis().SetTitleOffset(1.3)
+    eventHist.GetYaxis().SetLabelOffset(0.005)
+
+    eventHist.Draw("COL")
+    return eventHist
+
+
+# Draw one event, within the muon/noise window and extended up to 600 ns (two files)
+# The event displays are saved one file per event, as PNG only if both formats are selected
+def drawEvent(product, info):
+
+    c2 = getCanvas("c2")
+    rightMargin = c2.GetRightMargin()
+    formats = "png" if info["formats"] == "both" else info["formats"]
+
+    for name, xMax in [("event_%d" % product["evNum"], product["xAxis"][2]), ("event_ext_%d" % product["evNum"], product["extMax"])]:
+
+        c2.cd()
+        c2.SetRightMargin(0.05)
+        c2.Clear()
+
+        eventHist = drawEventHist(product, name, xMax)
+
+        txt = ROOT.TLatex()
+        txt.SetTextFont(42)
+        txt.SetTextSize(0.03)
+        txt.SetNDC()
+        txt.DrawLatex(c2.GetLeftMargin(), 0.035, product["text"])
+
+        drawAux(c2, info, "EV%d" % product["evNum"])
+        c2.RedrawAxis()
+        c2.Modify()
+        save(c2, "%s%s" % (product["path"], name), formats)
+
+    c2.SetRightMargin(rightMargin)
+
+
+# Set the margins of a pad of a divided canvas
+def setPadMargins(pad, left, right, top, bottom):
+
+    pad.SetLeftMargin(left)
+    pad.SetRightMargin(right)
+    pad.SetTopMargin(top)
+    pad.SetBottomMargin(bottom)
+
+
+# Draw a list of events in one multi-page PDF file (product: events, fileName), one page per event: the muon/noise window
+# (top) and the extended window up to 600 ns (bottom)
+def drawEventPages(product, info):
+
+    c = getCanvas("c2")
+    c.Print("%s[" % product["fileName"])
+
+    for event in product["events"]:
+
+        c.cd()
+        c.Clear()
+        c.Divide(1, 2)
+
+        hists = []
+        for i, xMax in [(1, event["xAxis"][2]), (2, event["extMax"])]:
+
+            pad = c.cd(i)
+            setPadMargins(pad, 0.12, 0.05, 0.08, 0.12)
+            hists.append(drawEventHist(event, "event_%d_%d" % (event["evNum"], i), xMax))
+
+        drawEventLabel(c.cd(1), event, info)
+        c.Print(product["fileName"])
+
+    c.Print("%s]" % product["fileName"])
+    c.Clear()
+
+
+# Draw a list of events on one contact sheet (product: events, fileName, tiles), one tile per event (muon/noise window)
+def drawEventSheet(product, info):
+
+    nX, nY = product["tiles"]
+    name = "sheet%dx%d" % (nX, nY)
+    if name not in canvases: canvases[name] = ROOT.TCanvas(name, name, 400*nX, 300*nY)
+    c = canvases[name]
+    c.cd()
+    c.Clear()
+    c.Divide(nX, nY)
+
+    hists = []
+    for i, event in enumerate(product["events"]):
+
+        pad = c.cd(i+1)
+        setPadMargins(pad, 0.15, 0.05, 0.12, 0.15)
+        hists.append(drawEventHist(event, "event_%d" % event["evNum"], event["xAxis"][2]))
+        drawEventLabel(pad, event, info)
+
+    c.Modify()
+    save(c, product["fileName"], info["formats"])
+
+
+# Write the event number and cluster info on top of an event pad
+def drawEventLabel(pad, event, info):
+
+    txt = ROOT.TLatex()
+    txt.SetTextFont(42)
+    txt.SetTextSize(0.05)
+    txt.SetNDC()
+    txt.DrawLatex(pad.GetLeftMargin(), 1.0-0.8*pad.GetTopMargin(), "S%d/HV%d/EV%d: %s" % (info["scanid"], info["HVPoint"], event["evNum"], event["text"]))
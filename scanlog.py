@@ -0,0 +1,72 @@
+
+import os, re, time
+
+
+## Progress of a running WebDCS scan, as written in its log.txt file
+# Each HV point starts with "Scanning point HVn", its DAQ run ends with "[DAQ] Run finished" and the complete scan ends
+# with "HVscan successfully ended!"
+
+
+# Input: path of the log.txt file
+# Output: scan ID (-1 if not yet known), list of the HV points of which the DAQ run is finished, flag if the scan ended
+def parseLog(logFile):
+
+    scanid, HVPoint, finished, ended = -1, -1, [], False
+    try:
+        with open(logFile) as f: lines = f.readlines()
+    except (IOError, OSError): return scanid, finished, ended
+
+    for line in lines:
+
+        m = re.search(r"Initialize HVSCAN (\d+)", line)
+        if m: scanid = int(m.group(1))
+
+        m = re.search(r"Scanning point HV(\d+)", line)
+        if m: HVPoint = int(m.group(1))
+
+        if "[DAQ] Run finished" in line and HVPoint != -1 and HVPoint not in finished: finished.append(HVPoint)
+        if "HVscan successfully ended!" in line: ended = True
+
+    return scanid, finished, ended
+
+
+# Output: size and modification time of the DAQ and CAEN files of an HV point, None if not (yet) written
+def fileStatus(dir, scanid, HVPoint):
+
+    try:
+        return [(os.stat(f).st_size, os.stat(f).st_mtime) for f in ["%s/Scan%.6d_HV%d_%s.root" % (dir, scanid, HVPoint, t) for t in ["DAQ", "CAEN"]]]
+    except OSError: return None
+
+
+# Watch a running scan: generator of the lists of newly finished HV points (in HV order), until the scan ended
+# An HV point is finished when its DAQ run is finished according to the log, and its DAQ/CAEN files exist and did not
+# change during one poll interval (i.e. are closed). The watch stops if nothing changes during timeout seconds.
+def watchScan(dir, pollInterval = 30, timeout = 3600):
+
+    done, status = set(), {}
+    lastChange = time.time()
+    while True:
+
+        scanid, finished, ended = parseLog("%s/log.txt" % dir)
+
+        new = []
+        for HVPoint in finished:
+
+            if HVPoint in done: continue
+            current = fileStatus(dir, scanid, HVPoint)
+            if current is not None and status.get(HVPoint) == current: new.append(HVPoint)
+            status[HVPoint] = current
+
+        if len(new) > 0:
+
+            done.update(new)
+            lastChange = time.time()
+            yield sorted(new)
+
+        if ended and len(done) == len(finished): return
+        if time.time() - lastChange > timeout:
+
+            print "No new HV point during %d s, stop watching the scan" % timeout
+            return
+
+        time.sleep(pollInterval)
@@ -0,0 +1,120 @@
+
+import sys, os, glob, re, multiprocessing
+import caen
+import config
+import analyzeEfficiencyRun
+import analyzeNoiseRun
+
+
+## Parameter sweep: several variants of the analysis of one scan (e.g. muonWindowWidth, timeWindowReject, TDC_strips_mask,
+# clusterization time constraints), each written in its own tag directory as if the scan driver had been run with it.
+# The variants are analyzed as the chambers of the scan driver (see analyzeEfficiencyRun.analyzeHVPoint): the DAQ file of
+# each HV point is read once for all the variants (shared raw data, see Analyzer), and the stage results which do not
+# depend on the varied parameters are filled once (see the stage results cache of the Analyzer)
+
+
+# Input: base configuration, variants {tag: overrides}, clusterization time constraints of all the variants
+# Output: configuration of each variant {tag: config}, including its clusterization time constraints ("clusterTimeWindows")
+def loadVariants(cfg, variants, clusterTimeWindows):
+
+    out = {}
+    for tag in variants:
+
+        out[tag] = dict(cfg, clusterTimeWindows = tuple(clusterTimeWindows))
+        out[tag].update(variants[tag])
+
+    return out
+
+
+
+if __name__ == "__main__":
+
+    ## scanType: "efficiency" or "noise", the results of each variant are those of analyzeEfficiencyRun.py or analyzeNoiseRun.py
+    scanType = "efficiency"
+
+    ## config: base configuration of all the variants (see config.py)
+    cfg = config.cfg_GRAPHITE_HIGH
+
+    ## clusterTimeWindows: nominal/up/down clusterization time constraint (ns) of all the variants (efficiency scans)
+    clusterTimeWindows = (10, 4, 16)
+
+    ## variants: {tag: overrides}, the overrides replace the entries of the base configuration (e.g. muonWindowWidth,
+    ## timeWindowReject, TDC_strips_mask) or the clusterization time constraints ("clusterTimeWindows").
+    ## The plots and results of each variant are saved in the directory with its tagname
+    variants = {
+
+        "INFN_efficiency"               : {},
+        "INFN_efficiency_muonWindow2"   : {"muonWindowWidth": 2},
+        "INFN_efficiency_reject200"     : {"timeWindowReject": 200},
+        "INFN_efficiency_cluster5"      : {"clusterTimeWindows": (5, 2, 8)},
+    }
+
+    ## dir: ROOT directory of all raw data files
+    dir = "."
+
+    ## xMin, xMax: typical voltage range for the analysis
+    xMin, xMax = 6000, 8000
+
+    ## nJobs: number of HV points analyzed in parallel (1: sequential analysis), e.g. multiprocessing.cpu_count(); each
+    ## process holds the decoded DAQ file and hits of its HV point, i.e. the peak memory grows with nJobs
+    nJobs = 1
+
+    ## computeOnly: only compute the results of the HV points (HVPoints.json), no plots per HV point
+    computeOnly = True
+
+    ## formats: output formats of the plots, "png", "pdf", "both" or "none"
+    formats = "both"
+
+    ## eventSummary: write the per-event summary tables of all the HV points of each variant to eventSummary.npz
+    eventSummary = False
+
+    ## muonPeak: muon time window of all the HV points (efficiency scans), see analyzeEfficiencyRun.py: "scan", "fit"
+    ## or (peakMean, peakWidth)
+    muonPeak = "scan"
+
+
+
+    ##############################################################################################
+    outputdir = "%s/" % dir
+    driver = analyzeEfficiencyRun if scanType == "efficiency" else analyzeNoiseRun
+    variants = loadVariants(cfg, variants, clusterTimeWindows) # {tag: config}, analyzed as the chambers of the driver
+    for tag in variants:
+        if not os.path.exists(driver.chamberDir(outputdir, tag)): os.makedirs(driver.chamberDir(outputdir, tag))
+
+    # get the scan ID from the ROOT file
+    files = glob.glob("%s/*CAEN.root" % dir)
+    if len(files) == 0: sys.exit("No ROOT files in directory")
+    scanid = int(re.findall(r'\d+', files[0])[0])
+    driver.scanid = scanid # scan ID on the scan plots (see drawAux)
+
+    # get all ROOT files in the dir
+    files.sort(key=driver.natural_keys) # sort on file name, i.e. according to HV points
+    HVPoints = [int(os.path.basename(CAENFile).split("_")[1][2:]) for CAENFile in files]
+
+    # analyze all HV points for all the variants, in parallel if nJobs > 1 (the results are collected in HV order);
+    # the raw data are shared by the variants, i.e. all the events of an HV point are processed at once (no streaming mode)
+    if scanType == "efficiency":
+
+        if muonPeak == "scan" and not analyzeEfficiencyRun.scanCacheAvailable(dir, scanid, HVPoints):
+
+            print "Warning: the DAQ files cannot be cached (read-only directory?), the muon peak is fitted per HV point (muonPeak = \"fit\") instead of reading each DAQ file twice"
+            muonPeak = "fit"
+
+        peak = dict((tag, {"fit": (-1, -1)}.get(muonPeak, muonPeak)) for tag in variants)
+        if muonPeak == "scan": peak = analyzeEfficiencyRun.scanMuonPeak(dir, outputdir, scanid, HVPoints, variants, nJobs, 1)[0]
+        results = analyzeEfficiencyRun.analyzeHVPoints(dir, outputdir, scanid, HVPoints, variants, computeOnly, nJobs, 1, peak, formats, 0, eventSummary)
+
+    else: results = analyzeNoiseRun.analyzeHVPoints(dir, outputdir, scanid, HVPoints, variants, computeOnly, -1, nJobs, 1, formats, 0, eventSummary)
+
+    CAEN = caen.loadScan(dir, scanid, HVPoints, nJobs) # HV and currents of all the HV points, read at once
+    for tag in sorted(variants):
+
+        points, tables = {}, {}
+        for HVPoint, (analyzerResults, HVTables) in zip(HVPoints, results):
+
+            points[HVPoint] = driver.loadHVPoint(CAEN, HVPoint, variants[tag], analyzerResults[tag])
+            for kind in HVTables[tag]: tables.setdefault(kind, {})[HVPoint] = HVTables[tag][kind]
+
+        driver.writeHVPoints(points, driver.chamberDir(outputdir, tag))
+        for kind in tables: driver.writeTables(tables[kind], driver.chamberDir(outputdir, tag), kind)
+        driver.summarizeScan(points, driver.chamberDir(outputdir, tag), xMin, xMax, formats)
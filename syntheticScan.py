@@ -0,0 +1,182 @@
+
+import sys, os, math, array
+import ROOT
+import numpy as np
+import config
+
+
+## Generator of synthetic WebDCS scans (see benchmark.py)
+# For each HV point, a Scan%06d_HV%d_DAQ.root file (RAWData tree with the same branches as the DAQ) and a
+# Scan%06d_HV%d_CAEN.root file (HVeff/HVapp/HVmon/Imon histograms of both gaps) are written, together with the log.txt of the scan
+#
+# Each event contains noise hits (uniform in time and over all strips) and, with a probability following a sigmoid
+# efficiency curve, one muon cluster (adjacent strips, Gaussian time peak). A fraction of the events is flagged as corrupted.
+settings = {
+
+    "scanid":               1,
+    "scanType":             "efficiency",   # efficiency (muon trigger window) or noise (noise trigger window, no muons)
+    "HVPoints":             [6400, 6600, 6800, 7000, 7200, 7400, 7600], # effective HV of each point (V)
+    "nEvents":              10000,  # number of triggers per HV point
+
+    "muonPeakMean":         267,    # time of the muon peak (ns)
+    "muonPeakSigma":        9,      # width of the muon peak (ns)
+    "muonJitter":           1,      # time spread of the hits inside a muon cluster (ns)
+    "meanClusterSize":      2.0,    # mean muon cluster size (strips)
+    "effMax":               0.98,   # efficiency curve: effMax / (1 + exp(lambda*(HV50 - HV)))
+    "lambda":               0.01,
+    "HV50":                 6900,
+
+    "noiseRate":            20.,    # noise rate per strip (Hz/cm2), the hit multiplicity follows from the trigger window
+    "corruptedFraction":    0.001,  # fraction of events with a corrupted TDC quality flag
+
+    "currentPerVolt":       1e-4,   # mean gap current (uA) per V above 5000 V
+    "seed":                 0,
+}
+
+
+# Input: generator settings (see above), chamber configuration (see config.py)
+# Output: TDC channels and time stamps of all events (flat arrays and per-event offsets), quality flags
+def generateEvents(s, cfg, HV):
+
+    rnd = np.random.RandomState(s["seed"] + int(HV))
+    nEvents = s["nEvents"]
+    triggerWindow = cfg["muonTriggerWindow"] if s["scanType"] == "efficiency" else cfg["noiseTriggerWindow"]
+    channels = np.asarray(cfg["TDC_channels"])
+    nStrips = len(channels)
+
+    # noise hits
+    meanNoiseHits = s["noiseRate"] * cfg["stripArea"] * triggerWindow * 1e-9 * nStrips
+    nNoise = rnd.poisson(meanNoiseHits, nEvents)
+    noiseEvent = np.repeat(np.arange(nEvents), nNoise)
+    noiseStrip = rnd.randint(0, nStrips, len(noiseEvent))
+    noiseTime = rnd.uniform(0, triggerWindow, len(noiseEvent))
+
+    # muon clusters
+    eff = 0.0
+    if s["scanType"] == "efficiency": eff = s["effMax"] / (1.0 + math.exp(s["lambda"]*(s["HV50"] - HV)))
+    muonEvents = np.nonzero(rnd.uniform(size=nEvents) < eff)[0]
+    CLS = np.minimum(1 + rnd.poisson(s["meanClusterSize"]-1, len(muonEvents)), nStrips)
+    first = (rnd.uniform(size=len(muonEvents)) * (nStrips - CLS + 1)).astype(np.int64)
+    peak = rnd.normal(s["muonPeakMean"], s["muonPeakSigma"], len(muonEvents))
+
+    muonEvent = np.repeat(muonEvents, CLS)
+    muonStrip = np.repeat(first, CLS) + (np.arange(CLS.sum()) - np.repeat(np.cumsum(CLS) - CLS, CLS))
+    muonTime = np.clip(np.repeat(peak, CLS) + rnd.normal(0, s["muonJitter"], len(muonEvent)), 0, triggerWindow)
+
+    # merge and order by event (and time, as the DAQ does)
+    event = np.concatenate([noiseEvent, muonEvent])
+    strip = np.concatenate([noiseStrip, muonStrip])
+    time = np.round(np.concatenate([noiseTime, muonTime]), 1) # 100 ps TDC resolution
+    order = np.lexsort((time, event))
+
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(event, minlength=nEvents))])
+
+    # quality flags: one digit per TDC (1: ok, 2: corrupted)
+    TDCs = sorted(set(int(ch) // 1000 for ch in channels))
+    qFlag = np.full(nEvents, sum(10**tdc for tdc in TDCs), dtype=np.int64)
+    corrupted = np.nonzero(rnd.uniform(size=nEvents) < s["corruptedFraction"])[0]
+    qFlag[corrupted] += 10**np.asarray(TDCs)[rnd.randint(0, len(TDCs), len(corrupted))]
+
+    return offsets, channels[strip[order]], time[order], qFlag
+
+
+def writeDAQ(fileName, offsets, channel, time, qFlag):
+
+    fOut = ROOT.TFile(fileName, "RECREATE")
+    t = ROOT.TTree("RAWData", "RAWData")
+
+    EventNumber = array.array('i', [0])
+    number_of_hits = array.array('i', [0])
+    Quality_flag = array.array('i', [0])
+    TDC_channel = ROOT.std.vector('int')()
+    TDC_TimeStamp = ROOT.std.vector('float')()
+
+    t.Branch("EventNumber", EventNumber, "EventNumber/I")
+    t.Branch("number_of_hits", number_of_hits, "number_of_hits/I")
+    t.Branch("Quality_flag", Quality_flag, "Quality_flag/I")
+    t.Branch("TDC_channel", TDC_channel)
+    t.Branch("TDC_TimeStamp", TDC_TimeStamp)
+
+    for evNum in range(len(qFlag)):
+
+        TDC_channel.clear()
+        TDC_TimeStamp.clear()
+        for i in range(offsets[evNum], offsets[evNum+1]):
+            TDC_channel.push_back(int(channel[i]))
+            TDC_TimeStamp.push_back(float(time[i]))
+
+        EventNumber[0] = evNum+1
+        number_of_hits[0] = offsets[evNum+1] - offsets[evNum]
+        Quality_flag[0] = int(qFlag[evNum])
+        t.Fill()
+
+    triggers = ROOT.TH1I("Triggers", "Number of triggers for this run", 1, 0, 1)
+    triggers.SetBinContent(1, len(qFlag))
+
+    t.Write()
+    triggers.Write()
+    fOut.Close()
+
+
+def writeCAEN(fileName, s, cfg, HV):
+
+    rnd = np.random.RandomState(s["seed"] + int(HV) + 1)
+    fOut = ROOT.TFile(fileName, "RECREATE")
+
+    hists = []
+    for gap in [cfg["topGapName"], cfg["botGapName"]]:
+
+        for name in ["HVeff", "HVapp", "HVmon"]:
+            h = ROOT.TH1F("%s_%s" % (name, gap), "%s_%s" % (name, gap), 1000, 0, 8192)
+            for v in rnd.normal(HV, 1.0, 1000): h.Fill(v)
+            hists.append(h)
+
+        h = ROOT.TH1F("Imon_%s" % gap, "Imon_%s" % gap, 1000, 0, 1)
+        for v in rnd.normal(max(HV - 5000, 0)*s["currentPerVolt"], 0.01, 1000): h.Fill(v)
+        hists.append(h)
+
+    for h in hists: h.Write()
+    fOut.Close()
+
+
+def writeLog(fileName, s):
+
+    with open(fileName, 'w') as f:
+
+        f.write("[HVscan][0] Initialize HVSCAN %d\n" % s["scanid"])
+        f.write("[HVscan][63] Start HVScan\n")
+        for i in range(len(s["HVPoints"])):
+            f.write("[HVscan][0] Scanning point HV%d\n" % (i+1))
+            f.write("[DAQ] Run finished. Waiting for the next signal...\n")
+        f.write("[HVscan][0] HVscan successfully ended!\n")
+
+
+# Input: output directory, generator settings (see above), chamber configuration (see config.py)
+def generateScan(dir, s = settings, cfg = config.cfg_GRAPHITE_HIGH):
+
+    if not os.path.exists(dir): os.makedirs(dir)
+
+    for i,HV in enumerate(s["HVPoints"]):
+
+        print "Generate HV point %d (%d V)" % (i+1, HV)
+        offsets, channel, time, qFlag = generateEvents(s, cfg, HV)
+        writeDAQ("%s/Scan%.6d_HV%d_DAQ.root" % (dir, s["scanid"], i+1), offsets, channel, time, qFlag)
+        writeCAEN("%s/Scan%.6d_HV%d_CAEN.root" % (dir, s["scanid"], i+1), s, cfg, HV)
+
+    writeLog("%s/log.txt" % dir, s)
+
+
+
+if __name__ == "__main__":
+
+    ## dir: directory where the synthetic scan is written
+    dir = "syntheticScan"
+
+    ## settings: see the settings dict above, e.g. a noise scan with 10 us trigger window
+    #settings["scanType"] = "noise"
+
+    ## config: chamber configuration used for the TDC mapping, strip area and gap names
+    cfg = config.cfg_GRAPHITE_HIGH
+
+
+    generateScan(dir, settings, cfg)